@@ -3,8 +3,8 @@ import os
 import sys
 import signal
 import types
-import time
 import ssl
+import time
 from datetime import datetime
 
 import irc.strings
@@ -12,9 +12,13 @@ from irc.bot import SingleServerIRCBot
 
 from stockbot.configuration import configuration
 from stockbot.db import create_tables
-from stockbot.command import root_command
+from stockbot.command import root_command, ErrorReply
 from stockbot.provider import QuoteServiceFactory
-from stockbot.util import colorify
+from stockbot.outbound import OutboundQueue
+from stockbot.executor import CommandExecutor, WorkerPool
+from stockbot.metrics import registry
+from stockbot import lines
+from stockbot.scheduler import JobFailed, JobRunner, JobScheduler
 from stockbot.timer import OncePerHourTimer
 
 # Set up logging
@@ -27,48 +31,98 @@ LOGGER = logging.getLogger(__name__)
 class IRCBot(SingleServerIRCBot):
 
     def __init__(self, **kwargs):
-        super(IRCBot, self).__init__([(configuration.server_name, int(configuration.server_port),
+        super(IRCBot, self).__init__([(configuration.server_name, configuration.server_port,
                                        configuration.server_password)], configuration.nick, configuration.nick,
                                      **kwargs)
         self.channel = configuration.channel_name
         self.failed_health_checks = 0
         self.max_failed_health_checks = 10
 
-        if configuration.scheduler:
-            self.reactor.scheduler.execute_every(60, self.execute_every_60_seconds)
         if configuration.die_when_not_pinged:
             self.reactor.scheduler.execute_every(60, self.health_check)
         self.quote_service_factory = QuoteServiceFactory()
-        self.ephemeral_oneshot_timers = set()
-        self.daily_timers = set()
+        self.outbound = OutboundQueue(rate=configuration.flood_rate_per_s, burst=configuration.flood_burst,
+                                      max_queue_size=configuration.flood_max_queue_size)
+        self.command_executor = CommandExecutor(max_workers=configuration.command_workers,
+                                                max_queue_size=configuration.command_queue_size,
+                                                timeout=configuration.command_timeout_s)
+        self.reactor.scheduler.execute_every(configuration.reactor_tick_interval_s, self.reactor_tick)
+        registry.register_collector(lambda: [
+            ("stockbot_command_queue_depth", {}, self.command_executor.queue_depth()),
+            ("stockbot_command_executor_in_flight", {}, self.command_executor.in_flight()),
+            ("stockbot_outbound_queue_depth", {}, len(self.outbound)),
+        ])
+        if configuration.metrics_file:
+            self.reactor.scheduler.execute_every(configuration.metrics_export_interval_s, self.write_metrics)
+        self.job_scheduler = JobScheduler()
+        self.job_runner = JobRunner(pool=WorkerPool(name="job", max_workers=configuration.job_workers,
+                                                    max_queue_size=configuration.job_queue_size))
+        # when the reactor is going to wake us up for the next job, None if it isn't
+        self.job_wake_at = None
         self.last_server_ping = datetime.now()
 
         # self.commands = DatabaseCollection(type=ScheduledCommand, attribute="command")
 
     def health_check(self):
-        if (datetime.now() - self.last_server_ping).seconds > int(configuration.die_when_not_pinged_in_s):
+        if (datetime.now() - self.last_server_ping).seconds > configuration.die_when_not_pinged_in_s:
             self.die("BAI")
 
-    def execute_every_60_seconds(self):
+    def add_job(self, job):
+        self.job_scheduler.add(job)
+        self.schedule_wake_up()
+
+    def schedule_wake_up(self):
+        # ask the reactor to call us when the next job is due, unless it already is going to call us before that
+        delay = self.job_scheduler.next_delay()
+        if delay is None or not configuration.scheduler:
+            return
+        wake_at = time.time() + delay
+        if self.job_wake_at is not None and self.job_wake_at <= wake_at:
+            return
+        self.job_wake_at = wake_at
+        self.reactor.scheduler.execute_after(delay, self.run_due_jobs)
+
+    def run_due_jobs(self):
+        self.job_wake_at = None
         if not self.connection.is_connected():
             LOGGER.debug("Not connected yet, hold off")
+            self.job_wake_at = time.time() + 5
+            self.reactor.scheduler.execute_after(5, self.run_due_jobs)
             return
 
-        for timer in self.daily_timers:
-            if timer.should_fire():
-                try:
-                    root_command.execute(*timer.command,
-                                         command_args={"service_factory": self.quote_service_factory,
-                                                       "instance": self}, callback=self.command_callback,
-                                         callback_args={})
-                except Exception as e:
-                    LOGGER.exception(f"failed to execute scheduled command '{timer.command}'")
+        for job in self.job_scheduler.pop_due():
+            if self.job_runner.run(job, self.execute_job, job) == JobRunner.REJECTED:
+                LOGGER.warning(f"too many jobs running, dropped scheduled command '{job.command}'")
+        self.schedule_wake_up()
+
+    def execute_job(self, job):
+        # runs in a job worker, inline so non blocking commands finish here too and the job runner's overlap policy,
+        # max runtime and timings cover the whole command. The reply goes through the outbound queue like any other
+        errors = []
+
+        def callback(result, **kwargs):
+            rows = result if isinstance(result, list) else [result]
+            errors.extend(str(x) for x in rows if isinstance(x, ErrorReply))
+            self.command_callback(result, **kwargs)
+
+        root_command.execute(*job.command,
+                             command_args={"service_factory": self.quote_service_factory, "instance": self},
+                             callback=callback, callback_args={}, inline=True)
+        # commands reply with their failures rather than raising, the job runner records them as the job's error
+        if len(errors) > 0:
+            raise JobFailed(", ".join(errors))
+
+    def write_metrics(self):
+        try:
+            registry.write(configuration.metrics_file)
+        except Exception:
+            LOGGER.exception("failed to write metrics to '{}'".format(configuration.metrics_file))
 
     def on_nicknameinuse(self, c, e):
         c.nick(c.get_nickname() + "_")
 
     def _startup_commands(self):
-        self.daily_timers.add(OncePerHourTimer(["game", "reddit"], fire_at_minute=0))
+        self.add_job(OncePerHourTimer(["game", "reddit"], fire_at_minute=0).job())
 
     def on_welcome(self, c, e):
         c.join(self.channel)
@@ -85,7 +139,8 @@ class IRCBot(SingleServerIRCBot):
         commands = [x for x in message.split(" ")]
         root_command.execute(*commands, command_args={"service_factory": self.quote_service_factory,
                                                       "instance": self, "sender": sender},
-                             callback=self.command_callback_priv, callback_args={"sender": sender})
+                             callback=self.command_callback_priv, callback_args={"sender": sender},
+                             executor=self.command_executor)
 
     def on_pubmsg(self, c, e):
         sender = e.source.nick
@@ -99,43 +154,34 @@ class IRCBot(SingleServerIRCBot):
             try:
                 root_command.execute(*commands, command_args={"service_factory": self.quote_service_factory,
                                                               "instance": self, "sender": sender},
-                                     callback=self.command_callback, callback_args={"sender": sender})
+                                     callback=self.command_callback, callback_args={"sender": sender},
+                                     executor=self.command_executor)
             except Exception as e:
                 LOGGER.exception("something failed", e)
                 self.command_callback("something failed", sender=sender)
 
     def command_callback_priv(self, result, **kwargs):
-        target = kwargs.get('sender', None)
-        if isinstance(result, list) or isinstance(result, types.GeneratorType):
-            for row in result:
-                self.colorify_send(target, str(row))
-                time.sleep(1)  # avoid getting kicked out from server
-        elif result is not None:
-            self.colorify_send(target, str(result))
+        self.enqueue(kwargs.get('sender', None), result)
 
     def command_callback(self, result, **kwargs):
+        self.enqueue(self.channel, result)
+
+    def enqueue(self, target, result):
+        # rows are packed into as few lines as fit in a message, the lines are paced by reactor_tick so we don't get
+        # kicked out from server
         if isinstance(result, list) or isinstance(result, types.GeneratorType):
-            for row in result:
-                self.colorify_send(self.channel, str(row))
-                time.sleep(1)  # avoid getting kicked out from server
+            rows = list(result)
         elif result is not None:
-            self.colorify_send(self.channel, str(result))
-
-    def colorify_send(self, target, msg):
-        # irc.client.MessageTooLong: Messages limited to 512 bytes including CR/LF
-        colored_message = colorify(msg)
-        if len(colored_message) > 512 or not configuration.should_colorify:
-            self.connection.privmsg(target, msg[:512])
+            rows = [result]
         else:
-            self.connection.privmsg(target, colored_message)
+            return
+        for line in lines.pack(rows, lines.byte_budget("PRIVMSG", target), colored=configuration.should_colorify):
+            self.outbound.put(target, line)
 
-    def colorify_notice(self, target, msg):
-        # irc.client.MessageTooLong: Messages limited to 512 bytes including CR/LF
-        colored_message = colorify(msg)
-        if len(colored_message) > 512 or not configuration.should_colorify:
-            self.connection.notice(target, msg[:512])
-        else:
-            self.connection.notice(target, colored_message)
+    def reactor_tick(self):
+        self.command_executor.run_pending_callbacks()
+        if self.connection.is_connected():
+            self.outbound.drain(self.connection.privmsg)
 
     def on_ping(self, c, e):
         self.last_server_ping = datetime.now()
@@ -155,6 +201,14 @@ if __name__ == '__main__':
         bot.die("kthxbai")
         sys.exit(0)
 
+    def sighup_handler(*args):
+        try:
+            configuration.reload()
+            LOGGER.info("reloaded configuration")
+        except Exception:
+            LOGGER.exception("failed to reload configuration, keeping the current one")
+
     signal.signal(signal.SIGTERM, sigterm_handler)
+    signal.signal(signal.SIGHUP, sighup_handler)
 
     bot.start()
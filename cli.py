@@ -7,19 +7,33 @@ import stockbot.configuration
 from stockbot.db import create_tables
 from stockbot.provider import QuoteServiceFactory
 from stockbot.command import root_command
+from stockbot import render
 
 stockbot.configuration.DEFAULT_VALUES["database_url"] = "sqlite:////cli.db"
+stockbot.configuration.configuration.reload()
+
+
+# rows that have fields are printed as json objects with --json
+as_json = len(sys.argv) > 1 and sys.argv[1] == "--json"
+args = sys.argv[2:] if as_json else sys.argv[1:]
+
+
+def to_str(row):
+    fields = render.fields_of(row)
+    if as_json and fields is not None:
+        return render.to_json(fields)
+    return str(row)
 
 
 def callback(result):
     if isinstance(result, list):
-        print("\n".join(result))
+        print("\n".join([to_str(x) for x in result]))
     elif result is not None:
-        print(result)
+        print(to_str(result))
     else:
         root_command.execute(*["help"], callback=callback)
 
 
 create_tables()
 
-root_command.execute(*sys.argv[1:], command_args={"service_factory": QuoteServiceFactory()}, callback=callback)
\ No newline at end of file
+root_command.execute(*args, command_args={"service_factory": QuoteServiceFactory()}, callback=callback)
\ No newline at end of file
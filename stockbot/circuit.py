@@ -0,0 +1,112 @@
+import contextvars
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    """ raised instead of calling an upstream that is known to be failing """
+
+    def __init__(self, name):
+        super().__init__("{} is unavailable right now, try again later".format(name))
+        self.name = name
+
+    def __reduce__(self):
+        # copies and pickles are built from the name, not from the message
+        return CircuitOpen, (self.name,)
+
+
+class CircuitBreaker(object):
+    """
+    Thread safe circuit breaker. It opens after failure_threshold consecutive failed or slow calls, while open every
+    call is turned away with CircuitOpen. After reset_timeout seconds a single probe call is let through (half open),
+    it closes the circuit when it succeeds and opens it again when it doesn't.
+
+    Calls made from inside a call that already went through the breaker pass straight through, so a service method
+    calling another guarded method of the same service is accounted for once. That is tracked in a context variable,
+    so it holds in worker threads running a copy of the caller's context too.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, *args, **kwargs):
+        self.name = kwargs.get('name', 'upstream')
+        self.failure_threshold = kwargs.get('failure_threshold', 5)
+        # calls taking at least this many seconds count as failures even when they succeed
+        self.slow_call = kwargs.get('slow_call', 10.0)
+        self.reset_timeout = kwargs.get('reset_timeout', 30.0)
+        self.clock = kwargs.get('clock', time.monotonic)
+        self.lock = threading.Lock()
+        self.inside = contextvars.ContextVar("circuit_{}_inside".format(self.name), default=False)
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.opened = 0
+        self.rejected = 0
+
+    def call(self, func, *args, **kwargs):
+        if self.inside.get():
+            return func(*args, **kwargs)
+        if not self.allow():
+            raise CircuitOpen(self.name)
+        token = self.inside.set(True)
+        started = self.clock()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        finally:
+            self.inside.reset(token)
+        self.record_success(self.clock() - started)
+        return result
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.OPEN and self.clock() - self.opened_at >= self.reset_timeout:
+                LOGGER.info("circuit for {} is half open, probing".format(self.name))
+                self.state = self.HALF_OPEN
+                return True
+            if self.state == self.CLOSED:
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self, seconds):
+        if seconds >= self.slow_call:
+            LOGGER.warning("slow call to {}, took {:.1f}s".format(self.name, seconds))
+            self.record_failure()
+            return
+        with self.lock:
+            if self.state != self.CLOSED:
+                LOGGER.info("circuit for {} is closed again".format(self.name))
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and
+                                                self.failures >= self.failure_threshold):
+                LOGGER.warning("circuit for {} opened after {} failures".format(self.name, self.failures))
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+                self.opened += 1
+
+    def samples(self):
+        with self.lock:
+            labels = {"upstream": self.name}
+            return [
+                ("stockbot_circuit_open", labels, 0 if self.state == self.CLOSED else 1),
+                ("stockbot_circuit_opened_total", labels, self.opened),
+                ("stockbot_circuit_rejected_total", labels, self.rejected),
+            ]
+
+    def result_as_list(self):
+        with self.lock:
+            return ["Circuit: {}, Consecutive failures: {}, Opened: {}, Rejected: {}".format(
+                self.state, self.failures, self.opened, self.rejected)]
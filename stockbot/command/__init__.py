@@ -1,9 +1,89 @@
-import threading
+import bisect
 import logging
+import threading
+import types
+
+from stockbot.cache import TTLCache
+from stockbot.circuit import CircuitOpen
+from stockbot import deadline
+from stockbot.configuration import configuration
+from stockbot.executor import CommandExecutor, WorkerPool
+from stockbot import http
+from stockbot.metrics import registry, timed
 
 LOGGER = logging.getLogger(__name__)
 
 
+class CommandOutputCache(object):
+    """
+    Short lived cache of command results keyed by command path and normalized arguments, a command repeated within
+    its cache_ttl is answered without being executed again. Keeps hit and miss counters per command.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.cache = TTLCache(max_size=kwargs.get('max_size', 500))
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    @staticmethod
+    def key(path, args):
+        return path, tuple(x.strip().lower() for x in args if x.strip())
+
+    def get(self, path, args):
+        result = self.cache.get(self.key(path, args))
+        with self.lock:
+            counters = self.counters.setdefault(path, {"hits": 0, "misses": 0})
+            counters["hits" if result is not None else "misses"] += 1
+        return result
+
+    def set(self, path, args, result, ttl):
+        self.cache.set(self.key(path, args), result, ttl=ttl)
+
+    def invalidate(self, path=None):
+        """ drop the cached output of the command with that path, or of every command """
+        if path is None:
+            self.cache.clear()
+        else:
+            self.cache.invalidate_matching(lambda key: key[0] == path)
+
+    def clear(self):
+        self.cache.clear()
+        with self.lock:
+            self.counters = {}
+
+    def samples(self):
+        with self.lock:
+            return [("stockbot_command_cache_{}_total".format(k), {"command": path}, v)
+                    for path, counters in self.counters.items() for k, v in counters.items()]
+
+    def result_as_list(self):
+        with self.lock:
+            return ["Command: {}, Hits: {hits}, Misses: {misses}".format(k, **v)
+                    for k, v in sorted(self.counters.items())]
+
+
+class ErrorReply(str):
+    """ a reply telling that the command failed, it is never served from the output cache """
+
+
+def cacheable(result):
+    if isinstance(result, list):
+        return not any(isinstance(x, ErrorReply) for x in result)
+    return result is not None and not isinstance(result, ErrorReply)
+
+
+# shared by every NonBlockingExecuteCommand
+task_pool = WorkerPool(name="task", max_workers=configuration.task_workers,
+                       max_queue_size=configuration.task_queue_size)
+output_cache = CommandOutputCache(max_size=configuration.command_cache_size)
+
+registry.register_collector(lambda: [
+    ("stockbot_task_queue_depth", {}, task_pool.queue_depth()),
+    ("stockbot_task_active_workers", {}, task_pool.active_workers()),
+    ("stockbot_command_cache_entries", {}, len(output_cache.cache)),
+] + output_cache.samples())
+
+
 class Command(object):
 
     def __init__(self, *args, **kwargs):
@@ -12,18 +92,58 @@ class Command(object):
         self.execute_command = kwargs.get('execute_command')
         self.expected_num_args = kwargs.get('expected_num_args', 0)
         self.help = kwargs.get('help', None)
+        # seconds the command may take, its IO deadline and when an executor replies that it timed out, None for
+        # command_timeout_s
+        self.timeout = kwargs.get('timeout', None)
+        # seconds the output may be served from the output cache for the same arguments, 0 disables caching
+        self.cache_ttl = kwargs.get('cache_ttl', 0)
         self.parent_command = None
         self.subcommands = []
+        # name and short name of every subcommand, plus the names sorted for prefix lookups
+        self.index = {}
+        self.sorted_names = []
         self.fallback_command = None
+        self.help_cache = None
 
     def register(self, command):
         command.parent_command = self
         self.subcommands.append(command)
+        for name in [command.name, command.short_name]:
+            if name is not None:
+                if name not in self.index:
+                    bisect.insort(self.sorted_names, name)
+                self.index[name] = command
+        self.invalidate_help()
 
     def register_fallback(self, fallback_command):
         fallback_command.parent_command = self
         self.fallback_command = fallback_command
 
+    def invalidate_help(self):
+        command = self
+        while command is not None:
+            command.help_cache = None
+            command = command.parent_command
+
+    def resolve(self, name):
+        """
+        Look up a subcommand by name or short name, or by a prefix that only matches a single subcommand
+
+        :param name:
+        :return: the subcommand or None
+        """
+        command = self.index.get(name)
+        if command is not None or not name:
+            return command
+        i = bisect.bisect_left(self.sorted_names, name)
+        candidates = set()
+        while i < len(self.sorted_names) and self.sorted_names[i].startswith(name):
+            candidates.add(self.index[self.sorted_names[i]])
+            if len(candidates) > 1:
+                return None
+            i += 1
+        return candidates.pop() if len(candidates) == 1 else None
+
     def execute(self, *args, **kwargs):
         """
         Recurse the command tree, this method should be overridden when it actually should be doing something
@@ -33,12 +153,40 @@ class Command(object):
         """
         e = args[0]
         LOGGER.debug("Item: {}".format(e))
-        c = [x for x in self.subcommands if x.name == e or x.short_name == e]
-        if len(c) == 0:
+        c = self.resolve(e)
+        if c is None:
             if self.fallback_command:
                 return self.fallback_command.execute(*args[1:], **kwargs)
             return None
-        return c[0].execute(*args[1:], **kwargs)
+        return c.execute(*args[1:], **kwargs)
+
+    def run_command(self, *args, **kwargs):
+        """
+        Call execute_command and consume what it yields, within the command's timeout (command_timeout_s by default)
+        which is the deadline every IO call made by the command has to respect. A deadline the caller already set is
+        kept when it is earlier.
+
+        A command that ran past its deadline raises DeadlineExceeded here even when it caught it along with
+        everything else, so command functions don't need to let it through themselves and their "broken" replies
+        don't hide a timeout. An upstream behind an open circuit is replied to with the CircuitOpen message.
+        """
+        with deadline.within(self.timeout or configuration.command_timeout_s):
+            try:
+                result = self.execute_command(*args, **kwargs)
+                if isinstance(result, types.GeneratorType):
+                    result = list(result)
+            except CircuitOpen as e:
+                result = ErrorReply(str(e))
+            deadline.check()
+            return result
+
+    def path(self):
+        names = []
+        command = self
+        while command.parent_command is not None:
+            names.append(command.name)
+            command = command.parent_command
+        return " ".join(reversed(names))
 
     def __repr__(self):
         help_output = [self.name]
@@ -49,6 +197,11 @@ class Command(object):
         return " ".join(help_output)
 
     def show_help(self, *args, **kwargs):
+        if self.help_cache is None:
+            self.help_cache = self._render_help()
+        return list(self.help_cache)
+
+    def _render_help(self):
         def paths(tree):
             """took and modified https://stackoverflow.com/a/5671568"""
             root = tree
@@ -84,20 +237,41 @@ class BlockingExecuteCommand(Command):
     def execute(self, *args, **kwargs):
         cb = kwargs.get('callback', None)
         cb_args = kwargs.get('callback_args', {})
+        executor = kwargs.get('executor', None)
         if self.expected_num_args > len(args):
             if callable(cb):
                 return cb(self.printable_self_help(), **cb_args)
             else:
                 return self.printable_self_help()
-        if callable(self.execute_command):
-            result = self.execute_command(*args, **kwargs.get('command_args'))
-        else:
+        execute_command = self.run_command if callable(self.execute_command) else None
+        if self.cache_ttl > 0 and callable(execute_command):
+            cached = output_cache.get(self.path(), args)
+            if cached is not None:
+                return cb(cached, **cb_args) if callable(cb) else cached
+            execute_command = self.execute_and_cache
+        if callable(execute_command):
+            execute_command = timed(self.path(), execute_command)
+        if executor is not None and callable(cb) and callable(execute_command):
+            # run it in the executor's worker pool, the callback is invoked later on the caller's thread
+            return executor.submit(execute_command, args, kwargs.get('command_args'), cb, cb_args,
+                                   timeout=self.timeout)
+        if not callable(execute_command):
             raise RuntimeError("execute_command not callable")
+        try:
+            result = execute_command(*args, **kwargs.get('command_args'))
+        except deadline.DeadlineExceeded:
+            result = CommandExecutor.timeout_message
         if callable(cb):
             return cb(result, **cb_args)
         else:
             return result
 
+    def execute_and_cache(self, *args, **kwargs):
+        result = self.run_command(*args, **kwargs)
+        if cacheable(result):
+            output_cache.set(self.path(), args, result, self.cache_ttl)
+        return result
+
 
 class NonBlockingExecuteCommand(Command):
 
@@ -105,60 +279,96 @@ class NonBlockingExecuteCommand(Command):
         super(NonBlockingExecuteCommand, self).__init__(*args, **kwargs)
         self.exclusive = kwargs.get('exclusive', True)
         self.return_prompts = kwargs.get('return_prompts', False)
+        # what to do when every worker is busy, WorkerPool.QUEUE or WorkerPool.REJECT
+        self.saturation_policy = kwargs.get('saturation_policy', WorkerPool.QUEUE)
+        self.pool = kwargs.get('pool', task_pool)
 
     def execute(self, *args, **kwargs):
+        """
+        Submit the task to the pool and return at once, or with inline=True run it on the calling thread, which is
+        what a caller that is already a worker (a scheduled job) wants
+        """
         cb = kwargs.get('callback', None)
         cb_args = kwargs.get('callback_args', {})
-        thread_name = "thread-{}".format("_".join(args))
-        if self.exclusive and self.is_already_running(thread_name):
-            if self.return_prompts:
-                if callable(cb):
-                    return cb("Task is currently running, hold your horses")
-                return "Task is currently running, hold your horses"
-            else:
-                return
-        if callable(self.execute_command):
-            thread = CommandThread(name=thread_name, target=self.execute_command, args=args,
-                                   kwargs=kwargs.get('command_args'), daemon=False)
-            thread.set_callback(cb, cb_args)
-            thread.start()
-        else:
+        task_name = "task-{}-{}".format(self.name, "_".join(args))
+        if not callable(self.execute_command):
             raise RuntimeError("execute_command not callable")
+        if kwargs.get('inline', False):
+            return self.run_task(cb, cb_args, args, kwargs.get('command_args'))
+        status = self.pool.submit_named(task_name, self.run_task, cb, cb_args, args, kwargs.get('command_args'),
+                                        exclusive=self.exclusive, policy=self.saturation_policy)
+        if status == WorkerPool.RUNNING:
+            prompt = "Task is currently running, hold your horses"
+        elif status == WorkerPool.REJECTED:
+            prompt = "Too busy right now, try again in a bit"
+        else:
+            prompt = "Task started"
         if self.return_prompts:
             if callable(cb):
-                return cb("Task started")
-            return "Task started"
+                return cb(prompt)
+            return prompt
 
-    @staticmethod
-    def is_already_running(thread_name):
-        return len([t for t in threading.enumerate() if t.name == thread_name]) > 0
+    def run_task(self, cb, cb_args, args, command_args):
+        # block until task has finished
+        try:
+            result = timed(self.path(), self.run_command)(*args, **command_args)
+        except deadline.DeadlineExceeded:
+            result = CommandExecutor.timeout_message
 
+        if callable(cb):
+            cb(result, **cb_args)
 
-#
-# Thread wrapper
-#
-class CommandThread(threading.Thread):
 
-    def __init__(self, *args, **kwargs):
-        super(CommandThread, self).__init__(*args, **kwargs)
-        self._callback = None
-        self._callback_args = {}
+root_command = Command(name="root")
+root_command.register(BlockingExecuteCommand(name="help", execute_command=root_command.show_help,
+                                             help="show help section"))
 
-    def set_callback(self, cb, cb_args):
-        self._callback = cb
-        self._callback_args = cb_args
 
-    def run(self):
-        # block until task has finished
-        result = self._target(*self._args, **self._kwargs)
+def get_command_stats(*args, **kwargs):
+    def ms(value):
+        return "{:.0f}".format(value * 1000) if value is not None else "N/A"
 
-        if callable(self._callback):
-            self._callback(result, **self._callback_args)
+    result = []
+    for path in registry.label_values("stockbot_command_duration_seconds", "command"):
+        labels = {"command": path}
+        histogram = registry.histogram("stockbot_command_duration_seconds", labels)
+        p50, p95, p99 = registry.percentiles("stockbot_command_duration_seconds", labels, (50, 95, 99))
+        result.append("Command: {}, Count: {}, Errors: {}, In Flight: {}, p50 ms: {}, p95 ms: {}, p99 ms: {}".format(
+            path, histogram.count, registry.counter("stockbot_command_errors_total", labels),
+            registry.gauge("stockbot_command_in_flight", labels), ms(p50), ms(p95), ms(p99)))
+    if len(result) > 0:
+        return result
+    return "No commands executed yet"
 
 
-root_command = Command(name="root")
-root_command.register(BlockingExecuteCommand(name="help", execute_command=root_command.show_help,
-                                             help="show help section"))
+def get_upstream_stats(*args, **kwargs):
+    result = http.result_as_list()
+    if len(result) > 0:
+        return result
+    return "No upstream requests done yet"
+
+
+def get_output_cache_stats(*args, **kwargs):
+    result = output_cache.result_as_list()
+    if len(result) > 0:
+        return result
+    return "No cached commands executed yet"
+
+
+def clear_output_cache(*args, **kwargs):
+    output_cache.clear()
+    return "Cleared command output cache"
+
+
+root_command.register(BlockingExecuteCommand(name="stats", execute_command=get_command_stats,
+                                             help="latency percentiles per command"))
+root_command.register(BlockingExecuteCommand(name="upstream", execute_command=get_upstream_stats,
+                                             help="latency, status codes and bytes per upstream endpoint"))
+
+cache_command = Command(name="cache")
+cache_command.register(BlockingExecuteCommand(name="stats", execute_command=get_output_cache_stats))
+cache_command.register(BlockingExecuteCommand(name="clear", execute_command=clear_output_cache))
+root_command.register(cache_command)
 
 import stockbot.command.quote
 import stockbot.command.ibindex
@@ -1,4 +1,4 @@
-from . import root_command, Command, BlockingExecuteCommand
+from . import root_command, Command, BlockingExecuteCommand, ErrorReply
 from ..service.reddit import RedditFreeGamesService
 from ..db import Session
 from ..configuration import configuration
@@ -22,7 +22,7 @@ def get_latest_free_games_reddit(*args, **kwargs):
         return response
     except Exception as e:
         LOGGER.exception("failed to get free reddit games", e)
-        return "Something broke"
+        return ErrorReply("Something broke")
 
 
 game_command = Command(name="game", short_name="g")
@@ -1,4 +1,5 @@
-from . import root_command, Command, BlockingExecuteCommand
+from . import root_command, Command, BlockingExecuteCommand, ErrorReply
+from stockbot.provider.ibindex import IbIndexNonExistingQuote
 import logging
 
 LOGGER = logging.getLogger(__name__)
@@ -14,7 +15,7 @@ def search(*args, **kwargs):
         return search_result.result_as_list()
     except Exception as e:
         LOGGER.exception("failed to query service")
-        return "Broken because of: {}".format(e)
+        return ErrorReply("Broken because of: {}".format(e))
 
 
 def get(*args, **kwargs):
@@ -25,16 +26,19 @@ def get(*args, **kwargs):
     try:
         search_result = service.search(search_text)
         ticker = search_result.get_ranked_ticker()
+        if ticker is None:
+            return IbIndexNonExistingQuote(search_text)
         quote_result = service.get_quote(ticker)
         return quote_result
     except Exception as e:
         LOGGER.exception("failed to query service")
-        return "Broken because of: {}".format(e)
+        return ErrorReply("Broken because of: {}".format(e))
 
 
 ibindex_command = Command(name="ibindex")
 ibindex_command.register(BlockingExecuteCommand(name="search", execute_command=search, help="<text>",
-                                                expected_num_args=1))
-ibindex_command.register(BlockingExecuteCommand(name="get", execute_command=get, help="<text>", expected_num_args=1))
+                                                expected_num_args=1, cache_ttl=60))
+ibindex_command.register(BlockingExecuteCommand(name="get", execute_command=get, help="<text>", expected_num_args=1,
+                                                cache_ttl=60))
 
 root_command.register(ibindex_command)
@@ -1,11 +1,11 @@
 from . import root_command, Command, BlockingExecuteCommand
 from lxml import html
+from stockbot import http
 from stockbot.db import Base, Session
 from sqlalchemy import Column, String, DateTime
 import datetime
 import hashlib
 import logging
-import requests
 
 LOGGER = logging.getLogger(__name__)
 
@@ -54,7 +54,7 @@ class NewsArticle(object):
 
 
 def get_articles(matches=(), sender=None):
-    req = requests.get("https://www.avanza.se/placera/telegram.plc.html")
+    req = http.get("https://www.avanza.se/placera/telegram.plc.html", endpoint="telegram")
     req.raise_for_status()
     tree = html.fromstring(req.content)
     items = tree.xpath('//ul[@class="feedArticleList XSText"]/li[@class="item"]/a')
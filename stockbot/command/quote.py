@@ -1,7 +1,10 @@
-from . import root_command, Command, BlockingExecuteCommand, ProxyCommand
+from . import root_command, Command, BlockingExecuteCommand, ErrorReply, ProxyCommand, output_cache
+from stockbot.configuration import configuration
 from stockbot.db import Session
 from stockbot.provider import ProviderHints
 from sqlalchemy import and_
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 import logging
 
 LOGGER = logging.getLogger(__name__)
@@ -35,7 +38,18 @@ def get_quote(*args, **kwargs):
         return service.get_quote(ticker)
     except ValueError as e:
         LOGGER.exception("failed to retrieve service for provider '{}'".format(provider))
-        return "No such provider '{}'".format(provider)
+        return ErrorReply("No such provider '{}'".format(provider))
+
+
+def get_quotes(*args, **kwargs):
+    provider = args[0]
+    try:
+        service = kwargs.get('service_factory').get_service(provider)
+        tickers = [ticker_hint(provider, x) for x in args[1:]]
+        return service.get_quotes(tickers)
+    except ValueError as e:
+        LOGGER.exception("failed to retrieve service for provider '{}'".format(provider))
+        return ErrorReply("No such provider '{}'".format(provider))
 
 
 def get_fresh_quote(*args, **kwargs):
@@ -43,33 +57,54 @@ def get_fresh_quote(*args, **kwargs):
     ticker = " ".join(args[1:])
     try:
         service = kwargs.get('service_factory').get_service(provider)
-        ticker = service.get_quote(ticker)
+        ticker = service.get_quote(ticker, use_cache=False)
         return ticker if ticker.is_fresh() else None
     except ValueError as e:
         LOGGER.exception("failed to retrieve service for provider '{}'".format(provider))
-        return "No such provider '{}'".format(provider)
+        return ErrorReply("No such provider '{}'".format(provider))
 
 
 def get_quote_lucky(*args, **kwargs):
     """ some evil branching here, just want to get it to work though """
     provider = args[0]
-    ticker = " ".join(args[1:])
+    tickers = [x.strip() for x in " ".join(args[1:]).split(",") if len(x.strip()) > 0]
     try:
         service = kwargs.get('service_factory').get_service(provider)
-        response = service.get_quote(ticker)
-        LOGGER.debug("Response from service get_quote: {}".format(str(response)))
-        if response.is_empty():
-            search_result = service.search(ticker)
-            if search_result.is_empty():
-                return "Nothing found for {}".format(ticker)
-            else:
-                first_ticker = [x for x in search_result.get_tickers() if x is not None][0]
-                return service.get_quote(first_ticker)
-        else:
-            return response
+        if len(tickers) > 1:
+            return get_quotes_lucky(service, tickers[:configuration.quote_max_tickers])
+        return lucky_quote(service, " ".join(tickers))
     except ValueError as e:
         LOGGER.exception("failed to retrieve service for provider '{}'".format(provider))
-        return "No such provider '{}'".format(provider)
+        return ErrorReply("No such provider '{}'".format(provider))
+
+
+def lucky_quote(service, ticker):
+    response = service.get_quote(ticker)
+    LOGGER.debug("Response from service get_quote: {}".format(str(response)))
+    if response.is_empty():
+        search_result = service.search(ticker)
+        if search_result.is_empty():
+            return "Nothing found for {}".format(ticker)
+        else:
+            first_ticker = [x for x in search_result.get_tickers() if x is not None][0]
+            return service.get_quote(first_ticker)
+    else:
+        return response
+
+
+def get_quotes_lucky(service, tickers):
+    """ look up the tickers concurrently, the result is in the same order as the tickers """
+    def lookup(ticker):
+        try:
+            return lucky_quote(service, ticker)
+        except Exception as e:
+            LOGGER.exception("failed to get quote for '{}'".format(ticker))
+            return ErrorReply("Failed to get quote for {}: {}".format(ticker, e))
+
+    with ThreadPoolExecutor(max_workers=min(len(tickers), configuration.quote_fanout)) as pool:
+        # every lookup runs in a copy of the caller's context so it keeps the command deadline
+        futures = [pool.submit(contextvars.copy_context().run, lookup, x) for x in tickers]
+        return [x.result() for x in futures]
 
 
 def get_quote_quick(*args, **kwargs):
@@ -85,11 +120,30 @@ def search_quote(*args, **kwargs):
         service = kwargs.get('service_factory').get_service(provider)
         search_result = service.search(ticker)
         if search_result is None:
-            return "Response from provider '{}' broken".format(provider)
+            return ErrorReply("Response from provider '{}' broken".format(provider))
         return search_result.result_as_list()
     except ValueError as e:
         LOGGER.exception("failed to retrieve service for provider '{}'".format(provider))
-        return "No such provider '{}'".format(provider)
+        return ErrorReply("No such provider '{}'".format(provider))
+
+
+def provider_stats(*args, **kwargs):
+    provider = args[0]
+    try:
+        service = kwargs.get('service_factory').get_service(provider)
+        result = service.stats()
+        if len(result) > 0:
+            return result
+        return "No stats for provider '{}'".format(provider)
+    except ValueError as e:
+        LOGGER.exception("failed to retrieve service for provider '{}'".format(provider))
+        return ErrorReply("No such provider '{}'".format(provider))
+
+
+def invalidate_hinted_quotes():
+    # cached quotes may have been looked up without the hint, or with the one that was removed
+    for command in hinted_commands:
+        output_cache.invalidate(command.path())
 
 
 def add_quote_hint(*args, **kwargs):
@@ -101,6 +155,7 @@ def add_quote_hint(*args, **kwargs):
         hint = ProviderHints(provider=provider, src=src_text, dst=dst_ticker)
         session.add(hint)
         session.commit()
+        invalidate_hinted_quotes()
         return "Added hint"
     except Exception as e:
         LOGGER.exception("failed to add hint")
@@ -121,7 +176,7 @@ def list_quote_hint(*args, **kwargs):
             return "no hints found"
     except Exception as e:
         LOGGER.exception("failed to list hints")
-        return "broken"
+        return ErrorReply("broken")
     finally:
         session.close()
 
@@ -135,6 +190,7 @@ def remove_quote_hint(*args, **kwargs):
         if hint:
             session.delete(hint)
             session.commit()
+            invalidate_hinted_quotes()
             return "Removed hint"
         else:
             return "No matching hint to remove"
@@ -153,19 +209,31 @@ hint_command.register(BlockingExecuteCommand(name="list", execute_command=list_q
                                              help="<provider>", expected_num_args=1))
 
 
+# commands that look tickers up through the hints
+hinted_commands = [
+    BlockingExecuteCommand(name="get", execute_command=get_quote, help="<provider> <ticker>", expected_num_args=2,
+                           cache_ttl=30),
+    BlockingExecuteCommand(name="multi", execute_command=get_quotes, help="<provider> <ticker> [<ticker> ...]",
+                           expected_num_args=2, cache_ttl=30),
+]
+
 quote_command = Command(name="quote", short_name="q")
-quote_command.register(BlockingExecuteCommand(name="get", execute_command=get_quote, help="<provider> <ticker>",
-                                              expected_num_args=2))
+for command in hinted_commands:
+    quote_command.register(command)
 quote_command.register(BlockingExecuteCommand(name="get_fresh", execute_command=get_fresh_quote,
                                               help="<provider> <ticker>", expected_num_args=2))
 quote_command.register(BlockingExecuteCommand(name="gl", execute_command=get_quote_lucky,
-                                              help="<provider> <ticker>", expected_num_args=2))
+                                              help="<provider> <ticker>[, <ticker> ...]", expected_num_args=2,
+                                              cache_ttl=30))
 quote_command.register(BlockingExecuteCommand(name="search", execute_command=search_quote,
-                                              help="<provider> <ticker>", expected_num_args=2))
+                                              help="<provider> <ticker>", expected_num_args=2, cache_ttl=300))
+quote_command.register(BlockingExecuteCommand(name="stats", execute_command=provider_stats, help="<provider>",
+                                              expected_num_args=1))
 quote_command.register(hint_command)
 
 root_command.register(quote_command)
 root_command.register(BlockingExecuteCommand(name="quick", short_name="qq", execute_command=get_quote_quick,
-                                             help="<search-ticker-string>", expected_num_args=1))
+                                             help="<search-ticker-string>[, <search-ticker-string> ...]",
+                                             expected_num_args=1, cache_ttl=30))
 root_command.register(ProxyCommand(name="qy", proxy_command=("quote", "get", "yahoo"), help="<ticker>",
                                    expected_num_args=1))
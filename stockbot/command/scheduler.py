@@ -1,5 +1,8 @@
 from . import root_command, Command, BlockingExecuteCommand
 import logging
+from datetime import datetime
+
+from stockbot.scheduler import JobStatus
 
 LOGGER = logging.getLogger(__name__)
 
@@ -45,6 +48,27 @@ def set_scheduler_interval(*args, **kwargs):
         return "Can't set interval from garbage input, must be of an int"
 
 
+def get_scheduler_status(*args, **kwargs):
+    def ms(value):
+        return "{:.0f}".format(value * 1000) if value is not None else "N/A"
+
+    bot = kwargs.get('instance')
+    jobs = bot.job_scheduler.get_jobs()
+    if len(jobs) == 0:
+        return "No jobs scheduled"
+    result = []
+    for job in jobs:
+        status = bot.job_runner.get_status(job.name)
+        if status is None:
+            status = JobStatus()
+        result.append("Job: {}, Next run: {}, Overlap: {}, Running: {}, Runs: {}, Skipped: {}, Last ms: {}, "
+                      "Last error: {}".format(
+                          job.name, datetime.fromtimestamp(job.scheduled_at).strftime("%Y-%m-%d %H:%M:%S"),
+                          job.overlap, status.running, status.runs, status.skipped, ms(status.last_duration),
+                          status.last_error or "None"))
+    return result
+
+
 def enable_scheduler(*args, **kwargs):
     bot = kwargs.get('instance')
     bot.scheduler = True
@@ -60,6 +84,8 @@ def disable_scheduler(*args, **kwargs):
 scheduler_command = Command(name="scheduler")
 scheduler_command.register(BlockingExecuteCommand(name="enable", execute_command=enable_scheduler))
 scheduler_command.register(BlockingExecuteCommand(name="disable", execute_command=disable_scheduler))
+scheduler_command.register(BlockingExecuteCommand(name="status", execute_command=get_scheduler_status,
+                                                  help="next run, last duration and last error per job"))
 
 scheduler_command_command = Command(name="command")
 scheduler_command_command.register(BlockingExecuteCommand(name="get", execute_command=get_scheduler_command))
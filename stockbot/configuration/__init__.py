@@ -8,31 +8,165 @@ DEFAULT_VALUES = {
     "die_when_not_pinged": "false",
     "die_when_not_pinged_in_s": "600",
     "game_ignore_list": "",
-    "should_colorify": "true"
+    "should_colorify": "true",
+    "ibindex_cache_ttl_s": "300",
+    "ibindex_cache_max_stale_s": "3600",
+    "yahoo_session_pool_size": "4",
+    "yahoo_session_idle_timeout_s": "300",
+    "yahoo_crumb_max_age_s": "86400",
+    "yahoo_search_cache_size": "1000",
+    "yahoo_search_cache_ttl_s": "86400",
+    "yahoo_search_cache_empty_ttl_s": "300",
+    "quote_cache_size": "1000",
+    "quote_cache_ttl_open_s": "15",
+    "quote_cache_ttl_closed_s": "900",
+    "quote_cache_ttl_closed_max_s": "86400",
+    "flood_rate_per_s": "1",
+    "flood_burst": "4",
+    "flood_max_queue_size": "100",
+    "reactor_tick_interval_s": "0.2",
+    "command_workers": "4",
+    "command_queue_size": "50",
+    "command_timeout_s": "30",
+    "task_workers": "2",
+    "task_queue_size": "10",
+    "job_workers": "2",
+    "job_queue_size": "10",
+    "command_cache_size": "500",
+    "quote_fanout": "4",
+    "quote_max_tickers": "10",
+    "metrics_file": "",
+    "http_timeout_s": "10",
+    "circuit_failure_threshold": "5",
+    "circuit_slow_call_s": "10",
+    "circuit_reset_timeout_s": "30",
+    "stale_quote_cache_size": "1000",
+    "stale_quote_max_age_s": "86400",
+    "upstream_max_concurrent": "4",
+    "upstream_rate_per_s": "5",
+    "upstream_burst": "10",
+    "upstream_retry_after_s": "5",
+    "metrics_export_interval_s": "15"
 }
 
 
-class Configuration(object):
+# how the known settings are parsed, the rest are strings, or booleans and lists going by their value and name
+TYPES = {
+    "server_port": int,
+    "scheduler": bool,
+    "server_use_ssl": bool,
+    "die_when_not_pinged": bool,
+    "die_when_not_pinged_in_s": int,
+    "game_ignore_list": list,
+    "should_colorify": bool,
+    "ibindex_cache_ttl_s": int,
+    "ibindex_cache_max_stale_s": int,
+    "yahoo_session_pool_size": int,
+    "yahoo_session_idle_timeout_s": int,
+    "yahoo_crumb_max_age_s": int,
+    "yahoo_search_cache_size": int,
+    "yahoo_search_cache_ttl_s": int,
+    "yahoo_search_cache_empty_ttl_s": int,
+    "quote_cache_size": int,
+    "quote_cache_ttl_open_s": int,
+    "quote_cache_ttl_closed_s": int,
+    "quote_cache_ttl_closed_max_s": int,
+    "flood_rate_per_s": float,
+    "flood_burst": int,
+    "flood_max_queue_size": int,
+    "reactor_tick_interval_s": float,
+    "command_workers": int,
+    "command_queue_size": int,
+    "command_timeout_s": float,
+    "task_workers": int,
+    "task_queue_size": int,
+    "job_workers": int,
+    "job_queue_size": int,
+    "command_cache_size": int,
+    "quote_fanout": int,
+    "quote_max_tickers": int,
+    "http_timeout_s": float,
+    "circuit_failure_threshold": int,
+    "circuit_slow_call_s": float,
+    "circuit_reset_timeout_s": float,
+    "stale_quote_cache_size": int,
+    "stale_quote_max_age_s": int,
+    "upstream_max_concurrent": int,
+    "upstream_rate_per_s": float,
+    "upstream_burst": int,
+    "upstream_retry_after_s": float,
+    "metrics_export_interval_s": float,
+}
+
+
+def parse(item, value, value_type=None):
+    if value_type is list or (value_type is None and item.endswith("_list")):
+        return value.split(",") if value else []
+    if value_type is bool or (value_type is None and value.lower() in ["true", "false"]):
+        return value.lower() == "true"
+    if value_type is not None:
+        try:
+            return value_type(value)
+        except ValueError:
+            raise RuntimeError("Environment variable {} must be of type {}, not '{}'".format(
+                item.upper(), value_type.__name__, value))
+    return value
+
+
+def read_config_file(path):
+    """ KEY=value lines, empty lines and lines starting with # are skipped """
+    values = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#") and "=" in line:
+                key, value = line.split("=", 1)
+                values[key.strip().upper()] = value.strip()
+    return values
+
+
+class ConfigurationSnapshot(object):
+    """
+    Every known setting parsed once from the environment, overlaid with CONFIG_FILE when it is set. Settings are
+    plain attributes, so reading them is as cheap as any attribute. Unknown settings are looked up in the captured
+    environment when asked for. A snapshot never changes, a reload builds a new one.
+    """
+
+    def __init__(self, environ):
+        environ = dict(environ)
+        if environ.get("CONFIG_FILE"):
+            environ.update(read_config_file(environ["CONFIG_FILE"]))
+        values = {k: parse(k, environ.get(k.upper(), v), TYPES.get(k)) for k, v in DEFAULT_VALUES.items()}
+        values["environ"] = environ
+        self.__dict__.update(values)
 
     def __getattr__(self, item: str):
-        value = os.getenv(item.upper(), self.default_wrapper(item))
+        if item.startswith("__"):
+            raise AttributeError(item)
+        value = self.environ.get(item.upper(), DEFAULT_VALUES.get(item))
         if value is None:
             raise RuntimeError("Must set environment variable {}".format(item.upper()))
-        else:
-            if item.endswith("_list"):
-                if not value:
-                    return []
-                else:
-                    return value.split(",")
-            if value.lower() in ["true", "false"]:
-                return value.lower() == "true"
-            return value
-
-    @staticmethod
-    def default_wrapper(item):
-        if item in DEFAULT_VALUES:
-            return DEFAULT_VALUES[item]
-        return None
+        return parse(item, value, TYPES.get(item))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("configuration snapshots are read only")
+
+
+class Configuration(object):
+    """ the current ConfigurationSnapshot, reload() swaps in a new one in a single assignment """
+
+    def __init__(self, environ=None):
+        self.snapshot = ConfigurationSnapshot(os.environ if environ is None else environ)
+
+    def __getattr__(self, item: str):
+        if item.startswith("__") or item == "snapshot":
+            raise AttributeError(item)
+        return getattr(self.snapshot, item)
+
+    def reload(self, environ=None):
+        """ parse the environment and config file again, keeps the current snapshot if that fails """
+        self.snapshot = ConfigurationSnapshot(os.environ if environ is None else environ)
+        return self.snapshot
 
 
 configuration = Configuration()
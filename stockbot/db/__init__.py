@@ -1,7 +1,8 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from stockbot import deadline
 from stockbot.configuration import Configuration
 
 Base = declarative_base()
@@ -10,6 +11,12 @@ engine = create_engine(Configuration().database_url)
 Session = sessionmaker(bind=engine)
 
 
+@event.listens_for(engine, "before_cursor_execute")
+def check_deadline(*args, **kwargs):
+    # don't start statements for a command that already ran out of time
+    deadline.check()
+
+
 def create_tables():
     Base.metadata.create_all(engine)
 
@@ -0,0 +1,60 @@
+import contextlib
+import contextvars
+import time
+
+
+class DeadlineExceeded(Exception):
+    """ the command ran out of time, raised by IO that checks the deadline before it starts """
+
+
+# monotonic time the current command has to be done by, None when there is no deadline
+current = contextvars.ContextVar("deadline", default=None)
+# threading.Event set when the work in the current context is called off, it then counts as past its deadline
+cancelled = contextvars.ContextVar("cancelled", default=None)
+
+
+@contextlib.contextmanager
+def within(seconds):
+    """ run the block with a deadline `seconds` from now, an earlier deadline that is already set is kept """
+    at = time.monotonic() + seconds
+    outer = current.get()
+    token = current.set(at if outer is None else min(outer, at))
+    try:
+        yield
+    finally:
+        current.reset(token)
+
+
+@contextlib.contextmanager
+def cancellable(event):
+    """ run the block so that setting the event makes it stop at its next deadline check """
+    token = cancelled.set(event)
+    try:
+        yield
+    finally:
+        cancelled.reset(token)
+
+
+def remaining():
+    event = cancelled.get()
+    if event is not None and event.is_set():
+        return 0.0
+    at = current.get()
+    return None if at is None else at - time.monotonic()
+
+
+def expired():
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def check():
+    if expired():
+        raise DeadlineExceeded()
+
+
+def timeout(default):
+    """ seconds an IO call may take, the default capped by what is left of the deadline """
+    check()
+    left = remaining()
+    return default if left is None else min(default, left)
@@ -0,0 +1,193 @@
+import contextvars
+import logging
+import queue
+import threading
+import time
+import types
+
+from stockbot.deadline import DeadlineExceeded
+
+LOGGER = logging.getLogger(__name__)
+
+
+class WorkerPool(object):
+    """
+    Fixed number of daemon worker threads fed from a bounded queue, threads are started on first use.
+
+    Named tasks are tracked in an in-flight registry from submit until they finish, which is what makes exclusive
+    submission atomic. Tasks run in a copy of the submitter's context, so they keep its command deadline.
+    """
+
+    # what submit_named does when every worker is busy: put the task on the queue, or turn it away
+    QUEUE = "queue"
+    REJECT = "reject"
+
+    STARTED = "started"
+    RUNNING = "running"
+    REJECTED = "rejected"
+
+    def __init__(self, *args, **kwargs):
+        self.name = kwargs.get('name', 'worker')
+        self.max_workers = kwargs.get('max_workers', 4)
+        self.queue = queue.Queue(maxsize=kwargs.get('max_queue_size', 50))
+        self.lock = threading.Lock()
+        self.threads = []
+        self.active = 0
+        self.in_flight = set()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        :return: False if the queue is full and the task was rejected
+        """
+        self._start()
+        try:
+            self.queue.put_nowait((contextvars.copy_context().run, (func,) + args, kwargs))
+            return True
+        except queue.Full:
+            LOGGER.warning("{} pool queue is full, rejecting task".format(self.name))
+            return False
+
+    def submit_named(self, task_name, func, *args, exclusive=True, policy=QUEUE, **kwargs):
+        """
+        :return: STARTED if the task was accepted, RUNNING if an exclusive task with that name is already in flight
+                 and REJECTED if the pool is saturated
+        """
+        with self.lock:
+            if exclusive and task_name in self.in_flight:
+                return self.RUNNING
+            if policy == self.REJECT and self.active + self.queue.qsize() >= self.max_workers:
+                return self.REJECTED
+            self.in_flight.add(task_name)
+        if not self.submit(self._run_named, task_name, func, *args, **kwargs):
+            with self.lock:
+                self.in_flight.discard(task_name)
+            return self.REJECTED
+        return self.STARTED
+
+    def _run_named(self, task_name, func, *args, **kwargs):
+        try:
+            func(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.in_flight.discard(task_name)
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def in_flight_tasks(self):
+        with self.lock:
+            return sorted(self.in_flight)
+
+    def active_workers(self):
+        with self.lock:
+            return self.active
+
+    def _start(self):
+        with self.lock:
+            while len(self.threads) < self.max_workers:
+                thread = threading.Thread(name="{}-{}".format(self.name, len(self.threads)), target=self._work,
+                                          daemon=True)
+                self.threads.append(thread)
+                thread.start()
+
+    def _work(self):
+        while True:
+            func, args, kwargs = self.queue.get()
+            with self.lock:
+                self.active += 1
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                LOGGER.exception("task failed in {} pool".format(self.name))
+            finally:
+                with self.lock:
+                    self.active -= 1
+                self.queue.task_done()
+
+
+class PendingCommand(object):
+
+    def __init__(self, callback, callback_args, deadline):
+        self.callback = callback
+        self.callback_args = callback_args
+        self.deadline = deadline
+        self.timed_out = False
+
+
+class CommandExecutor(object):
+    """
+    Runs commands in a WorkerPool and hands the results back to the reactor thread.
+
+    Workers never call the callbacks themselves, they put the result on a queue which the reactor empties through
+    run_pending_callbacks. That is also where commands running past their timeout get a "timed out" reply, whatever
+    they return later is thrown away.
+    """
+
+    busy_message = "Too busy right now, try again in a bit"
+    timeout_message = "Timed out, try again later"
+
+    def __init__(self, *args, **kwargs):
+        self.pool = WorkerPool(name="command", max_workers=kwargs.get('max_workers', 4),
+                               max_queue_size=kwargs.get('max_queue_size', 50))
+        self.timeout = kwargs.get('timeout', 30)
+        self.clock = kwargs.get('clock', time.monotonic)
+        self.completed = queue.SimpleQueue()
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def submit(self, func, args, kwargs, callback, callback_args, timeout=None):
+        task = PendingCommand(callback, callback_args, self.clock() + (timeout or self.timeout))
+        with self.lock:
+            self.pending.add(task)
+        if not self.pool.submit(self._run, task, func, args, kwargs):
+            with self.lock:
+                self.pending.discard(task)
+            return callback(self.busy_message, **callback_args)
+
+    def _run(self, task, func, args, kwargs):
+        try:
+            result = func(*args, **kwargs)
+            # generators are lazy, consume them here so their IO doesn't end up on the reactor thread
+            if isinstance(result, types.GeneratorType):
+                result = list(result)
+        except DeadlineExceeded:
+            LOGGER.info("command ran past its deadline")
+            result = self.timeout_message
+        except Exception:
+            LOGGER.exception("command failed")
+            result = "something failed"
+        self.completed.put((task, result))
+
+    def run_pending_callbacks(self):
+        """ invoke callbacks of finished and timed out commands, must be called from the reactor thread """
+        while True:
+            try:
+                task, result = self.completed.get_nowait()
+            except queue.Empty:
+                break
+            with self.lock:
+                self.pending.discard(task)
+            if task.timed_out:
+                LOGGER.info("dropping result of timed out command")
+                continue
+            self._invoke(task, result)
+        now = self.clock()
+        with self.lock:
+            expired = [x for x in self.pending if not x.timed_out and x.deadline < now]
+        for task in expired:
+            task.timed_out = True
+            self._invoke(task, self.timeout_message)
+
+    @staticmethod
+    def _invoke(task, result):
+        try:
+            task.callback(result, **task.callback_args)
+        except Exception:
+            LOGGER.exception("command callback failed")
+
+    def queue_depth(self):
+        return self.pool.queue_depth()
+
+    def in_flight(self):
+        with self.lock:
+            return len(self.pending)
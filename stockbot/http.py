@@ -0,0 +1,120 @@
+import email.utils
+import logging
+import time
+import urllib.parse
+from datetime import datetime, timezone
+
+import requests
+
+from stockbot import deadline
+from stockbot.configuration import configuration
+from stockbot.metrics import registry
+
+LOGGER = logging.getLogger(__name__)
+
+
+def labels_for(url, endpoint=None):
+    parts = urllib.parse.urlsplit(url)
+    return {"host": parts.hostname, "endpoint": endpoint or parts.path}
+
+
+def retry_after(response, default):
+    """ seconds the Retry-After header of a response asks for, it is either seconds or an HTTP date """
+    value = response.headers.get("Retry-After")
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, (email.utils.parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+
+def request(method, url, endpoint=None, session=None, limiter=None, **kwargs):
+    """
+    Do an upstream HTTP request and record latency, response bytes and status code per host and endpoint
+
+    :param method:
+    :param url:
+    :param endpoint: name to record the request under, defaults to the url path which may contain ids
+    :param session: anything with a requests style request method, like a requests or curl_cffi session, defaults
+                    to the requests module
+    :param limiter: UpstreamLimiter the request waits for within the command deadline, a 429 makes it back off
+    :param kwargs: passed on to the request, the timeout defaults to http_timeout_s capped by the command deadline
+    :return: the response
+    :raises DeadlineExceeded: if the command deadline passed before or during the request
+    """
+    client = session if session is not None else requests
+    labels = labels_for(url, endpoint)
+    if limiter is not None and not limiter.acquire(deadline.remaining()):
+        registry.inc("stockbot_http_errors_total", {**labels, "error": "DeadlineExceeded"})
+        raise deadline.DeadlineExceeded()
+    started = time.monotonic()
+    try:
+        kwargs.setdefault("timeout", deadline.timeout(configuration.http_timeout_s))
+        response = client.request(method, url, **kwargs)
+    except Exception as e:
+        registry.inc("stockbot_http_errors_total", {**labels, "error": type(e).__name__})
+        if deadline.expired():
+            raise deadline.DeadlineExceeded() from e
+        raise
+    finally:
+        registry.observe("stockbot_http_duration_seconds", labels, time.monotonic() - started)
+        if limiter is not None:
+            limiter.release()
+    if response.status_code == 429 and limiter is not None:
+        seconds = retry_after(response, configuration.upstream_retry_after_s)
+        LOGGER.warning("{} is throttling us, backing off for {:.0f}s".format(labels["host"], seconds))
+        limiter.back_off(seconds)
+    registry.inc("stockbot_http_responses_total", {**labels, "status": str(response.status_code)})
+    registry.inc("stockbot_http_response_bytes_total", labels, len(response.content))
+    return response
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def record_retry(url, endpoint=None, reason=None):
+    registry.inc("stockbot_http_retries_total", {**labels_for(url, endpoint), "reason": reason or "unknown"})
+
+
+def record_credentials_refresh(provider):
+    registry.inc("stockbot_http_credentials_refreshes_total", {"provider": provider})
+
+
+def result_as_list(hosts=None):
+    """ one row per host and endpoint that has been requested, only for the given hosts when there are any """
+    def ms(value):
+        return "{:.0f}".format(value * 1000) if value is not None else "N/A"
+
+    result = []
+    for host in registry.label_values("stockbot_http_duration_seconds", "host"):
+        if hosts is not None and host not in hosts:
+            continue
+        for endpoint in registry.label_values("stockbot_http_duration_seconds", "endpoint"):
+            labels = {"host": host, "endpoint": endpoint}
+            histogram = registry.histogram("stockbot_http_duration_seconds", labels)
+            if histogram is None:
+                continue
+            p50, p95 = registry.percentiles("stockbot_http_duration_seconds", labels, (50, 95))
+            statuses = ["{}x{}".format(status, registry.counter("stockbot_http_responses_total",
+                                                                 {**labels, "status": status}))
+                        for status in registry.label_values("stockbot_http_responses_total", "status")
+                        if registry.counter("stockbot_http_responses_total", {**labels, "status": status}) > 0]
+            retries = sum(registry.counter("stockbot_http_retries_total", {**labels, "reason": reason})
+                          for reason in registry.label_values("stockbot_http_retries_total", "reason"))
+            errors = sum(registry.counter("stockbot_http_errors_total", {**labels, "error": error})
+                         for error in registry.label_values("stockbot_http_errors_total", "error"))
+            result.append("Upstream: {}{}, Requests: {}, Statuses: {}, Errors: {}, Retries: {}, Bytes: {}, "
+                          "p50 ms: {}, p95 ms: {}".format(
+                            host, endpoint if endpoint.startswith("/") else " " + endpoint, histogram.count,
+                            " ".join(statuses) or "none", errors, retries,
+                            registry.counter("stockbot_http_response_bytes_total", labels),
+                            ms(p50), ms(p95)))
+    return result
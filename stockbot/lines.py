@@ -0,0 +1,100 @@
+from stockbot import render
+from stockbot.util import colorify
+
+# between rows packed into the same line
+ROW_SEPARATOR = " | "
+
+
+def byte_budget(command, target):
+    """ bytes left for the text of a message to target, irc.client raises MessageTooLong above 512 including CR/LF """
+    return 512 - len("{} {} :\r\n".format(command, target).encode("utf-8"))
+
+
+def utf8_len(text):
+    return len(text.encode("utf-8"))
+
+
+def cut(text, size):
+    """ the longest prefix of text that is at most size bytes in UTF-8, without splitting a character """
+    return text.encode("utf-8")[:size].decode("utf-8", errors="ignore")
+
+
+def split(items, render_items, plain_items, budget):
+    """
+    Group consecutive items into as few lines as possible where every rendered line fits the budget. An item that
+    doesn't fit on its own is cut, from its plain rendering so no color code is cut in half.
+
+    :param items: fields or sections of a row
+    :param render_items: renders a list of items into a line
+    :param plain_items: renders a list of items into a line without colors
+    :param budget: max bytes per line
+    :return: lines
+    """
+    line = render_items(items)
+    if utf8_len(line) <= budget:
+        return [line]
+    lines = []
+    group = []
+    line = None
+    for item in items:
+        candidate = render_items(group + [item])
+        if utf8_len(candidate) <= budget:
+            group.append(item)
+            line = candidate
+            continue
+        if len(group) > 0:
+            lines.append(line)
+        group = [item]
+        line = render_items(group)
+        if utf8_len(line) > budget:
+            lines.append(cut(plain_items(group), budget))
+            group = []
+            line = None
+    if len(group) > 0:
+        lines.append(line)
+    return lines
+
+
+def row_lines(row, budget, colored=True):
+    """ one row rendered into one line, or more when it's too long, split on field or ", " section boundaries """
+    fields = render.fields_of(row)
+    if fields is not None:
+        return split(fields, render.irc if colored else render.plain, render.plain, budget)
+
+    def join(sections):
+        return ", ".join(sections)
+
+    def render_sections(sections):
+        return colorify(join(sections)) if colored else join(sections)
+
+    return split(str(row).split(", "), render_sections, join, budget)
+
+
+def pack(rows, budget, colored=True):
+    """
+    Render rows into as few lines of at most budget bytes as possible, short rows share a line separated by
+    ROW_SEPARATOR and long rows are split over several lines
+
+    :param rows: rows with fields or anything else which is rendered as a string
+    :param budget: max bytes per line, see byte_budget
+    :param colored: render with IRC colors
+    :return: lines
+    """
+    lines = []
+    line = None
+    separator_size = utf8_len(ROW_SEPARATOR)
+    for row in rows:
+        rendered = [x for x in row_lines(row, budget, colored) if x]
+        if len(rendered) == 0:
+            continue
+        if len(rendered) == 1 and line is not None and \
+                utf8_len(line) + separator_size + utf8_len(rendered[0]) <= budget:
+            line = line + ROW_SEPARATOR + rendered[0]
+            continue
+        if line is not None:
+            lines.append(line)
+        lines.extend(rendered[:-1])
+        line = rendered[-1]
+    if line is not None:
+        lines.append(line)
+    return lines
@@ -0,0 +1,216 @@
+import bisect
+import logging
+import math
+import os
+import threading
+import time
+import types
+from collections import deque
+
+from stockbot.deadline import DeadlineExceeded
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    """
+    Cumulative bucket counts for the text export plus a window of the most recent samples, percentiles are
+    calculated from the window so they follow what the bot is doing right now.
+    """
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, window=1000):
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.samples.append(value)
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, p):
+        return self.percentiles([p])[0]
+
+    def percentiles(self, ps):
+        """ not thread safe, MetricsRegistry.percentiles calls it under the registry lock """
+        if len(self.samples) == 0:
+            return [None] * len(ps)
+        # nearest rank
+        ordered = sorted(self.samples)
+        return [ordered[max(0, math.ceil(p / 100.0 * len(ordered)) - 1)] for p in ps]
+
+    def cumulative_buckets(self):
+        total = 0
+        for le, count in zip([str(x) for x in self.buckets] + ["+Inf"], self.bucket_counts):
+            total += count
+            yield le, total
+
+
+class MetricsRegistry(object):
+    """
+    Process wide counters, gauges and histograms, identified by name and a dict of labels.
+
+    Collectors are callables returning (name, labels, value) samples, they are called on export for values that are
+    owned by someone else, like queue depths.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, value=1):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_gauge(self, name, labels=None, value=1):
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def set_gauge(self, name, labels=None, value=0):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, labels=None, value=0.0):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def counter(self, name, labels=None):
+        with self.lock:
+            return self.counters.get(self._key(name, labels), 0)
+
+    def gauge(self, name, labels=None):
+        with self.lock:
+            return self.gauges.get(self._key(name, labels), 0)
+
+    def histogram(self, name, labels=None):
+        """ the histogram itself, only its count may be read without the lock, see percentiles """
+        with self.lock:
+            return self.histograms.get(self._key(name, labels))
+
+    def percentiles(self, name, labels=None, ps=(50, 95, 99)):
+        """ percentiles of the histogram's recent samples, taken under the lock while workers keep observing """
+        with self.lock:
+            histogram = self.histograms.get(self._key(name, labels))
+            return [None] * len(ps) if histogram is None else histogram.percentiles(ps)
+
+    def label_values(self, name, label):
+        """ every value the label has been given for the metric name """
+        with self.lock:
+            keys = list(self.counters) + list(self.gauges) + list(self.histograms)
+        return sorted(set(dict(labels)[label] for n, labels in keys if n == name and label in dict(labels)))
+
+    def register_collector(self, collector):
+        with self.lock:
+            self.collectors.append(collector)
+
+    def collect(self):
+        with self.lock:
+            collectors = list(self.collectors)
+        samples = []
+        for collector in collectors:
+            try:
+                samples.extend(collector())
+            except Exception:
+                LOGGER.exception("metrics collector failed")
+        return samples
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def export_text(self):
+        """ everything in the prometheus text exposition format """
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted(self.histograms.items())
+            histogram_values = {k: (list(v.cumulative_buckets()), v.sum, v.count) for k, v in histograms}
+        collected = sorted((self._key(name, labels), value) for name, labels, value in self.collect())
+        typed = [("counter", counters), ("gauge", gauges),
+                 ("counter", [x for x in collected if x[0][0].endswith("_total")]),
+                 ("gauge", [x for x in collected if not x[0][0].endswith("_total")])]
+        seen = set()
+        for metric_type, samples in typed:
+            for (name, labels), value in samples:
+                if name not in seen:
+                    seen.add(name)
+                    lines.append("# TYPE {} {}".format(name, metric_type))
+                lines.append("{}{} {}".format(name, self._labels(labels), value))
+        for (name, labels), _ in histograms:
+            buckets, total, count = histogram_values[(name, labels)]
+            if name not in seen:
+                seen.add(name)
+                lines.append("# TYPE {} histogram".format(name))
+            for le, cumulative in buckets:
+                lines.append("{}_bucket{} {}".format(name, self._labels(labels + (("le", le),)), cumulative))
+            lines.append("{}_sum{} {}".format(name, self._labels(labels), total))
+            lines.append("{}_count{} {}".format(name, self._labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _labels(labels):
+        if len(labels) == 0:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(
+            k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in labels) + "}"
+
+    def write(self, path):
+        # write and rename so a scraper never reads a half written file
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "w") as f:
+            f.write(self.export_text())
+        os.replace(tmp_path, path)
+
+
+registry = MetricsRegistry()
+
+
+def timed(command, func):
+    """
+    Wrap a command function so every call records latency, count, errors and in flight calls for the command path,
+    generators are consumed inside the measurement so their IO is part of the latency
+
+    :param command: command path used as label
+    :param func:
+    :return:
+    """
+    labels = {"command": command}
+
+    def func_wrapper(*args, **kwargs):
+        registry.add_gauge("stockbot_command_in_flight", labels, 1)
+        started = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+            if isinstance(result, types.GeneratorType):
+                result = list(result)
+            return result
+        except DeadlineExceeded:
+            registry.inc("stockbot_command_timeouts_total", labels)
+            raise
+        except Exception:
+            registry.inc("stockbot_command_errors_total", labels)
+            raise
+        finally:
+            registry.observe("stockbot_command_duration_seconds", labels, time.monotonic() - started)
+            registry.add_gauge("stockbot_command_in_flight", labels, -1)
+    return func_wrapper
@@ -0,0 +1,67 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+from stockbot.ratelimit import TokenBucket
+
+LOGGER = logging.getLogger(__name__)
+
+
+class OutboundQueue(object):
+    """
+    Outgoing IRC messages, one FIFO per target.
+
+    Callbacks put messages on the queue and return right away, the reactor drains it periodically. The server counts
+    every line the connection sends, so a single token bucket paces all targets, which are served round robin so one
+    long reply doesn't starve everyone else.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.bucket = TokenBucket(rate=kwargs.get('rate', 1.0), burst=kwargs.get('burst', 4),
+                                  clock=kwargs.get('clock', time.monotonic))
+        self.max_queue_size = kwargs.get('max_queue_size', 100)
+        self.queues = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, target, msg):
+        with self.lock:
+            queue = self.queues.setdefault(target, deque())
+            if len(queue) >= self.max_queue_size:
+                LOGGER.warning("outbound queue for {} is full, dropping message".format(target))
+                return False
+            queue.append(msg)
+            return True
+
+    def drain(self, send):
+        """
+        Send as many messages as the token bucket allows, meant to be called from the reactor thread
+
+        :param send: callable taking target and message
+        :return: number of messages sent
+        """
+        sent = 0
+        # only the reactor takes messages off the queue, so it can't run empty between the check and _next
+        while len(self) > 0 and self.bucket.try_acquire():
+            target, msg = self._next()
+            try:
+                send(target, msg)
+            except Exception:
+                LOGGER.exception("failed to send message to {}".format(target))
+            sent += 1
+        return sent
+
+    def _next(self):
+        with self.lock:
+            target, queue = next(iter(self.queues.items()))
+            msg = queue.popleft()
+            if len(queue) == 0:
+                del self.queues[target]
+            else:
+                # rotate the target to the back so other targets get their turn
+                self.queues.move_to_end(target)
+            return target, msg
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(x) for x in self.queues.values())
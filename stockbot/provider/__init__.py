@@ -1,4 +1,5 @@
 import logging
+import threading
 from .ibindex import IbIndexQueryService
 from .yahoo import YahooQueryService
 from stockbot.db import Base
@@ -15,16 +16,26 @@ class ProviderHints(Base):
 
 
 class QuoteServiceFactory(object):
+    """ builds every provider at most once, however many threads ask for it at the same time """
 
     providers = {
         "ibindex": IbIndexQueryService,
         "yahoo": YahooQueryService
     }
 
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.services = {}
+
     def get_service(self, name):
-        if not hasattr(self, name):
-            try:
-                setattr(self, name, self.providers[name]())
-            except KeyError as e:
-                raise ValueError("provider '{}' not implemented".format(name))
-        return getattr(self, name)
+        service = self.services.get(name)
+        if service is None:
+            with self.lock:
+                service = self.services.get(name)
+                if service is None:
+                    try:
+                        provider = self.providers[name]
+                    except KeyError as e:
+                        raise ValueError("provider '{}' not implemented".format(name))
+                    service = self.services[name] = provider()
+        return service
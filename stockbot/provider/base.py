@@ -1,16 +1,231 @@
+import copy
+import functools
 import logging
+import threading
+import time
+from collections import Counter
+
+from stockbot import deadline, render
+from stockbot.cache import TTLCache
+from stockbot.circuit import CircuitBreaker
+from stockbot.configuration import configuration
+from stockbot.metrics import registry
+from stockbot.ratelimit import UpstreamLimiter
 
 LOGGER = logging.getLogger(__name__)
 
+# quotes shared by every provider, keyed by (provider, symbol) and kept for as long as the quote itself says
+quote_cache = TTLCache(max_size=configuration.quote_cache_size)
+# last good quote per (provider, ticker) with the time it was fetched, served marked as stale when the provider fails
+last_good_quotes = TTLCache(max_size=configuration.stale_quote_cache_size,
+                            ttl=configuration.stale_quote_max_age_s)
+
+
+class SingleFlight(object):
+    """
+    Concurrent calls with the same key share one execution: the first caller runs it and everyone arriving while it
+    runs waits for it and gets the same result, or a copy of the same exception.
+
+    Followers wait no longer than their own deadline. When the leader ran out of its deadline they don't inherit
+    that, they try again themselves.
+    """
+
+    class Call(object):
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.exception = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        # number of calls that piggybacked on an already running call, per provider
+        self.coalesced = Counter()
+
+    def samples(self):
+        with self.lock:
+            return [("stockbot_coalesced_calls_total", {"provider": k}, v) for k, v in self.coalesced.items()]
+
+    def do(self, key, func, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self.Call()
+            else:
+                self.coalesced[key[0]] += 1
+        if not leader:
+            if not call.done.wait(deadline.remaining()):
+                raise deadline.DeadlineExceeded()
+            if isinstance(call.exception, deadline.DeadlineExceeded):
+                return self.do(key, func, *args, **kwargs)
+            if call.exception is not None:
+                # every follower raises its own exception, raising the leader's from several threads at once would
+                # have them all rewrite its traceback
+                raise self._copy(call.exception) from call.exception
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.exception = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    @staticmethod
+    def _copy(exception):
+        try:
+            return copy.copy(exception)
+        except Exception:
+            return RuntimeError(str(exception))
+
+
+single_flight = SingleFlight()
+
+
+def cache_samples(name, cache):
+    """ samples of a TTLCache for the metrics registry """
+    stats = cache.stats()
+    return [("stockbot_{}_cache_entries".format(name), {}, stats.pop("size"))] + [
+        ("stockbot_{}_cache_{}_total".format(name, k), {}, v) for k, v in stats.items()
+    ]
+
+
+registry.register_collector(lambda: cache_samples("quote", quote_cache) + single_flight.samples())
+
+
+def coalesce(func):
+    """
+    decorator for quote service methods that makes identical concurrent calls share one upstream request
+    :param func:
+    :return:
+    """
+    @functools.wraps(func)
+    def func_wrapper(self, *args, **kwargs):
+        key = (self.name, func.__name__, args, tuple(sorted(kwargs.items())))
+        return single_flight.do(key, func, self, *args, **kwargs)
+    return func_wrapper
+
+
+def circuit_breaker(name):
+    """ circuit breaker for a provider, configured from circuit_* """
+    breaker = CircuitBreaker(name=name, failure_threshold=configuration.circuit_failure_threshold,
+                             slow_call=configuration.circuit_slow_call_s,
+                             reset_timeout=configuration.circuit_reset_timeout_s)
+    registry.register_collector(breaker.samples)
+    return breaker
+
+
+def upstream_limiter(name):
+    """ concurrency and rate limiter for a provider's upstream, configured from upstream_* """
+    limiter = UpstreamLimiter(name=name, max_concurrent=configuration.upstream_max_concurrent,
+                              rate=configuration.upstream_rate_per_s, burst=configuration.upstream_burst)
+    registry.register_collector(limiter.samples)
+    return limiter
+
+
+def guarded(func):
+    """
+    decorator for quote service methods that go upstream, the calls go through the service's circuit breaker
+    :param func:
+    :return:
+    """
+    @functools.wraps(func)
+    def func_wrapper(self, *args, **kwargs):
+        if self.breaker is None:
+            return func(self, *args, **kwargs)
+        return self.breaker.call(func, self, *args, **kwargs)
+    return func_wrapper
+
+
+def serve_stale(func):
+    """
+    decorator for get_quote, remembers the last good quote per ticker and answers with it, marked as stale, when the
+    provider fails or its circuit is open
+    :param func:
+    :return:
+    """
+    @functools.wraps(func)
+    def func_wrapper(self, ticker, *args, **kwargs):
+        try:
+            quote = func(self, ticker, *args, **kwargs)
+        except Exception:
+            last_good = last_good_quotes.get((self.name, ticker))
+            if last_good is None:
+                raise
+            LOGGER.warning("{} failed, serving stale quote for {}".format(self.name, ticker))
+            registry.inc("stockbot_stale_quotes_total", {"provider": self.name})
+            return StaleQuote(*last_good)
+        if self.quote_type is not None and isinstance(quote, self.quote_type):
+            last_good_quotes.set((self.name, ticker), (quote, time.time()))
+        return quote
+    return func_wrapper
+
 
 class BaseQuoteService(object):
 
-    def get_quote(self, ticker):
+    name = None
+    # CircuitBreaker guarding the upstream, None to call it unguarded
+    breaker = None
+    # quotes of this type are remembered as last good quotes
+    quote_type = None
+
+    def get_quote(self, ticker, use_cache=True):
         raise NotImplemented
 
+    def get_quotes(self, tickers):
+        return [self.get_quote(x) for x in tickers]
+
+    def get_cached_quote(self, symbol):
+        return quote_cache.get((self.name, symbol))
+
+    def cache_quote(self, symbol, quote):
+        ttl = quote.cache_ttl()
+        if ttl > 0:
+            quote_cache.set((self.name, symbol), quote, ttl=ttl)
+        return quote
+
     def search(self, query):
         raise NotImplemented
 
+    def stats(self):
+        stats = ["Coalesced calls: {}".format(single_flight.coalesced[self.name])]
+        if self.breaker is not None:
+            stats.extend(self.breaker.result_as_list())
+        return stats
+
+
+class StaleQuote(object):
+    """ a last good quote served while its provider is failing """
+
+    def __init__(self, quote, fetched_at):
+        self.quote = quote
+        self.fetched_at = fetched_at
+
+    def __getattr__(self, item):
+        return getattr(self.quote, item)
+
+    def is_empty(self):
+        return False
+
+    def is_fresh(self):
+        return False
+
+    def stale_field(self):
+        return ["Stale", "{} minutes old".format(int((time.time() - self.fetched_at) // 60)), render.TEXT]
+
+    @property
+    def fields(self):
+        fields = render.fields_of(self.quote)
+        return None if fields is None else fields + [self.stale_field()]
+
+    def __str__(self):
+        return "{}, {}: {}".format(self.quote, *self.stale_field()[:2])
+
 
 class BaseQuote(object):
 
@@ -34,6 +249,10 @@ class BaseQuote(object):
     def is_fresh(self):
         return False
 
+    def cache_ttl(self):
+        """ seconds this quote may be served from the quote cache, 0 means don't cache it """
+        return 0
+
     @staticmethod
     def fields_to_str(fields):
         return ", ".join([
@@ -1,8 +1,15 @@
-import requests
 import datetime
-from functools import lru_cache
+import logging
+import threading
+import time
+from collections import defaultdict
 
-from stockbot.provider.base import BaseQuoteService
+from stockbot import deadline, http, render
+from stockbot.configuration import configuration
+from stockbot.provider.base import BaseQuoteService, coalesce, circuit_breaker, guarded, serve_stale, \
+    upstream_limiter
+
+LOGGER = logging.getLogger(__name__)
 
 
 class IbIndexNonExistingQuote(object):
@@ -22,15 +29,15 @@ class IbIndexQuote(object):
         self.nav_rebate_reported = "{:.3f}".format(message["netAssetValueRebatePremium"])
         self.nav_rebate_calculated = "{:.3f}".format(message["netAssetValueCalculatedRebatePremium"])
         self.nav_datechange = datetime.datetime.utcfromtimestamp(self.message["netAssetValueChangeDate"] / 1000)
+        self.fields = [
+            ["Name", self.name, render.TITLE],
+            ["NAV rebate percentage (reported)", self.nav_rebate_reported, render.IMPORTANT_CHANGE],
+            ["NAV rebate percentage (calculated)", self.nav_rebate_calculated, render.IMPORTANT_CHANGE],
+            ["NAV datechange", self.nav_datechange, render.TEXT]
+        ]
 
     def __str__(self):
-        return "Name: {name}, NAV rebate percentage (reported): {nav_rebate_reported}, NAV rebate percentage " \
-               "(calculated): {nav_rebate_calculated}, NAV datechange: {nav_datechange}".format(
-                name=self.name,
-                nav_rebate_reported=self.nav_rebate_reported,
-                nav_rebate_calculated=self.nav_rebate_calculated,
-                nav_datechange=self.nav_datechange
-                )
+        return render.plain(self.fields)
 
 
 class IbIndexSearchResult(object):
@@ -38,6 +45,7 @@ class IbIndexSearchResult(object):
     def __init__(self, result=None, query=None):
         self.result = result
         self.query = query
+        self.ranked_ticker = None
 
     def __str__(self):
         return "Result: {r}".format(r=" | ".join(self.result_as_list()))
@@ -49,44 +57,171 @@ class IbIndexSearchResult(object):
         return result
 
     def get_ranked_ticker(self):
-        ranked = []
-        for item in self.result:
-            if self.query == item["product"].lower():
-                rank = 1.0
-            else:
-                rank = len(self.query) / len(item["productName"])
-            ranked.append((rank, item["product"]))
-        ranked.sort(key=lambda x: x[0], reverse=True)
-        return ranked[0][1]
+        if self.ranked_ticker is None and self.result:
+            self.ranked_ticker = max(self.result, key=self._rank)["product"]
+        return self.ranked_ticker
+
+    def _rank(self, item):
+        if self.query == item["product"].lower():
+            return 1.0
+        return len(self.query) / len(item["productName"])
+
+
+class IbIndexProductIndex(object):
+    """
+    Lookup tables built once per product snapshot: an exact dict keyed by product code and an inverted n-gram
+    index over the product names, so a search only has to verify the candidates sharing all grams of the query.
+    """
+
+    gram_size = 3
+
+    def __init__(self, products):
+        self.products = products
+        self.names = [item["productName"].lower() for item in products]
+        self.by_product = {}
+        self.grams = defaultdict(set)
+        for position, item in enumerate(products):
+            self.by_product.setdefault(item["product"].lower(), position)
+            for gram in self._grams(self.names[position]):
+                self.grams[gram].add(position)
+
+    def _grams(self, text):
+        for size in range(1, self.gram_size + 1):
+            for i in range(len(text) - size + 1):
+                yield text[i:i + size]
+
+    def get(self, product):
+        position = self.by_product.get(product.lower())
+        if position is None:
+            return None
+        return self.products[position]
+
+    def search(self, query):
+        query = query.lower()
+        positions = set(self._name_matches(query))
+        if query in self.by_product:
+            positions.add(self.by_product[query])
+        return [self.products[x] for x in sorted(positions)]
+
+    def _name_matches(self, query):
+        if len(query) == 0:
+            return range(len(self.products))
+        if len(query) <= self.gram_size:
+            return self.grams.get(query, ())
+        postings = sorted((self.grams.get(query[i:i + self.gram_size], set())
+                           for i in range(len(query) - self.gram_size + 1)), key=len)
+        candidates = postings[0].intersection(*postings[1:])
+        return [x for x in candidates if query in self.names[x]]
+
+
+class IbIndexProductSnapshot(object):
+    """
+    Process wide copy of the ibindex product list, every service instance reads from the same snapshot.
+
+    A snapshot older than the TTL is still served while a background thread fetches a new one, a snapshot older
+    than max_stale (or no snapshot at all) is refreshed in the calling thread. Refreshes run one at a time, callers
+    that waited for one use what it fetched.
+    """
+
+    url = "http://ibindex.se/ibi//index/getProducts.req"
+    headers = {
+        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_6) AppleWebKit/537.36 (KHTML, like Gecko) "
+                      "Chrome/81.0.4044.129 Safari/537.36"
+    }
+    limiter = upstream_limiter("ibindex")
+
+    def __init__(self, *args, **kwargs):
+        self.ttl = kwargs.get('ttl', None)
+        self.max_stale = kwargs.get('max_stale', None)
+        self.index = None
+        self.fetched_at = None
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.refresh_thread = None
+
+    def get_ttl(self):
+        return self.ttl if self.ttl is not None else configuration.ibindex_cache_ttl_s
+
+    def get_max_stale(self):
+        return self.max_stale if self.max_stale is not None else configuration.ibindex_cache_max_stale_s
+
+    def get_index(self):
+        with self.lock:
+            index, fetched_at = self.index, self.fetched_at
+        if index is None or time.monotonic() - fetched_at > self.get_max_stale():
+            return self.refresh(max_age=self.get_max_stale())
+        if time.monotonic() - fetched_at > self.get_ttl():
+            self.refresh_in_background()
+        return index
+
+    def get_products(self):
+        return self.get_index().products
+
+    def refresh(self, max_age=None):
+        """ fetch and index the products, unless a refresh while waiting left an index younger than max_age """
+        left = deadline.remaining()
+        if not self.refresh_lock.acquire(timeout=-1 if left is None else max(0.0, left)):
+            raise deadline.DeadlineExceeded()
+        try:
+            with self.lock:
+                index, fetched_at = self.index, self.fetched_at
+            if max_age is not None and index is not None and time.monotonic() - fetched_at <= max_age:
+                return index
+            response = http.post(self.url, endpoint="getProducts", limiter=self.limiter, headers=self.headers)
+            response.raise_for_status()
+            index = IbIndexProductIndex(response.json())
+            with self.lock:
+                self.index = index
+                self.fetched_at = time.monotonic()
+            return index
+        finally:
+            self.refresh_lock.release()
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refresh_thread is not None and self.refresh_thread.is_alive():
+                return
+            self.refresh_thread = threading.Thread(name="thread-ibindex-refresh", target=self._background_refresh,
+                                                   daemon=True)
+            self.refresh_thread.start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh(max_age=self.get_ttl())
+        except Exception:
+            LOGGER.exception("failed to refresh ibindex products, keep serving the old snapshot")
+
+    def invalidate(self):
+        with self.lock:
+            self.index = None
+            self.fetched_at = None
+
+
+product_snapshot = IbIndexProductSnapshot()
 
 
 class IbIndexQueryService(BaseQuoteService):
 
+    name = "ibindex"
+
+    breaker = circuit_breaker("ibindex")
+    quote_type = IbIndexQuote
+
     def __init__(self, *args, **kwargs):
-        self.url = "http://ibindex.se/ibi//index/getProducts.req"
-        self.headers = {
-            "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_6) AppleWebKit/537.36 (KHTML, like Gecko) "
-                          "Chrome/81.0.4044.129 Safari/537.36"
-        }
-
-    def get_quote(self, ticker):
-        response = requests.post(self.url, headers=self.headers)
-        response.raise_for_status()
-        data = response.json()
-        try:
-            message = [x for x in data if x["product"].lower() == ticker.lower()][0]
-            return IbIndexQuote(message=message)
-        except IndexError:
+        self.snapshot = kwargs.get('snapshot', product_snapshot)
+
+    @coalesce
+    @serve_stale
+    @guarded
+    def get_quote(self, ticker, use_cache=True):
+        # the product snapshot is already a cache, nothing more to bypass
+        message = self.snapshot.get_index().get(ticker)
+        if message is None:
             return IbIndexNonExistingQuote(ticker=ticker)
+        return IbIndexQuote(message=message)
 
-    @lru_cache(maxsize=10)
+    @coalesce
+    @guarded
     def search(self, query):
-        query_lower = query.lower()
-        response = requests.post(self.url, headers=self.headers)
-        response.raise_for_status()
-        data = response.json()
-        matches = []
-        for item in data:
-            if query_lower == item["product"].lower() or query_lower in item["productName"].lower():
-                matches.append(item)
-        return IbIndexSearchResult(result=matches, query=query_lower)
+        matches = self.snapshot.get_index().search(query)
+        return IbIndexSearchResult(result=matches, query=query.lower())
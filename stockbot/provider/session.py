@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SessionPool(object):
+    """
+    Thread safe pool of long lived HTTP sessions so requests reuse warm connections instead of paying a new TCP and
+    TLS handshake every time.
+
+    At most max_size idle sessions are kept, sessions idle for longer than idle_timeout seconds are closed. The
+    cookies and crumb are held by the pool rather than the sessions, so a refresh is seen by every pooled session.
+    The generation counter is bumped on every refresh so callers can tell whether someone else already refreshed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.factory = kwargs.get('factory')
+        self.max_size = kwargs.get('max_size', 4)
+        self.idle_timeout = kwargs.get('idle_timeout', 300)
+        self.lock = threading.Lock()
+        self.idle = []
+        self.cookies = {}
+        self.crumb = None
+        self.generation = 0
+        self.refresh_lock = threading.Lock()
+
+    @contextmanager
+    def session(self):
+        s = self.acquire()
+        try:
+            yield s
+        except Exception:
+            # the connection may be in a bad state, don't hand it out again
+            self._close(s)
+            raise
+        self.release(s)
+
+    def acquire(self):
+        with self.lock:
+            expired = self._pop_expired()
+            s = self.idle.pop()[0] if len(self.idle) > 0 else None
+        for e in expired:
+            self._close(e)
+        if s is None:
+            LOGGER.debug("creating new pooled session")
+            s = self.factory()
+        return s
+
+    def release(self, s):
+        with self.lock:
+            if len(self.idle) < self.max_size:
+                self.idle.append((s, time.monotonic()))
+                return
+        self._close(s)
+
+    def refresh_credentials(self, seen_generation, refresh):
+        """
+        Single flight refresh of cookies and crumb, the callable is only invoked if nobody else refreshed since the
+        caller read the generation, everyone else waits for the running refresh and then reuses its result
+
+        :param seen_generation: generation the caller used for the request that failed
+        :param refresh: callable returning a (cookies, crumb) tuple
+        :return: True if this call did the refresh
+        """
+        with self.refresh_lock:
+            if self.generation != seen_generation:
+                return False
+            self.cookies, self.crumb = refresh()
+            self.generation += 1
+            return True
+
+    def size(self):
+        with self.lock:
+            return len(self.idle)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for s, _ in idle:
+            self._close(s)
+
+    def _pop_expired(self):
+        # idle is ordered by release time, the oldest sessions are first in the list
+        now = time.monotonic()
+        expired = []
+        while len(self.idle) > 0 and now - self.idle[0][1] > self.idle_timeout:
+            expired.append(self.idle.pop(0)[0])
+        return expired
+
+    @staticmethod
+    def _close(s):
+        try:
+            s.close()
+        except Exception:
+            LOGGER.exception("failed to close pooled session")
@@ -1,14 +1,48 @@
+import contextvars
+import json
 import logging
 from curl_cffi import requests
 import urllib.parse
-from datetime import datetime
+from datetime import datetime, timedelta
 from bs4 import BeautifulSoup
-
-from stockbot.provider.base import BaseQuoteService, BaseQuote
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import Column, String, DateTime
+
+from stockbot import http, render
+from stockbot.cache import TTLCache
+from stockbot.configuration import configuration
+from stockbot.db import Base, Session
+from stockbot.deadline import DeadlineExceeded
+from stockbot.metrics import registry
+from stockbot.provider.base import BaseQuoteService, BaseQuote, quote_cache, coalesce, cache_samples, \
+    circuit_breaker, guarded, serve_stale, upstream_limiter
+from stockbot.provider.session import SessionPool
 
 LOGGER = logging.getLogger(__name__)
 
 
+class YahooCredentials(Base):
+
+    __tablename__ = "yahoo_credentials"
+
+    id = Column(String, primary_key=True)
+    crumb = Column(String)
+    cookies = Column(String)
+    created_date = Column(DateTime, default=datetime.utcnow)
+
+    @classmethod
+    def load(cls, session, max_age):
+        credentials = session.get(cls, "default")
+        if credentials is None or (datetime.utcnow() - credentials.created_date).total_seconds() > max_age:
+            return None
+        return json.loads(credentials.cookies), credentials.crumb
+
+    @classmethod
+    def save(cls, session, cookies, crumb):
+        session.merge(cls(id="default", crumb=crumb, cookies=json.dumps(cookies), created_date=datetime.utcnow()))
+        session.commit()
+
+
 class YahooFallbackQuote(object):
 
     def __init__(self, *args, **kwargs):
@@ -26,8 +60,20 @@ class YahooFallbackQuote(object):
 
 class YahooQuote(BaseQuote):
 
+    # the only quote fields rendered, asked for explicitly so the quote endpoint skips everything else
+    quote_fields = [
+        "symbol", "shortName", "market", "marketState", "regularMarketTime", "regularMarketPrice",
+        "regularMarketDayLow", "regularMarketDayHigh", "regularMarketChangePercent", "preMarketPrice",
+        "preMarketChangePercent"
+    ]
+
+    # pre market of the next session starts at least this long after the last trade of a session
+    overnight_gap = timedelta(hours=12)
+
     def __init__(self, o):
-        for k, v in o["optionChain"]["result"][0]["quote"].items():
+        # accepts both an options endpoint response and a bare quote from the quote endpoint
+        quote = o["optionChain"]["result"][0]["quote"] if "optionChain" in o else o
+        for k, v in quote.items():
             setattr(self, k, v)
         if self.regularMarketTime == "N/A":
             self.timestamp = None
@@ -38,21 +84,21 @@ class YahooQuote(BaseQuote):
         self.is_pre_market = self.marketState == "PRE"
 
         self.fields = [
-            ["Name", self.shortName],
-            ["Price", self.regularMarketPrice],
-            ["Low Price", self.regularMarketDayLow],
-            ["High Price", self.regularMarketDayHigh],
-            ["Percent Change 1 Day", self.regularMarketChangePercent]
+            ["Name", self.shortName, render.TITLE],
+            ["Price", self.regularMarketPrice, render.NUMBER],
+            ["Low Price", self.regularMarketDayLow, render.NUMBER],
+            ["High Price", self.regularMarketDayHigh, render.NUMBER],
+            ["Percent Change 1 Day", self.regularMarketChangePercent, render.IMPORTANT_CHANGE]
         ]
         if self.is_pre_market:
             self.fields.extend([
-                ["Price Pre Market", self.preMarketPrice],
-                ["Percent Change Pre Market", self.preMarketChangePercent]
+                ["Price Pre Market", self.preMarketPrice, render.NUMBER],
+                ["Percent Change Pre Market", self.preMarketChangePercent, render.IMPORTANT_CHANGE]
             ])
         self.fields.extend([
-            ["Market", self.market],
-            ["Chart", "https://finance.yahoo.com/chart/{}".format(urllib.parse.quote_plus(self.symbol))],
-            ["Update Time", self.timestamp_str]
+            ["Market", self.market, render.TEXT],
+            ["Chart", "https://finance.yahoo.com/chart/{}".format(urllib.parse.quote_plus(self.symbol)), render.URL],
+            ["Update Time", self.timestamp_str, render.TEXT]
         ])
 
     def is_fresh(self):
@@ -60,71 +106,165 @@ class YahooQuote(BaseQuote):
             return False
         return (datetime.now() - self.timestamp).total_seconds() < 16 * 60
 
+    def next_session(self):
+        """
+        When the market is expected to open again after the session of regularMarketTime. Yahoo doesn't say, the
+        estimate is the time of the last trade plus the shortest overnight gap, moved past the weekend.
+        """
+        if self.timestamp is None:
+            return None
+        opens = self.timestamp + self.overnight_gap
+        while opens.weekday() >= 5:
+            opens += timedelta(days=1)
+        return opens
+
+    def cache_ttl(self, now=None):
+        if self.marketState in ["REGULAR", "PRE"] or self.is_fresh():
+            return configuration.quote_cache_ttl_open_s
+        # the market is closed so the price won't move until the next session. Holidays aren't known, so past the
+        # estimated start of it have another look every quote_cache_ttl_closed_s
+        opens = self.next_session()
+        if opens is None:
+            return configuration.quote_cache_ttl_closed_s
+        ttl = int((opens - (now or datetime.now())).total_seconds())
+        return min(max(ttl, configuration.quote_cache_ttl_closed_s), configuration.quote_cache_ttl_closed_max_s)
+
 
 class YahooSearchResult(object):
 
-    def __init__(self, o, query):
-        self.o = o
+    def __init__(self, o=None, query=None, symbols=None):
         self.query = query
-        self.tickers = []
-        if "quotes" in self.o:
-            self.tickers.extend(self.__ranked_tickers())
+        if symbols is None:
+            symbols = [x["symbol"] for x in self.__ranked_tickers(o) if "symbol" in x] if "quotes" in o else []
+        # only the ranked symbols are kept, the raw response is thrown away
+        self.symbols = tuple(symbols)
         LOGGER.info(f"search query: {self.query}")
-        LOGGER.info(f"search result: {self.tickers}")
+        LOGGER.info(f"search result: {self.symbols}")
 
-    def __ranked_tickers(self):
-        for idx, _ in enumerate(self.o["quotes"]):
+    def __ranked_tickers(self, o):
+        for idx, _ in enumerate(o["quotes"]):
             # assign higher weight to stockholm instruments
-            if "score" not in self.o["quotes"][idx]:
-                self.o["quotes"][idx]["score"] = 0
-            if "exchange" in self.o["quotes"][idx] and self.o["quotes"][idx]["exchange"] == "STO":
-                self.o["quotes"][idx]["score"] += self.o["quotes"][idx]["score"]
-            if "symbol" in self.o["quotes"][idx] and self.o["quotes"][idx]["symbol"] == self.query:
-                self.o["quotes"][idx]["score"] += 1000000000
-        return sorted(self.o["quotes"], key=lambda d: d["score"], reverse=True)
+            if "score" not in o["quotes"][idx]:
+                o["quotes"][idx]["score"] = 0
+            if "exchange" in o["quotes"][idx] and o["quotes"][idx]["exchange"] == "STO":
+                o["quotes"][idx]["score"] += o["quotes"][idx]["score"]
+            if "symbol" in o["quotes"][idx] and o["quotes"][idx]["symbol"] == self.query:
+                o["quotes"][idx]["score"] += 1000000000
+        return sorted(o["quotes"], key=lambda d: d["score"], reverse=True)
 
     def get_tickers(self):
-        return [x["symbol"] for x in self.tickers if "symbol" in x]
+        return list(self.symbols)
 
     def result_as_list(self):
-        return ["Name: {}".format(n["symbol"]) for n in self.tickers]
+        return ["Name: {}".format(x) for x in self.symbols]
 
     def is_empty(self):
-        return not (
-                len(self.tickers) > 0 and
-                any([True for x in self.tickers if "symbol" in x])
-        )
+        return len(self.symbols) == 0
 
 
 class YahooQueryService(BaseQuoteService):
-    # search results probably don't change that much so cache them
-    search_cache = {}
+
+    name = "yahoo"
+
+    breaker = circuit_breaker("yahoo")
+    limiter = upstream_limiter("yahoo")
+    quote_type = YahooQuote
+
+    # search results probably don't change that much so cache them, but not forever since symbols change
+    search_cache = TTLCache(max_size=configuration.yahoo_search_cache_size,
+                            ttl=configuration.yahoo_search_cache_ttl_s)
 
     headers = {
         "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36"
     }
 
-    cookies = {}
-    crumb = None
+    # warm sessions shared by every instance, also holds the cookies and crumb
+    session_pool = SessionPool(factory=lambda: requests.Session(impersonate="chrome"),
+                               max_size=configuration.yahoo_session_pool_size,
+                               idle_timeout=configuration.yahoo_session_idle_timeout_s)
+
+    # max number of symbols asked for in one request to the quote endpoint
+    quote_batch_size = 50
+
+    quote_url = "https://query2.finance.yahoo.com/v7/finance/quote"
+    options_url = "https://query2.finance.yahoo.com/v7/finance/options/{t}"
+    search_url = "https://query2.finance.yahoo.com/v1/finance/search"
 
     def __init__(self, *args, **kwargs):
         pass
 
-    def get_quote(self, ticker):
+    @coalesce
+    @serve_stale
+    @guarded
+    def get_quote(self, ticker, use_cache=True):
         search_result = self.search(ticker)
         if not search_result.is_empty():
-            t = search_result.get_tickers()[0]
-            response = self._get_with_cookie_refresh("https://query2.finance.yahoo.com/v7/finance/options/{t}".format(
-                t=t))
-            response.raise_for_status()
-            return YahooQuote(response.json())
+            symbol = search_result.get_tickers()[0]
+            quote = self.get_cached_quote(symbol) if use_cache else None
+            if quote is None:
+                quote = self.cache_quote(symbol, self._fetch_quote(symbol))
+            return quote
         else:
-            print(search_result.o)
+            LOGGER.info("nothing found for {}".format(ticker))
             return YahooFallbackQuote()
 
+    def _fetch_quote(self, symbol):
+        response = self._get_with_cookie_refresh(self.quote_url, params={
+            "symbols": symbol,
+            "fields": ",".join(YahooQuote.quote_fields)
+        }, endpoint="quote")
+        if response.status_code == 200:
+            result = (response.json().get("quoteResponse") or {}).get("result") or []
+            if len(result) > 0:
+                return YahooQuote(result[0])
+        LOGGER.info("quote endpoint returned {} without result for {}, falling back to options endpoint".format(
+            response.status_code, symbol))
+        response = self._get_with_cookie_refresh(self.options_url.format(t=symbol), endpoint="options")
+        response.raise_for_status()
+        return YahooQuote(response.json())
+
+    def resolve_symbols(self, tickers):
+        """ the first symbol the search finds for every ticker or None, searches not in the cache run concurrently """
+        def resolve(ticker):
+            search_result = self.search(ticker)
+            return None if search_result.is_empty() else search_result.get_tickers()[0]
+
+        unique = list(dict.fromkeys(tickers))
+        if len(unique) <= 1:
+            resolved = [resolve(x) for x in unique]
+        else:
+            with ThreadPoolExecutor(max_workers=min(len(unique), configuration.quote_fanout)) as pool:
+                # every search runs in a copy of the caller's context so it keeps the command deadline
+                futures = [pool.submit(contextvars.copy_context().run, resolve, x) for x in unique]
+                resolved = [x.result() for x in futures]
+        symbols = dict(zip(unique, resolved))
+        return [symbols[x] for x in tickers]
+
+    @guarded
+    def get_quotes(self, tickers):
+        symbols = self.resolve_symbols(tickers)
+        quotes = {}
+        for symbol in dict.fromkeys(x for x in symbols if x is not None):
+            quote = self.get_cached_quote(symbol)
+            if quote is not None:
+                quotes[symbol] = quote
+        missing_symbols = list(dict.fromkeys(x for x in symbols if x is not None and x not in quotes))
+        for i in range(0, len(missing_symbols), self.quote_batch_size):
+            response = self._get_with_cookie_refresh(self.quote_url, params={
+                "symbols": ",".join(missing_symbols[i:i + self.quote_batch_size]),
+                "fields": ",".join(YahooQuote.quote_fields)
+            }, endpoint="quote")
+            response.raise_for_status()
+            for quote in response.json()["quoteResponse"]["result"]:
+                quotes[quote["symbol"]] = self.cache_quote(quote["symbol"], YahooQuote(quote))
+        return [quotes.get(x, YahooFallbackQuote()) if x is not None else YahooFallbackQuote() for x in symbols]
+
+    @coalesce
+    @guarded
     def search(self, query):
-        if query not in self.search_cache:
-            response = self._get_with_cookie_refresh('https://query2.finance.yahoo.com/v1/finance/search', params={
+        symbols = self.search_cache.get(query)
+        if symbols is None:
+            response = self._get_with_cookie_refresh(self.search_url, params={
                 "q": query,
                 "lang": "en-US",
                 "region": "US",
@@ -137,34 +277,71 @@ class YahooQueryService(BaseQuoteService):
                 "enableCb": "true",
                 "enableNavLinks": "true",
                 "enableEnhancedTrivialQuery": "true"
-            })
+            }, endpoint="search")
             response.raise_for_status()
-            self.search_cache[query] = response.json()
-        return YahooSearchResult(self.search_cache[query], query)
+            search_result = YahooSearchResult(response.json(), query)
+            # don't keep misses (typos mostly) around for as long as hits
+            ttl = configuration.yahoo_search_cache_empty_ttl_s if search_result.is_empty() else None
+            self.search_cache.set(query, search_result.symbols, ttl=ttl)
+            return search_result
+        return YahooSearchResult(query=query, symbols=symbols)
+
+    def stats(self):
+        # latency and bytes per endpoint come from the shared http metrics, quote vs options shows what the field
+        # list saves
+        return super().stats() + http.result_as_list(hosts=[urllib.parse.urlsplit(self.quote_url).hostname]) + [
+            "Cache: {}, Hits: {hits}, Misses: {misses}, Evictions: {evictions}, Expirations: {expirations}, "
+            "Size: {size}".format(name, **cache.stats()) for name, cache in [("search", self.search_cache),
+                                                                             ("quote", quote_cache)]
+        ]
 
-    def _get_with_cookie_refresh(self, url, params={}):
-        with requests.Session(impersonate="chrome") as s:
-            response = s.get(url, cookies=self.cookies, params={**params, **{"crumb": self.crumb}},
-                             headers=self.headers)
+    def _get_with_cookie_refresh(self, url, params={}, endpoint=None):
+        pool = self.session_pool
+        if pool.crumb is None and pool.generation == 0:
+            pool.refresh_credentials(0, self._load_cookies_and_crumb)
+        with pool.session() as s:
+            generation = pool.generation
+            response = http.get(url, endpoint=endpoint, session=s, limiter=self.limiter, cookies=pool.cookies,
+                                params={**params, **{"crumb": pool.crumb}}, headers=self.headers)
             if response.status_code in [401, 403]:
-                self._get_cookies_and_crumb()
-                response = s.get(url, cookies=self.cookies, params={**params, **{"crumb": self.crumb}},
-                                 headers=self.headers)
-            return response
+                http.record_retry(url, endpoint=endpoint, reason=str(response.status_code))
+                pool.refresh_credentials(generation, self._refresh_cookies_and_crumb)
+                response = http.get(url, endpoint=endpoint, session=s, limiter=self.limiter, cookies=pool.cookies,
+                                    params={**params, **{"crumb": pool.crumb}}, headers=self.headers)
+        return response
+
+    def _load_cookies_and_crumb(self):
+        """ reuse what an earlier process stored unless it is too old, it saves four round trips on the first quote """
+        try:
+            with Session() as session:
+                stored = YahooCredentials.load(session, configuration.yahoo_crumb_max_age_s)
+        except DeadlineExceeded:
+            raise
+        except Exception:
+            LOGGER.exception("failed to load stored yahoo cookies and crumb")
+            stored = None
+        return stored if stored is not None else ({}, None)
+
+    def _refresh_cookies_and_crumb(self):
+        http.record_credentials_refresh(self.name)
+        cookies, crumb = self._get_cookies_and_crumb()
+        try:
+            with Session() as session:
+                YahooCredentials.save(session, cookies, crumb)
+        except Exception:
+            LOGGER.exception("failed to store yahoo cookies and crumb")
+        return cookies, crumb
 
     # copy paste from https://github.com/ranaroussi/yfinance/blob/main/yfinance/data.py but without configuration bloat
     def _get_cookies_and_crumb(self):
 
-        self.cookies = {}
-        self.crumb = None
-
         base_args = {
             'headers': self.headers
         }
 
         get_args = {**base_args, 'url': 'https://guce.yahoo.com/consent'}
-        with requests.Session(impersonate="chrome") as s:
-            response = s.get(**get_args)
+        with self.session_pool.session() as s:
+            response = http.get(endpoint="consent", session=s, limiter=self.limiter, **get_args)
             soup = BeautifulSoup(response.content, 'html.parser')
             csrfTokenInput = soup.find('input', attrs={'name': 'csrfToken'})
             csrfToken = csrfTokenInput['value']
@@ -187,13 +364,16 @@ class YahooQueryService(BaseQuoteService):
             get_args = {**base_args,
                         'url': f'https://guce.yahoo.com/copyConsent?sessionId={sessionId}',
                         'data': data}
-            s.post(**post_args)
-            s.get(**get_args)
-            self.cookies = s.cookies
+            http.post(endpoint="collectConsent", session=s, limiter=self.limiter, **post_args)
+            http.get(endpoint="copyConsent", session=s, limiter=self.limiter, **get_args)
+            cookies = {c.name: c.value for c in s.cookies.jar}
 
             get_args = {
                 'url': 'https://query2.finance.yahoo.com/v1/test/getcrumb',
                 'headers': self.headers,
             }
-            r = s.get(**get_args)
-            self.crumb = r.text
+            r = http.get(endpoint="getcrumb", session=s, limiter=self.limiter, **get_args)
+            return cookies, r.text
+
+
+registry.register_collector(lambda: cache_samples("yahoo_search", YahooQueryService.search_cache))
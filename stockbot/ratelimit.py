@@ -0,0 +1,101 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket, refilled with rate tokens per second up to burst tokens.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.rate = float(kwargs.get('rate', 1.0))
+        self.burst = float(kwargs.get('burst', 1.0))
+        self.clock = kwargs.get('clock', time.monotonic)
+        self.tokens = self.burst
+        self.updated_at = self.clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, tokens=1):
+        with self.lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def wait_time(self, tokens=1):
+        """ seconds until the given number of tokens is available """
+        with self.lock:
+            self._refill()
+            return max(0.0, (tokens - self.tokens) / self.rate)
+
+
+class UpstreamLimiter(object):
+    """
+    Limits the number of concurrent calls and the call rate to one upstream. Callers wait for a free slot and a token
+    instead of being turned away, and an upstream answering 429 holds back every caller until its Retry-After passed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.name = kwargs.get('name', 'upstream')
+        self.clock = kwargs.get('clock', time.monotonic)
+        self.sleep = kwargs.get('sleep', time.sleep)
+        self.max_concurrent = kwargs.get('max_concurrent', 4)
+        self.semaphore = threading.BoundedSemaphore(self.max_concurrent)
+        self.bucket = TokenBucket(rate=kwargs.get('rate', 5.0), burst=kwargs.get('burst', 10), clock=self.clock)
+        self.lock = threading.Lock()
+        self.blocked_until = 0.0
+        self.in_flight = 0
+        self.back_offs = 0
+
+    def acquire(self, timeout=None):
+        """
+        Wait for a free slot and a token, release() the slot when the call is done
+
+        :param timeout: seconds to wait at most, None to wait as long as it takes
+        :return: False if that wasn't possible within the timeout
+        """
+        end = None if timeout is None else self.clock() + timeout
+        if timeout is None:
+            self.semaphore.acquire()
+        elif timeout <= 0 or not self.semaphore.acquire(timeout=timeout):
+            return False
+        while True:
+            now = self.clock()
+            with self.lock:
+                wait = self.blocked_until - now
+            if wait <= 0:
+                if self.bucket.try_acquire():
+                    with self.lock:
+                        self.in_flight += 1
+                    return True
+                wait = self.bucket.wait_time()
+            if end is not None and now + wait > end:
+                self.semaphore.release()
+                return False
+            self.sleep(wait)
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+        self.semaphore.release()
+
+    def back_off(self, seconds):
+        """ hold back every call for the given seconds, like an upstream's Retry-After asks us to """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, self.clock() + seconds)
+            self.back_offs += 1
+
+    def samples(self):
+        with self.lock:
+            labels = {"upstream": self.name}
+            return [
+                ("stockbot_upstream_in_flight", labels, self.in_flight),
+                ("stockbot_upstream_blocked_seconds", labels, max(0.0, self.blocked_until - self.clock())),
+                ("stockbot_upstream_back_offs_total", labels, self.back_offs),
+            ]
@@ -0,0 +1,85 @@
+import json
+
+from stockbot.util import ColorHelper
+
+# what a field value is, decides how it is rendered
+TITLE = "title"
+TEXT = "text"
+NUMBER = "number"
+CHANGE = "change"
+IMPORTANT_CHANGE = "important_change"
+RECOMMENDATION = "recommendation"
+URL = "url"
+
+
+def fields_of(row):
+    """ the (key, value, kind) fields of a row that has them, None for rows that are just strings """
+    fields = getattr(row, "fields", None)
+    return fields if isinstance(fields, list) else None
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _irc_number(value):
+    v = _number(value)
+    return ColorHelper.grey(value if v is None else "{:.3f}".format(v))
+
+
+def _irc_change(value):
+    v = _number(value)
+    if v is None:
+        return ColorHelper.grey(value)
+    return ColorHelper.red("{:.3f}".format(v)) if v < 0 else ColorHelper.green("{:.3f}".format(v))
+
+
+def _irc_important_change(value):
+    v = _number(value)
+    return ColorHelper.grey(value) if v is None else ColorHelper.bold(_irc_change(value))
+
+
+def _irc_recommendation(value):
+    # buy/hold/sell
+    split = str(value).split("/")
+    if len(split) != 3:
+        return ColorHelper.grey(value)
+    return "{}/{}/{}".format(ColorHelper.green(split[0]), ColorHelper.yellow(split[1]), ColorHelper.red(split[2]))
+
+
+IRC_VALUE_RENDERERS = {
+    TITLE: lambda value: ColorHelper.bold(ColorHelper.white(value)),
+    TEXT: ColorHelper.grey,
+    NUMBER: _irc_number,
+    CHANGE: _irc_change,
+    IMPORTANT_CHANGE: _irc_important_change,
+    RECOMMENDATION: _irc_recommendation,
+    URL: ColorHelper.greenish,
+}
+
+IRC_SEPARATOR = ColorHelper.white(",") + " "
+
+
+def field_parts(field):
+    """ fields are (key, value) or (key, value, kind), text is the default kind """
+    return field[0], field[1], field[2] if len(field) > 2 else TEXT
+
+
+def irc(fields):
+    rendered = []
+    for field in fields:
+        key, value, kind = field_parts(field)
+        value_renderer = IRC_VALUE_RENDERERS.get(kind, ColorHelper.grey)
+        rendered.append("{}: {}".format(ColorHelper.purple(key), value_renderer(value)))
+    return IRC_SEPARATOR.join(rendered)
+
+
+def plain(fields):
+    return ", ".join("{}: {}".format(*field_parts(x)[:2]) for x in fields)
+
+
+def to_json(fields):
+    return json.dumps(dict(field_parts(x)[:2] for x in fields), default=str)
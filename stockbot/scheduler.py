@@ -0,0 +1,327 @@
+import contextlib
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from stockbot import deadline
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CronSpec(object):
+    """
+    Cron style schedule, "second minute hour day-of-month month day-of-week" or the classic five fields without the
+    seconds (which then means second 0). Fields are *, numbers, ranges a-b, lists a,b and steps */n or a-b/n. Day of
+    week is 0-6 with 0 (or 7) being Sunday, and like cron a day matches either day field when both are restricted.
+    """
+
+    # (min, max) of every field, in the order of a six field spec
+    ranges = [(0, 59), (0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, spec):
+        self.spec = spec
+        fields = spec.split()
+        if len(fields) == 5:
+            fields = ["0"] + fields
+        if len(fields) != 6:
+            raise ValueError("cron spec '{}' must have five or six fields".format(spec))
+        self.seconds, self.minutes, self.hours, self.days, self.months, days_of_week = [
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self.ranges)]
+        self.days_of_week = set(x % 7 for x in days_of_week)
+        self.any_day = fields[3] == "*"
+        self.any_day_of_week = fields[5] == "*"
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(","):
+            value_range, _, step = part.partition("/")
+            if value_range == "*":
+                start, end = low, high
+            elif "-" in value_range:
+                start, end = [int(x) for x in value_range.split("-", 1)]
+            else:
+                start = end = int(value_range)
+                if step:
+                    end = high
+            if start < low or end > high or start > end:
+                raise ValueError("'{}' is out of range {}-{}".format(part, low, high))
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def _day_matches(self, dt):
+        day = dt.day in self.days
+        day_of_week = (dt.weekday() + 1) % 7 in self.days_of_week
+        if self.any_day or self.any_day_of_week:
+            return day and day_of_week
+        return day or day_of_week
+
+    def next_after(self, dt):
+        """ the first time matching the spec strictly after dt """
+        dt = dt.replace(microsecond=0) + timedelta(seconds=1)
+        # a spec like "0 0 0 31 2 *" never matches, give up after looking a few years ahead
+        limit = dt + timedelta(days=366 * 5)
+        while dt < limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0, second=0)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0, second=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0, second=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt = dt.replace(second=0) + timedelta(minutes=1)
+            elif dt.second not in self.seconds:
+                dt = dt + timedelta(seconds=1)
+            else:
+                return dt
+        raise ValueError("cron spec '{}' never matches".format(self.spec))
+
+    def __str__(self):
+        return self.spec
+
+
+class ScheduledJob(object):
+    """
+    A command run on a CronSpec. When the scheduler falls behind (the process was suspended, the reactor was stuck)
+    the catch up policy decides what happens with the runs that were missed:
+
+    SKIP drops them unless the run is less than grace seconds late, ONCE runs once for all of them and ALL runs every
+    one of them. Every run is delayed by a random 0 to jitter seconds so jobs on the same schedule spread out.
+
+    The overlap policy decides what a JobRunner does when the job is due while its previous run is still going: SKIP
+    the new run, QUEUE it to start when the previous one is done, or REPLACE the previous run which is called off at
+    its next deadline check. A run taking more than max_runtime seconds is called off the same way.
+    """
+
+    SKIP = "skip"
+    ONCE = "once"
+    ALL = "all"
+    QUEUE = "queue"
+    REPLACE = "replace"
+
+    def __init__(self, *args, **kwargs):
+        self.name = kwargs.get('name')
+        self.command = kwargs.get('command')
+        self.spec = kwargs.get('spec')
+        self.catch_up = kwargs.get('catch_up', self.ONCE)
+        self.grace = kwargs.get('grace', 60)
+        self.jitter = kwargs.get('jitter', 0)
+        self.overlap = kwargs.get('overlap', self.SKIP)
+        # seconds, None to use the command timeout
+        self.max_runtime = kwargs.get('max_runtime', None)
+        self.scheduled_at = None
+        self.cancelled = False
+
+    def next_run(self, after):
+        """
+        epoch seconds of the next run according to the spec, without jitter, always later than after
+
+        The spec is matched against naive local time, which is ambiguous in the hour repeated when daylight saving
+        time ends. A match is tried as both of its occurrences and the first one later than after is the next run, the
+        search starts at the local time of after itself which can come around a second time.
+        """
+        dt = datetime.fromtimestamp(after).replace(microsecond=0, fold=0) - timedelta(seconds=1)
+        while True:
+            dt = self.spec.next_after(dt)
+            for candidate in (dt.replace(fold=0), dt.replace(fold=1)):
+                at = candidate.timestamp()
+                if at > after:
+                    return at
+
+    def __repr__(self):
+        return "<ScheduledJob name={}, spec={}, catch_up={}>".format(self.name, self.spec, self.catch_up)
+
+
+class JobScheduler(object):
+    """
+    Jobs ordered by their next run in a heap, so finding what is due never looks at jobs that are not. Whoever drives
+    it asks for next_delay() and calls pop_due() when that has passed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.clock = kwargs.get('clock', time.time)
+        self.random = kwargs.get('random', random.uniform)
+        self.lock = threading.Lock()
+        self.heap = []
+        self.jobs = {}
+        self.counter = itertools.count()
+
+    def add(self, job):
+        """ add or replace the job with the same name """
+        with self.lock:
+            if job.name in self.jobs:
+                self.jobs[job.name].cancelled = True
+            job.cancelled = False
+            self.jobs[job.name] = job
+            self._push(job, job.next_run(self.clock()))
+
+    def remove(self, name):
+        with self.lock:
+            job = self.jobs.pop(name, None)
+            if job is not None:
+                # it stays in the heap until it comes up, then it's thrown away
+                job.cancelled = True
+            return job is not None
+
+    def get_jobs(self):
+        with self.lock:
+            return sorted(self.jobs.values(), key=lambda x: x.scheduled_at)
+
+    def _push(self, job, scheduled_at):
+        job.scheduled_at = scheduled_at
+        fire_at = scheduled_at + (self.random(0, job.jitter) if job.jitter > 0 else 0)
+        heapq.heappush(self.heap, (fire_at, next(self.counter), job))
+
+    def next_delay(self):
+        """ seconds until the next job is due, None when there are no jobs """
+        with self.lock:
+            while len(self.heap) > 0 and self.heap[0][2].cancelled:
+                heapq.heappop(self.heap)
+            if len(self.heap) == 0:
+                return None
+            return max(0.0, self.heap[0][0] - self.clock())
+
+    def pop_due(self):
+        """ the jobs that are due to run now, a job can be in there more than once when it catches up with ALL """
+        now = self.clock()
+        due = []
+        with self.lock:
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                _, _, job = heapq.heappop(self.heap)
+                if job.cancelled:
+                    continue
+                late = now - job.scheduled_at
+                if job.catch_up == ScheduledJob.ALL:
+                    due.append(job)
+                    self._push_after(job, job.scheduled_at)
+                    continue
+                if job.catch_up == ScheduledJob.SKIP and late > job.grace:
+                    LOGGER.warning("skipping run of {}, it is {:.0f}s late".format(job.name, late))
+                else:
+                    due.append(job)
+                self._push_after(job, now)
+        return due
+
+    def _push_after(self, job, after):
+        # a job pushed back at or before the time it was popped for would be popped again right away, forever
+        scheduled_at = job.next_run(after)
+        if scheduled_at <= after:
+            LOGGER.error("dropping {}, its next run {} is not after {}".format(job.name, scheduled_at, after))
+            job.cancelled = True
+            self.jobs.pop(job.name, None)
+            return
+        self._push(job, scheduled_at)
+
+
+class JobFailed(Exception):
+    """ raised by a job whose command replied that it failed instead of raising """
+
+
+class JobStatus(object):
+    """ what a JobRunner knows about the runs of one job """
+
+    def __init__(self):
+        self.running = False
+        # cancel event of the run currently going, a replaced run keeps going until it notices it was called off
+        self.current = None
+        self.pending = None
+        self.runs = 0
+        self.skipped = 0
+        self.replaced = 0
+        self.rejected = 0
+        self.last_started_at = None
+        self.last_duration = None
+        self.last_error = None
+
+
+class JobRunner(object):
+    """
+    Runs scheduled jobs in a bounded WorkerPool, so a slow job holds up neither the other jobs nor the reactor, and
+    applies the overlap policy and max runtime of every job.
+    """
+
+    STARTED = "started"
+    SKIPPED = "skipped"
+    QUEUED = "queued"
+    REPLACED = "replaced"
+    REJECTED = "rejected"
+
+    def __init__(self, *args, **kwargs):
+        self.pool = kwargs.get('pool')
+        self.clock = kwargs.get('clock', time.monotonic)
+        self.lock = threading.Lock()
+        self.statuses = {}
+
+    def run(self, job, func, *args, **kwargs):
+        """
+        :return: STARTED, REPLACED if it called off the previous run, SKIPPED or QUEUED when the previous run is
+                 still going and REJECTED if the pool is full
+        """
+        result = self.STARTED
+        with self.lock:
+            status = self.statuses.setdefault(job.name, JobStatus())
+            if status.running:
+                if job.overlap == ScheduledJob.QUEUE:
+                    # one queued run is enough to catch up
+                    status.pending = (func, args, kwargs)
+                    return self.QUEUED
+                if job.overlap != ScheduledJob.REPLACE:
+                    status.skipped += 1
+                    LOGGER.info("skipping {}, the previous run is still going".format(job.name))
+                    return self.SKIPPED
+                status.current.set()
+                status.replaced += 1
+                result = self.REPLACED
+            status.running = True
+            status.current = threading.Event()
+            cancel = status.current
+        if not self.pool.submit(self._run, job, status, cancel, func, args, kwargs):
+            with self.lock:
+                if status.current is cancel:
+                    status.running = False
+                    status.current = None
+                status.rejected += 1
+            return self.REJECTED
+        return result
+
+    def _run(self, job, status, cancel, func, args, kwargs):
+        started = self.clock()
+        with self.lock:
+            status.last_started_at = time.time()
+        error = None
+        max_runtime = deadline.within(job.max_runtime) if job.max_runtime else contextlib.nullcontext()
+        try:
+            with deadline.cancellable(cancel), max_runtime:
+                func(*args, **kwargs)
+                # commands answer a deadline with a timed out reply rather than raising
+                if deadline.expired():
+                    raise deadline.DeadlineExceeded()
+        except deadline.DeadlineExceeded:
+            error = "timed out"
+        except JobFailed as e:
+            LOGGER.warning("scheduled job {} failed: {}".format(job.name, e))
+            error = str(e)
+        except Exception as e:
+            LOGGER.exception("scheduled job {} failed".format(job.name))
+            error = str(e) or type(e).__name__
+        pending = None
+        with self.lock:
+            status.runs += 1
+            # a replaced run finishing late doesn't get to overwrite what the run that replaced it reported
+            if not cancel.is_set():
+                status.last_duration = self.clock() - started
+                status.last_error = error
+            if status.current is cancel:
+                status.running = False
+                status.current = None
+                pending, status.pending = status.pending, None
+        if pending is not None:
+            self.run(job, pending[0], *pending[1], **pending[2])
+
+    def get_status(self, name):
+        with self.lock:
+            return self.statuses.get(name)
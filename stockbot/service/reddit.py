@@ -1,7 +1,7 @@
-import requests
 import logging
 import os
 from datetime import datetime
+from stockbot import http
 from stockbot.db import Base, Session
 from lxml import etree
 from sqlalchemy import Column, String, DateTime, Boolean, Integer, select, update
@@ -28,7 +28,7 @@ class RedditFreeGamesService(object):
         self.ignore_words = ignore_words
 
     def refresh(self, session: Session) -> None:
-        response = requests.get("https://www.reddit.com/r/FreeGameFindings/new.rss", headers={
+        response = http.get("https://www.reddit.com/r/FreeGameFindings/new.rss", endpoint="freegames", headers={
             "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/134.0.0.0 Safari/537.36"
         })
         response.raise_for_status()
@@ -1,5 +1,7 @@
 from datetime import datetime
 
+from stockbot.scheduler import CronSpec, ScheduledJob
+
 
 class OneshotTimer(object):
 
@@ -35,6 +37,10 @@ class OncePerDayTimer(object):
         now = datetime.now()
         return now.hour == self.fire_at_hour and now.minute == self.fire_at_minute
 
+    def job(self, **kwargs):
+        return ScheduledJob(name=self.identity, command=self.command,
+                            spec=CronSpec("0 {} {} * * *".format(self.fire_at_minute, self.fire_at_hour)), **kwargs)
+
     def __eq__(self, other):
         if hasattr(other, "identity"):
             return self.identity == other.identity
@@ -55,6 +61,10 @@ class OncePerHourTimer(object):
         now = datetime.now()
         return now.minute == self.fire_at_minute
 
+    def job(self, **kwargs):
+        return ScheduledJob(name=self.identity, command=self.command,
+                            spec=CronSpec("0 {} * * * *".format(self.fire_at_minute)), **kwargs)
+
     def __eq__(self, other):
         if hasattr(other, "identity"):
             return self.identity == other.identity
@@ -36,11 +36,13 @@ class ColorHelper(object):
         return "\x0310{}\x03".format(value)
 
 
-def colorify(msg):
+num_change_regex = re.compile("[^\w]?(total (percentage return|return)|%)[^\w]?", flags=re.IGNORECASE)
+num_important_change_regex = re.compile("[^\w]?(change|rebate percentage)[^\w]?", flags=re.IGNORECASE)
+num_recommendations_regex = re.compile("[^\w]?recommendations [^\w]?", flags=re.IGNORECASE)
+
 
-    num_change_regex = re.compile("[^\w]?(total (percentage return|return)|%)[^\w]?", flags=re.IGNORECASE)
-    num_important_change_regex = re.compile("[^\w]?(change|rebate percentage)[^\w]?", flags=re.IGNORECASE)
-    num_recommendations_regex = re.compile("[^\w]?recommendations [^\w]?", flags=re.IGNORECASE)
+def colorify(msg):
+    """ guess the colors of a "key: value, key: value | ..." string, rows with fields use stockbot.render instead """
 
     # split over pipe separated "groups"
     group_split = msg.split("|")
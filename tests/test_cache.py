@@ -0,0 +1,35 @@
+import time
+import unittest
+
+from stockbot.cache import TTLCache
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_hit_and_miss(self):
+        cache = TTLCache(max_size=2, ttl=60)
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", 1)
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual({"hits": 1, "misses": 1, "evictions": 0, "expirations": 0, "size": 1}, cache.stats())
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(3, cache.get("c"))
+        self.assertEqual(1, cache.stats()["evictions"])
+
+    def test_entry_expires(self):
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set("a", 1, ttl=0.01)
+        cache.set("b", 2)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(2, cache.get("b"))
+        self.assertEqual(1, cache.stats()["expirations"])
+        self.assertEqual(1, len(cache))
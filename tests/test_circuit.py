@@ -0,0 +1,69 @@
+import unittest
+
+from stockbot.circuit import CircuitBreaker, CircuitOpen
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def fail():
+    raise ConnectionError("upstream down")
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.sut = CircuitBreaker(name="test", failure_threshold=2, slow_call=5, reset_timeout=30, clock=self.clock)
+
+    def test_opens_after_consecutive_failures(self):
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                self.sut.call(fail)
+        self.assertEqual(CircuitBreaker.OPEN, self.sut.state)
+        with self.assertRaises(CircuitOpen):
+            self.sut.call(lambda: "never called")
+        self.assertEqual(1, self.sut.rejected)
+
+    def test_success_resets_failures(self):
+        with self.assertRaises(ConnectionError):
+            self.sut.call(fail)
+        self.assertEqual("ok", self.sut.call(lambda: "ok"))
+        with self.assertRaises(ConnectionError):
+            self.sut.call(fail)
+        self.assertEqual(CircuitBreaker.CLOSED, self.sut.state)
+
+    def test_slow_calls_count_as_failures(self):
+        def slow():
+            self.clock.now += 5
+            return "slow"
+        self.assertEqual("slow", self.sut.call(slow))
+        self.assertEqual("slow", self.sut.call(slow))
+        self.assertEqual(CircuitBreaker.OPEN, self.sut.state)
+
+    def test_half_open_probe(self):
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                self.sut.call(fail)
+        self.clock.now = 30
+        with self.assertRaises(ConnectionError):
+            self.sut.call(fail)
+        self.assertEqual(CircuitBreaker.OPEN, self.sut.state)
+        self.clock.now = 60
+        self.assertEqual("ok", self.sut.call(lambda: "ok"))
+        self.assertEqual(CircuitBreaker.CLOSED, self.sut.state)
+        self.assertEqual(2, self.sut.opened)
+
+    def test_nested_calls_pass_through(self):
+        self.clock.now = 0
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                self.sut.call(fail)
+        self.clock.now = 30
+        self.assertEqual("inner", self.sut.call(lambda: self.sut.call(lambda: "inner")))
@@ -1,13 +1,17 @@
 import threading
+import time
 import unittest
 import vcr
 
 from unittest.mock import patch
 
-from stockbot.command import root_command
+from stockbot.command import root_command, Command, BlockingExecuteCommand, ErrorReply, output_cache
+from stockbot.circuit import CircuitOpen
 from stockbot.db import Session, create_tables, drop_tables
 from stockbot.persistence import DatabaseCollection, ScheduledCommand
 from stockbot.provider import QuoteServiceFactory
+from stockbot.provider.base import BaseQuoteService
+from stockbot.provider.ibindex import IbIndexQueryService, IbIndexProductSnapshot, IbIndexProductIndex
 
 
 class FakeQuoteServiceSearchResult(object):
@@ -59,6 +63,7 @@ class TestCommand(unittest.TestCase):
         self.ircbot = FakeIrcBot()
         self.service = FakeQuoteService()
         self.session = Session()
+        output_cache.clear()
         create_tables()
 
     def tearDown(self):
@@ -77,6 +82,16 @@ class TestCommand(unittest.TestCase):
         res = self.__cmd_wrap(*command)
         self.assertEqual("Here's your fake quote for aapl", res)
 
+    def test_ibindex_get_without_match(self):
+        snapshot = IbIndexProductSnapshot(ttl=300, max_stale=3600)
+        snapshot.index = IbIndexProductIndex([{"product": "INVE B", "productName": "Investor B"}])
+        snapshot.fetched_at = time.monotonic()
+        factory = QuoteServiceFactory()
+        factory.services = {"ibindex": IbIndexQueryService(snapshot=snapshot)}
+        res = root_command.execute("ibindex", "get", "abcdefghijklmnop", command_args={"service_factory": factory})
+        self.assertNotIsInstance(res, ErrorReply)
+        self.assertEqual("No such quote: abcdefghijklmnop", str(res))
+
     def test_quote_get_fresh_command(self):
 
         class FakeQuoteIsNotFresh(object):
@@ -92,7 +107,7 @@ class TestCommand(unittest.TestCase):
 
         class FakeQuoteServiceLocal(object):
 
-            def get_quote(self, ticker):
+            def get_quote(self, ticker, use_cache=True):
                 if ticker == "not_fresh":
                     return FakeQuoteIsNotFresh()
                 else:
@@ -108,6 +123,55 @@ class TestCommand(unittest.TestCase):
         res = root_command.execute(*command, command_args={"service_factory": factory, "instance": self.ircbot})
         self.assertEqual("I'm fresh", str(res))
 
+    def test_quote_multi_command(self):
+
+        class FakeQuoteServiceMulti(BaseQuoteService):
+
+            def get_quote(self, ticker):
+                return "Here's your fake quote for {}".format(ticker)
+
+        factory = QuoteServiceFactory()
+        factory.providers = {"fakeprovider": FakeQuoteServiceMulti}
+        command = ["quote", "multi", "fakeprovider", "aapl", "msft"]
+        res = root_command.execute(*command, command_args={"service_factory": factory, "instance": self.ircbot})
+        self.assertEqual(["Here's your fake quote for aapl", "Here's your fake quote for msft"], res)
+
+    def test_quote_lucky_multiple_tickers(self):
+
+        class FakeQuote(object):
+
+            def __init__(self, ticker):
+                self.ticker = ticker
+
+            def is_empty(self):
+                return self.ticker == "nothing"
+
+            def __str__(self):
+                return "Quote for {}".format(self.ticker)
+
+        class FakeSearchResult(object):
+
+            def is_empty(self):
+                return True
+
+        class SlowFakeQuoteService(object):
+
+            def get_quote(self, ticker):
+                time.sleep(0.2)
+                return FakeQuote(ticker)
+
+            def search(self, query):
+                return FakeSearchResult()
+
+        factory = QuoteServiceFactory()
+        factory.providers = {"fakeprovider": SlowFakeQuoteService}
+        command = ["quote", "gl", "fakeprovider", "volvo", "b,", "ericsson,nothing", ",", "abb"]
+        started = time.monotonic()
+        res = root_command.execute(*command, command_args={"service_factory": factory, "instance": self.ircbot})
+        self.assertLess(time.monotonic() - started, 0.6)
+        self.assertEqual(["Quote for volvo b", "Quote for ericsson", "Nothing found for nothing", "Quote for abb"],
+                         [str(x) for x in res])
+
     def test_quote_get_command_invalid_input(self):
 
         command = ["quote", "get", "invalid-provider", "aapl"]
@@ -139,6 +203,96 @@ class TestCommand(unittest.TestCase):
         self.assertIn("quote (q) get <provider> <ticker>", res)
         self.assertIn("quote (q) search <provider> <ticker>", res)
 
+    def test_execute_unique_prefix_command(self):
+
+        command = ["quo", "get", "fakeprovider", "aapl"]
+        res = self.__cmd_wrap(*command)
+        self.assertEqual("Here's your fake quote for aapl", res)
+
+        command = ["quo", "sea", "fakeprovider", "foobar"]
+        res = self.__cmd_wrap(*command)
+        self.assertIn("Ticker: FOO, Market: Foo Market, Name: Foo Company", res)
+
+        # get, get_fresh and gl all start with g
+        command = ["quote", "g", "fakeprovider", "aapl"]
+        res = self.__cmd_wrap(*command)
+        self.assertIsNone(res)
+
+        # quick and quote both start with qu
+        command = ["qu", "get", "fakeprovider", "aapl"]
+        res = self.__cmd_wrap(*command)
+        self.assertIsNone(res)
+
+    def test_help_is_invalidated_on_register(self):
+
+        tree = Command(name="root")
+        subtree = Command(name="sub")
+        tree.register(subtree)
+        subtree.register(BlockingExecuteCommand(name="one"))
+        self.assertEqual(["sub one"], tree.show_help())
+        subtree.register(BlockingExecuteCommand(name="two", help="<arg>"))
+        self.assertEqual(["sub one", "sub two <arg>"], tree.show_help())
+
+    def test_cached_command_output(self):
+
+        calls = []
+
+        def count(*args, **kwargs):
+            calls.append(args)
+            return "called with {}".format(" ".join(args))
+
+        tree = Command(name="root")
+        tree.register(BlockingExecuteCommand(name="cached", execute_command=count, cache_ttl=30))
+        tree.register(BlockingExecuteCommand(name="uncached", execute_command=count))
+
+        self.assertEqual("called with Foo", tree.execute("cached", "Foo", command_args={}))
+        self.assertEqual("called with Foo", tree.execute("cached", "foo ", command_args={}))
+        self.assertEqual("called with bar", tree.execute("cached", "bar", command_args={}))
+        tree.execute("uncached", "foo", command_args={})
+        tree.execute("uncached", "foo", command_args={})
+        self.assertEqual(4, len(calls))
+        self.assertIn("Command: cached, Hits: 1, Misses: 2", output_cache.result_as_list())
+
+    def test_circuit_open_reply(self):
+        def unavailable(*args, **kwargs):
+            raise CircuitOpen("fake")
+
+        tree = Command(name="root")
+        tree.register(BlockingExecuteCommand(name="unavailable", execute_command=unavailable, cache_ttl=30))
+        result = tree.execute("unavailable", command_args={})
+        self.assertIsInstance(result, ErrorReply)
+        self.assertEqual("fake is unavailable right now, try again later", result)
+        self.assertIsNone(output_cache.get("unavailable", ()))
+
+    def test_error_replies_are_not_cached(self):
+        replies = [ErrorReply("upstream broken"), ["fine", ErrorReply("one broken")], "fine"]
+
+        def flaky(*args, **kwargs):
+            return replies.pop(0)
+
+        tree = Command(name="root")
+        tree.register(BlockingExecuteCommand(name="flaky", execute_command=flaky, cache_ttl=30))
+        self.assertEqual("upstream broken", tree.execute("flaky", command_args={}))
+        self.assertEqual(["fine", "one broken"], tree.execute("flaky", command_args={}))
+        self.assertEqual("fine", tree.execute("flaky", command_args={}))
+        self.assertEqual("fine", tree.execute("flaky", command_args={}))
+        self.assertEqual(0, len(replies))
+
+    def test_cache_stats_command(self):
+
+        command = ["quote", "get", "fakeprovider", "aapl"]
+        self.__cmd_wrap(*command)
+        self.__cmd_wrap(*command)
+        res = self.__cmd_wrap("cache", "stats")
+        self.assertIn("Command: quote get, Hits: 1, Misses: 1", res)
+
+    def test_stats_command(self):
+
+        self.__cmd_wrap("quote", "get", "fakeprovider", "aapl")
+        res = self.__cmd_wrap("stats")
+        self.assertRegex("\n".join(res), "Command: quote get, Count: [0-9]+, Errors: 0, In Flight: 0, p50 ms: [0-9]+, "
+                                          "p95 ms: [0-9]+, p99 ms: [0-9]+")
+
     def test_execute_scheduler_ticker_commands(self):
 
         # blank state
@@ -241,6 +395,14 @@ class TestCommand(unittest.TestCase):
         res = self.__cmd_wrap(*command)
         self.assertEqual("no hints found", res)
 
+    def test_quote_hints_invalidate_cached_quotes(self):
+        self.assertEqual("Here's your fake quote for apple", self.__cmd_wrap("quote", "get", "fakeprovider", "apple"))
+        self.__cmd_wrap("quote", "search", "fakeprovider", "apple")
+        self.assertEqual("Added hint", self.__cmd_wrap("quote", "hint", "add", "fakeprovider", "aapl", "apple"))
+        self.assertEqual("Here's your fake quote for aapl", self.__cmd_wrap("quote", "get", "fakeprovider", "apple"))
+        self.__cmd_wrap("quote", "search", "fakeprovider", "apple")
+        self.assertIn("Command: quote search, Hits: 1, Misses: 1", output_cache.result_as_list())
+
 
 class IntegrationTestCommand(unittest.TestCase):
 
@@ -1,7 +1,8 @@
 import unittest
 import os
+import tempfile
 
-from stockbot.configuration import Configuration
+from stockbot.configuration import Configuration, ConfigurationSnapshot
 from unittest.mock import patch
 
 
@@ -31,3 +32,39 @@ class TestConfiguration(unittest.TestCase):
 
     def test_get_empty_env_list(self):
         self.assertEqual([], Configuration().game_ignore_list)
+
+    def test_typed_values(self):
+        snapshot = ConfigurationSnapshot({'COMMAND_WORKERS': '8', 'HTTP_TIMEOUT_S': '2.5', 'SCHEDULER': 'TRUE'})
+        self.assertEqual(8, snapshot.command_workers)
+        self.assertEqual(2.5, snapshot.http_timeout_s)
+        self.assertEqual(True, snapshot.scheduler)
+        self.assertEqual(300, snapshot.ibindex_cache_ttl_s)
+
+    def test_invalid_typed_value(self):
+        with self.assertRaisesRegex(RuntimeError, "COMMAND_WORKERS must be of type int"):
+            ConfigurationSnapshot({'COMMAND_WORKERS': 'many'})
+
+    def test_snapshot_is_read_only(self):
+        with self.assertRaises(AttributeError):
+            ConfigurationSnapshot({}).scheduler = True
+
+    def test_reload(self):
+        sut = Configuration({'GAME_IGNORE_LIST': 'a'})
+        snapshot = sut.snapshot
+        self.assertEqual(["a"], sut.game_ignore_list)
+        sut.reload({'GAME_IGNORE_LIST': 'a,b'})
+        self.assertEqual(["a", "b"], sut.game_ignore_list)
+        self.assertEqual(["a"], snapshot.game_ignore_list)
+        with self.assertRaises(RuntimeError):
+            sut.reload({'COMMAND_WORKERS': 'many'})
+        self.assertEqual(["a", "b"], sut.game_ignore_list)
+
+    def test_config_file(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".env", delete=False) as f:
+            f.write("# ignored\nSHOULD_COLORIFY=false\n\nGAME_IGNORE_LIST = x,y\n")
+        try:
+            sut = Configuration({'CONFIG_FILE': f.name, 'SHOULD_COLORIFY': 'true'})
+            self.assertEqual(False, sut.should_colorify)
+            self.assertEqual(["x", "y"], sut.game_ignore_list)
+        finally:
+            os.remove(f.name)
@@ -0,0 +1,180 @@
+import threading
+import unittest
+
+from stockbot.command import root_command, BlockingExecuteCommand, NonBlockingExecuteCommand
+from stockbot import deadline
+from stockbot.executor import CommandExecutor, WorkerPool
+from stockbot.metrics import registry
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_rejects_when_queue_is_full(self):
+        release = threading.Event()
+        sut = WorkerPool(name="test", max_workers=1, max_queue_size=1)
+        self.assertTrue(sut.submit(release.wait))
+        while sut.active_workers() == 0:
+            pass
+        self.assertTrue(sut.submit(release.wait))
+        self.assertFalse(sut.submit(release.wait))
+        self.assertEqual(1, sut.queue_depth())
+        release.set()
+        sut.queue.join()
+        self.assertEqual(0, sut.active_workers())
+
+    def test_named_task_is_exclusive(self):
+        release = threading.Event()
+        sut = WorkerPool(name="test", max_workers=2, max_queue_size=2)
+        self.assertEqual(WorkerPool.STARTED, sut.submit_named("task-a", release.wait))
+        self.assertEqual(WorkerPool.RUNNING, sut.submit_named("task-a", release.wait))
+        self.assertEqual(WorkerPool.STARTED, sut.submit_named("task-a", release.wait, exclusive=False))
+        self.assertEqual(["task-a"], sut.in_flight_tasks())
+        release.set()
+        sut.queue.join()
+        self.assertEqual([], sut.in_flight_tasks())
+
+    def test_named_task_saturation_policy(self):
+        release = threading.Event()
+        sut = WorkerPool(name="test", max_workers=1, max_queue_size=2)
+        self.assertEqual(WorkerPool.STARTED, sut.submit_named("task-a", release.wait))
+        self.assertEqual(WorkerPool.REJECTED, sut.submit_named("task-b", release.wait, policy=WorkerPool.REJECT))
+        self.assertEqual(WorkerPool.STARTED, sut.submit_named("task-b", release.wait, policy=WorkerPool.QUEUE))
+        release.set()
+        sut.queue.join()
+
+
+class TestNonBlockingExecuteCommand(unittest.TestCase):
+
+    def test_exclusive_command(self):
+        release = threading.Event()
+        results = []
+        command = NonBlockingExecuteCommand(name="slow", execute_command=lambda *args, **kwargs: release.wait(),
+                                           return_prompts=True, pool=WorkerPool(name="test", max_workers=2))
+        self.assertEqual("Task started", command.execute("a", command_args={}))
+        self.assertEqual("Task is currently running, hold your horses", command.execute("a", command_args={}))
+        command.execute("b", command_args={}, callback=lambda r, **kw: results.append(r))
+        release.set()
+        command.pool.queue.join()
+        self.assertEqual(["Task started", True], results)
+
+    def test_inline(self):
+        results = []
+        command = NonBlockingExecuteCommand(name="inline", pool=WorkerPool(name="test", max_workers=1),
+                                            execute_command=lambda *args, **kwargs: threading.current_thread().name)
+        command.execute("a", command_args={}, callback=lambda r, **kw: results.append(r), inline=True)
+        self.assertEqual([threading.current_thread().name], results)
+        self.assertEqual([], command.pool.threads)
+
+
+class TestCommandExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.results = []
+        self.sut = CommandExecutor(max_workers=2, max_queue_size=2, timeout=10, clock=self.clock)
+
+    def callback(self, result, **kwargs):
+        self.results.append((threading.current_thread().name, result, kwargs))
+
+    def test_callback_runs_on_calling_thread(self):
+        self.sut.submit(lambda x: "result {}".format(x), ("a",), {}, self.callback, {"sender": "me"})
+        self.sut.pool.queue.join()
+        self.assertEqual([], self.results)
+        self.sut.run_pending_callbacks()
+        self.assertEqual([(threading.current_thread().name, "result a", {"sender": "me"})], self.results)
+        self.assertEqual(0, self.sut.in_flight())
+
+    def test_generator_is_consumed_by_worker(self):
+        def gen():
+            yield "row {}".format(threading.current_thread().name)
+        self.sut.submit(gen, (), {}, self.callback, {})
+        self.sut.pool.queue.join()
+        self.sut.run_pending_callbacks()
+        self.assertTrue(self.results[0][1][0].startswith("row command-"))
+
+    def test_timeout(self):
+        release = threading.Event()
+
+        def slow():
+            release.wait()
+            return "too late"
+
+        self.sut.submit(slow, (), {}, self.callback, {}, timeout=5)
+        self.clock.now = 6
+        self.sut.run_pending_callbacks()
+        self.assertEqual([CommandExecutor.timeout_message], [x[1] for x in self.results])
+        release.set()
+        self.sut.pool.queue.join()
+        self.sut.run_pending_callbacks()
+        self.assertEqual([CommandExecutor.timeout_message], [x[1] for x in self.results])
+
+    def test_failing_command(self):
+        self.sut.submit(lambda: 1 / 0, (), {}, self.callback, {})
+        self.sut.pool.queue.join()
+        self.sut.run_pending_callbacks()
+        self.assertEqual(["something failed"], [x[1] for x in self.results])
+
+    def test_blocking_command_with_executor(self):
+        root_command.execute("help", command_args={}, callback=self.callback, callback_args={}, executor=self.sut)
+        self.sut.pool.queue.join()
+        self.sut.run_pending_callbacks()
+        self.assertIn("quote (q) get <provider> <ticker>", self.results[0][1])
+
+    def test_blocking_command_timeout(self):
+        release = threading.Event()
+        command = BlockingExecuteCommand(name="slow", execute_command=lambda *args, **kwargs: release.wait(),
+                                         timeout=1)
+        command.execute(command_args={}, callback=self.callback, callback_args={}, executor=self.sut)
+        self.clock.now = 2
+        self.sut.run_pending_callbacks()
+        release.set()
+        self.assertEqual([CommandExecutor.timeout_message], [x[1] for x in self.results])
+
+    def test_deadline_is_propagated_to_worker(self):
+        with deadline.within(5):
+            self.sut.submit(deadline.remaining, (), {}, self.callback, {})
+        self.sut.pool.queue.join()
+        self.sut.run_pending_callbacks()
+        self.assertTrue(0 < self.results[0][1] <= 5)
+
+    def test_deadline_exceeded(self):
+        registry.reset()
+        command = BlockingExecuteCommand(name="expired", execute_command=lambda *args, **kwargs: deadline.check())
+        with deadline.within(-1):
+            command.execute(command_args={}, callback=self.callback, callback_args={}, executor=self.sut)
+            self.sut.pool.queue.join()
+            self.sut.run_pending_callbacks()
+            self.assertEqual([CommandExecutor.timeout_message], [x[1] for x in self.results])
+            self.assertEqual(CommandExecutor.timeout_message, command.execute(command_args={}))
+        self.assertEqual(2, registry.counter("stockbot_command_timeouts_total", {"command": command.path()}))
+
+    def test_deadline_exceeded_caught_by_command(self):
+        def swallowing(*args, **kwargs):
+            try:
+                deadline.check()
+            except Exception:
+                return "broken"
+
+        command = BlockingExecuteCommand(name="swallowing", execute_command=swallowing)
+        with deadline.within(-1):
+            self.assertEqual(CommandExecutor.timeout_message, command.execute(command_args={}))
+
+    def test_command_timeout_is_its_deadline(self):
+        def remaining(*args, **kwargs):
+            return deadline.remaining()
+
+        slow = BlockingExecuteCommand(name="slow", execute_command=remaining, timeout=60)
+        self.assertTrue(30 < slow.execute(command_args={}) <= 60)
+        quick = BlockingExecuteCommand(name="quick", execute_command=remaining, timeout=5)
+        self.assertTrue(0 < quick.execute(command_args={}) <= 5)
+        default = BlockingExecuteCommand(name="default", execute_command=remaining)
+        self.assertTrue(5 < default.execute(command_args={}) <= 30)
@@ -0,0 +1,105 @@
+import time
+import unittest
+from unittest.mock import patch
+
+from stockbot import deadline, http
+from stockbot.metrics import registry
+from stockbot.ratelimit import UpstreamLimiter
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, content=b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+
+class FakeSession(object):
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class TestHttp(unittest.TestCase):
+
+    def setUp(self):
+        registry.reset()
+
+    def tearDown(self):
+        registry.reset()
+
+    def test_records_status_bytes_and_latency(self):
+        session = FakeSession(FakeResponse(200, b"12345"), FakeResponse(404, b"1"))
+        http.get("https://example.com/v1/quote", endpoint="quote", session=session, params={"a": "b"})
+        http.get("https://example.com/v1/quote", endpoint="quote", session=session)
+        labels = {"host": "example.com", "endpoint": "quote"}
+        self.assertEqual(("GET", "https://example.com/v1/quote", {"params": {"a": "b"}, "timeout": 10.0}),
+                         session.requests[0])
+        self.assertEqual(1, registry.counter("stockbot_http_responses_total", {**labels, "status": "200"}))
+        self.assertEqual(1, registry.counter("stockbot_http_responses_total", {**labels, "status": "404"}))
+        self.assertEqual(6, registry.counter("stockbot_http_response_bytes_total", labels))
+        self.assertEqual(2, registry.histogram("stockbot_http_duration_seconds", labels).count)
+
+    def test_records_errors(self):
+        session = FakeSession(ConnectionError("nope"))
+        with self.assertRaises(ConnectionError):
+            http.post("https://example.com/products", session=session)
+        labels = {"host": "example.com", "endpoint": "/products"}
+        self.assertEqual(1, registry.counter("stockbot_http_errors_total", {**labels, "error": "ConnectionError"}))
+        self.assertEqual(1, registry.histogram("stockbot_http_duration_seconds", labels).count)
+
+    def test_result_as_list(self):
+        self.assertEqual([], http.result_as_list())
+        session = FakeSession(FakeResponse(401), FakeResponse(200, b"12"))
+        http.get("https://example.com/quote", endpoint="quote", session=session)
+        http.record_retry("https://example.com/quote", endpoint="quote", reason="401")
+        http.get("https://example.com/quote", endpoint="quote", session=session)
+        result = http.result_as_list()
+        self.assertEqual(1, len(result))
+        self.assertTrue(result[0].startswith("Upstream: example.com quote, Requests: 2, Statuses: 200x1 401x1, "
+                                             "Errors: 0, Retries: 1, Bytes: 2, "), result[0])
+        self.assertEqual([], http.result_as_list(hosts=["query2.finance.yahoo.com"]))
+        self.assertEqual(result, http.result_as_list(hosts=["example.com"]))
+
+    def test_timeout_is_capped_by_deadline(self):
+        session = FakeSession(FakeResponse(200))
+        with deadline.within(2):
+            http.get("https://example.com/quote", session=session)
+        self.assertLessEqual(session.requests[0][2]["timeout"], 2)
+
+    def test_expired_deadline(self):
+        session = FakeSession(FakeResponse(200), TimeoutError("slow"))
+        with deadline.within(-1):
+            with self.assertRaises(deadline.DeadlineExceeded):
+                http.get("https://example.com/quote", session=session)
+        self.assertEqual([], session.requests)
+        with deadline.within(1):
+            session.responses.pop(0)
+            with patch.object(deadline, "expired", return_value=True), \
+                    self.assertRaises(deadline.DeadlineExceeded):
+                http.get("https://example.com/quote", session=session)
+
+    def test_too_many_requests_backs_off(self):
+        limiter = UpstreamLimiter(name="test")
+        session = FakeSession(FakeResponse(429, headers={"Retry-After": "120"}))
+        self.assertEqual(429, http.get("https://example.com/quote", session=session, limiter=limiter).status_code)
+        self.assertGreater(limiter.blocked_until - time.monotonic(), 100)
+        self.assertEqual(0, limiter.in_flight)
+        with deadline.within(1):
+            with self.assertRaises(deadline.DeadlineExceeded):
+                http.get("https://example.com/quote", session=session, limiter=limiter)
+
+    def test_retry_after(self):
+        self.assertEqual(5, http.retry_after(FakeResponse(429), 5))
+        self.assertEqual(7, http.retry_after(FakeResponse(429, headers={"Retry-After": "7"}), 5))
+        past = FakeResponse(429, headers={"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})
+        self.assertEqual(0, http.retry_after(past, 5))
@@ -0,0 +1,53 @@
+import unittest
+
+from stockbot import lines, render
+from stockbot.util import ColorHelper
+
+
+class Row(object):
+
+    def __init__(self, fields):
+        self.fields = fields
+
+
+class TestLines(unittest.TestCase):
+
+    def test_byte_budget(self):
+        self.assertEqual(512 - len("PRIVMSG #chan :\r\n"), lines.byte_budget("PRIVMSG", "#chan"))
+
+    def test_cut_keeps_characters_whole(self):
+        self.assertEqual("åä", lines.cut("åäö", 5))
+        self.assertEqual("åäö", lines.cut("åäö", 6))
+
+    def test_short_rows_are_packed(self):
+        rows = ["quote get <provider> <ticker>", "quote search <provider> <text>", "x" * 40]
+        self.assertEqual(["quote get <provider> <ticker> | quote search <provider> <text>", "x" * 40],
+                         lines.pack(rows, 70, colored=False))
+
+    def test_long_row_is_split_on_fields(self):
+        row = Row([["Name", "Åbo Aktie", render.TITLE], ["Price", 1.5, render.NUMBER],
+                   ["Chart", "https://example.com/" + "x" * 30, render.URL]])
+        result = lines.pack([row], 70)
+        self.assertEqual([render.irc(row.fields[:2]), render.irc(row.fields[2:])], result)
+        self.assertTrue(all(lines.utf8_len(x) <= 70 for x in result))
+
+    def test_long_string_is_split_on_sections(self):
+        row = "Name: Ölands Bank, Price: 12.5, Market: se"
+        self.assertEqual(["Name: Ölands Bank, Price: 12.5", "Market: se"], lines.pack([row], 33, colored=False))
+
+    def test_too_long_field_is_cut_without_colors(self):
+        row = Row([["Name", "ö" * 100, render.TITLE]])
+        result = lines.pack([row], 51)
+        self.assertEqual(["Name: " + "ö" * 22], result)
+        self.assertNotIn("\x03", result[0])
+
+    def test_colored_rows_fit_budget(self):
+        rows = ["Name: Volvo, Price: 1.0"] * 30
+        budget = lines.byte_budget("PRIVMSG", "#stockbot")
+        result = lines.pack(rows, budget)
+        self.assertTrue(all(lines.utf8_len(x) <= budget for x in result))
+        self.assertIn(ColorHelper.purple("Name"), result[0])
+        self.assertLess(len(result), 30)
+
+    def test_empty_rows_are_skipped(self):
+        self.assertEqual(["a | b"], lines.pack(["a", "", "b"], 100, colored=False))
@@ -0,0 +1,100 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from stockbot.metrics import Histogram, MetricsRegistry, registry, timed
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_percentile(self):
+        sut = Histogram()
+        self.assertIsNone(sut.percentile(50))
+        for i in range(1, 101):
+            sut.observe(i / 100.0)
+        self.assertEqual(0.5, sut.percentile(50))
+        self.assertEqual(0.95, sut.percentile(95))
+        self.assertEqual(0.99, sut.percentile(99))
+        self.assertEqual(100, sut.count)
+
+    def test_cumulative_buckets(self):
+        sut = Histogram()
+        sut.observe(0.001)
+        sut.observe(0.2)
+        sut.observe(100)
+        buckets = dict(sut.cumulative_buckets())
+        self.assertEqual(1, buckets["0.005"])
+        self.assertEqual(2, buckets["0.25"])
+        self.assertEqual(3, buckets["+Inf"])
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def test_export_text(self):
+        sut = MetricsRegistry()
+        sut.inc("requests_total", {"host": "example.com"})
+        sut.inc("requests_total", {"host": "example.com"})
+        sut.set_gauge("queue_depth", value=3)
+        sut.observe("duration_seconds", {"command": 'say "hi"'}, 0.2)
+        sut.register_collector(lambda: [("pool_active", {"pool": "task"}, 1)])
+        text = sut.export_text()
+        self.assertIn("# TYPE requests_total counter\nrequests_total{host=\"example.com\"} 2\n", text)
+        self.assertIn("queue_depth 3\n", text)
+        self.assertIn("# TYPE pool_active gauge\npool_active{pool=\"task\"} 1\n", text)
+        self.assertIn("# TYPE duration_seconds histogram\n", text)
+        self.assertIn('duration_seconds_bucket{command="say \\"hi\\"",le="0.25"} 1\n', text)
+        self.assertIn('duration_seconds_count{command="say \\"hi\\""} 1\n', text)
+
+    def test_percentiles_while_observing(self):
+        sut = MetricsRegistry()
+        self.assertEqual([None, None], sut.percentiles("duration_seconds", ps=(50, 95)))
+        stop = threading.Event()
+
+        def observe():
+            while not stop.is_set():
+                sut.observe("duration_seconds", value=0.1)
+
+        thread = threading.Thread(target=observe)
+        thread.start()
+        try:
+            for _ in range(200):
+                sut.percentiles("duration_seconds", ps=(50, 95))
+        finally:
+            stop.set()
+            thread.join()
+        self.assertEqual([0.1, 0.1], sut.percentiles("duration_seconds", ps=(50, 95)))
+
+    def test_write(self):
+        sut = MetricsRegistry()
+        sut.inc("requests_total")
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "metrics.prom")
+            sut.write(path)
+            with open(path) as f:
+                self.assertIn("requests_total 1", f.read())
+
+    def test_failing_collector_is_skipped(self):
+        sut = MetricsRegistry()
+        sut.register_collector(lambda: 1 / 0)
+        sut.inc("requests_total")
+        self.assertIn("requests_total 1", sut.export_text())
+
+
+class TestTimed(unittest.TestCase):
+
+    def test_records_latency_and_errors(self):
+        labels = {"command": "test timed"}
+
+        def fail():
+            raise RuntimeError("broken")
+
+        def gen():
+            yield "row"
+
+        self.assertEqual(["row"], timed("test timed", gen)())
+        with self.assertRaises(RuntimeError):
+            timed("test timed", fail)()
+        self.assertEqual(2, registry.histogram("stockbot_command_duration_seconds", labels).count)
+        self.assertEqual(1, registry.counter("stockbot_command_errors_total", labels))
+        self.assertEqual(0, registry.gauge("stockbot_command_in_flight", labels))
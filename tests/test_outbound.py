@@ -0,0 +1,60 @@
+import unittest
+
+from stockbot.outbound import OutboundQueue
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestOutboundQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.sent = []
+        self.sut = OutboundQueue(rate=1, burst=2, clock=self.clock)
+
+    def send(self, target, msg):
+        self.sent.append((target, msg))
+
+    def test_drain_is_paced(self):
+        for i in range(4):
+            self.sut.put("#chan", "row {}".format(i))
+        self.assertEqual(2, self.sut.drain(self.send))
+        self.assertEqual(0, self.sut.drain(self.send))
+        self.clock.now = 1.0
+        self.assertEqual(1, self.sut.drain(self.send))
+        self.assertEqual([("#chan", "row 0"), ("#chan", "row 1"), ("#chan", "row 2")], self.sent)
+        self.assertEqual(1, len(self.sut))
+
+    def test_drain_round_robin_between_targets(self):
+        self.sut = OutboundQueue(rate=1, burst=4, clock=self.clock)
+        for i in range(3):
+            self.sut.put("#chan", "row {}".format(i))
+        self.sut.put("someone", "private row")
+        self.sut.drain(self.send)
+        self.assertEqual([("#chan", "row 0"), ("someone", "private row"), ("#chan", "row 1"), ("#chan", "row 2")],
+                         self.sent)
+
+    def test_drain_keeps_tokens_when_idle(self):
+        self.assertEqual(0, self.sut.drain(self.send))
+        self.sut.put("#chan", "row")
+        self.sut.put("#chan", "row")
+        self.assertEqual(2, self.sut.drain(self.send))
+
+    def test_full_queue_drops_message(self):
+        self.sut = OutboundQueue(rate=1, burst=2, max_queue_size=1, clock=self.clock)
+        self.assertTrue(self.sut.put("#chan", "row 0"))
+        self.assertFalse(self.sut.put("#chan", "row 1"))
+
+    def test_send_failure_is_not_fatal(self):
+        def broken_send(target, msg):
+            raise ValueError("Message is too long")
+        self.sut.put("#chan", "row 0")
+        self.sut.put("#chan", "row 1")
+        self.assertEqual(2, self.sut.drain(broken_send))
@@ -1,10 +1,24 @@
 import os
+import threading
+import time
 import unittest
 import vcr
+from datetime import datetime
+from stockbot import deadline
+from stockbot.cache import TTLCache
+from stockbot.db import Session, create_tables, drop_tables
+from stockbot.deadline import DeadlineExceeded
 from stockbot.persistence import DatabaseCollection, ScheduledCommand
 from stockbot.provider import QuoteServiceFactory
-from stockbot.provider.ibindex import IbIndexQueryService
-from stockbot.provider.yahoo import YahooQueryService
+from stockbot.provider.ibindex import IbIndexQueryService, IbIndexProductSnapshot, IbIndexProductIndex, \
+    product_snapshot
+from unittest.mock import Mock, patch
+from stockbot.circuit import CircuitBreaker, CircuitOpen
+from stockbot.configuration import configuration, ConfigurationSnapshot
+from stockbot.provider.base import quote_cache, last_good_quotes, SingleFlight, StaleQuote
+from stockbot.provider.session import SessionPool
+from stockbot.provider.yahoo import YahooQueryService, YahooSearchResult, YahooFallbackQuote, YahooQuote, \
+    YahooCredentials
 
 CWD = os.path.dirname(os.path.realpath(__file__))
 
@@ -26,10 +40,149 @@ class TestQuoteServiceFactory(unittest.TestCase):
         factory = QuoteServiceFactory()
         self.assertEqual(YahooQueryService, type(factory.get_service("yahoo")))
 
+    def test_provider_is_built_once(self):
+        built = []
+
+        class SlowService(object):
+            def __init__(self):
+                built.append(self)
+                time.sleep(0.05)
+
+        factory = QuoteServiceFactory()
+        factory.providers = {"slow": SlowService}
+        services = []
+        threads = [threading.Thread(target=lambda: services.append(factory.get_service("slow"))) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(1, len(built))
+        self.assertTrue(all(x is built[0] for x in services))
+
+    def test_unknown_provider(self):
+        with self.assertRaises(ValueError):
+            QuoteServiceFactory().get_service("nope")
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def run_concurrently(self, func, num_threads=5):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(func())) for _ in range(num_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_concurrent_calls_share_result(self):
+        sut = SingleFlight()
+        calls = []
+
+        def slow_quote(ticker):
+            calls.append(ticker)
+            time.sleep(0.1)
+            return "quote for {}".format(ticker)
+
+        results = self.run_concurrently(lambda: sut.do(("fake", "aapl"), slow_quote, "aapl"))
+        self.assertEqual(["aapl"], calls)
+        self.assertEqual(["quote for aapl"] * 5, results)
+        self.assertEqual(4, sut.coalesced["fake"])
+        self.assertEqual({}, sut.calls)
+
+    def test_concurrent_calls_share_exception(self):
+        sut = SingleFlight()
+
+        def slow_failure():
+            time.sleep(0.1)
+            raise RuntimeError("upstream broke")
+
+        def call():
+            try:
+                return sut.do(("fake", "aapl"), slow_failure)
+            except RuntimeError as e:
+                return str(e)
+
+        self.assertEqual(["upstream broke"] * 5, self.run_concurrently(call))
+
+    def test_followers_raise_their_own_exception(self):
+        sut = SingleFlight()
+        raised = []
+
+        def slow_failure():
+            time.sleep(0.1)
+            raise CircuitOpen("fake")
+
+        def call():
+            try:
+                return sut.do(("fake", "aapl"), slow_failure)
+            except CircuitOpen as e:
+                raised.append(e)
+                return str(e)
+
+        self.assertEqual([str(CircuitOpen("fake"))] * 5, self.run_concurrently(call))
+        self.assertEqual(5, len(set(id(x) for x in raised)))
+
+    def test_follower_waits_no_longer_than_its_deadline(self):
+        sut = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_quote():
+            started.set()
+            release.wait(5)
+            return "quote"
+
+        leader = threading.Thread(target=lambda: sut.do(("fake", "aapl"), slow_quote))
+        leader.start()
+        started.wait(5)
+        try:
+            with deadline.within(0.05):
+                with self.assertRaises(DeadlineExceeded):
+                    sut.do(("fake", "aapl"), slow_quote)
+        finally:
+            release.set()
+            leader.join()
+
+    def test_follower_retries_when_leader_ran_out_of_time(self):
+        sut = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def quote():
+            calls.append(1)
+            if len(calls) == 1:
+                started.set()
+                release.wait(5)
+                raise DeadlineExceeded()
+            return "quote"
+
+        def leader():
+            try:
+                sut.do(("fake", "aapl"), quote)
+            except DeadlineExceeded:
+                pass
+
+        thread = threading.Thread(target=leader)
+        thread.start()
+        started.wait(5)
+        follower = []
+        follower_thread = threading.Thread(target=lambda: follower.append(sut.do(("fake", "aapl"), quote)))
+        follower_thread.start()
+        while sut.coalesced["fake"] == 0:
+            time.sleep(0.01)
+        release.set()
+        thread.join()
+        follower_thread.join()
+        self.assertEqual(["quote"], follower)
+        self.assertEqual(2, len(calls))
+
 
 class TestIbIndexQueryService(unittest.TestCase):
 
     def setUp(self):
+        product_snapshot.invalidate()
         self.service = IbIndexQueryService()
 
     @vcr.use_cassette('mock/vcr_cassettes/ibindex/quote/all.yaml')
@@ -43,6 +196,7 @@ class TestIbIndexQueryService(unittest.TestCase):
         text = "abcdefghijlkmnop"
         result = self.service.search(text)
         self.assertEqual("Result: Nada", str(result))
+        self.assertIsNone(result.get_ranked_ticker())
 
     @vcr.use_cassette('mock/vcr_cassettes/ibindex/quote/all.yaml')
     def test_search_with_multiple_matches(self):
@@ -71,6 +225,114 @@ class TestIbIndexQueryService(unittest.TestCase):
         self.assertEqual("No such quote: abcdefghijklmnop", str(result))
 
 
+class TestIbIndexProductSnapshot(unittest.TestCase):
+
+    @vcr.use_cassette('mock/vcr_cassettes/ibindex/quote/all.yaml')
+    def test_search_and_quote_share_snapshot(self):
+        snapshot = IbIndexProductSnapshot(ttl=300, max_stale=3600)
+        service = IbIndexQueryService(snapshot=snapshot)
+        with patch.object(snapshot, "refresh", wraps=snapshot.refresh) as refresh:
+            ticker = service.search("investor").get_ranked_ticker()
+            service.get_quote(ticker)
+            self.assertEqual(1, refresh.call_count)
+
+    @vcr.use_cassette('mock/vcr_cassettes/ibindex/quote/all.yaml')
+    def test_expired_snapshot_is_served_while_refreshing(self):
+        snapshot = IbIndexProductSnapshot(ttl=300, max_stale=3600)
+        index = snapshot.get_index()
+        snapshot.fetched_at -= 301
+        with patch.object(snapshot, "refresh_in_background") as refresh_in_background:
+            self.assertIs(index, snapshot.get_index())
+            refresh_in_background.assert_called_once()
+
+    def test_too_old_snapshot_is_refreshed_in_place(self):
+        snapshot = IbIndexProductSnapshot(ttl=300, max_stale=3600)
+        snapshot.index = IbIndexProductIndex([{"product": "OLD", "productName": "Old"}])
+        snapshot.fetched_at = time.monotonic() - 3601
+        new_index = IbIndexProductIndex([{"product": "NEW", "productName": "New"}])
+        with patch.object(snapshot, "refresh", return_value=new_index) as refresh:
+            self.assertIs(new_index, snapshot.get_index())
+            refresh.assert_called_once()
+
+    def test_concurrent_cold_start_fetches_once(self):
+        snapshot = IbIndexProductSnapshot(ttl=300, max_stale=3600)
+        response = Mock()
+        response.json.return_value = [{"product": "INVE B", "productName": "Investor B"}]
+
+        def slow_post(*args, **kwargs):
+            time.sleep(0.1)
+            return response
+
+        with patch("stockbot.provider.ibindex.http.post", side_effect=slow_post) as post:
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(snapshot.get_index())) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(1, post.call_count)
+        self.assertEqual(5, len(results))
+        self.assertTrue(all(index is results[0] for index in results))
+
+
+class TestIbIndexProductIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = IbIndexProductIndex([
+            {"product": "HAV B", "productName": "Havsfrun Investment B"},
+            {"product": "INVE B", "productName": "Investor B"},
+            {"product": "NAXS", "productName": "NAXS"},
+        ])
+
+    def test_get_by_product(self):
+        self.assertEqual("Investor B", self.index.get("inve b")["productName"])
+        self.assertIsNone(self.index.get("inve"))
+
+    def test_search_substring(self):
+        self.assertEqual(["HAV B", "INVE B"], [x["product"] for x in self.index.search("Invest")])
+        self.assertEqual(["INVE B"], [x["product"] for x in self.index.search("tor b")])
+        self.assertEqual([], [x["product"] for x in self.index.search("investx")])
+
+    def test_search_short_query(self):
+        self.assertEqual(["NAXS"], [x["product"] for x in self.index.search("xs")])
+        self.assertEqual(["HAV B", "INVE B"], [x["product"] for x in self.index.search("v")])
+
+    def test_search_exact_product(self):
+        self.assertEqual(["INVE B"], [x["product"] for x in self.index.search("INVE B")])
+
+
+class TestStaleQuoteFallback(unittest.TestCase):
+
+    def setUp(self):
+        last_good_quotes.clear()
+        self.snapshot = IbIndexProductSnapshot(ttl=300, max_stale=3600)
+        self.snapshot.index = IbIndexProductIndex([{
+            "product": "INVE B", "productName": "Investor B", "netAssetValueRebatePremium": 1.0,
+            "netAssetValueCalculatedRebatePremium": 2.0, "netAssetValueChangeDate": 1600000000000
+        }])
+        self.snapshot.fetched_at = time.monotonic()
+        self.service = IbIndexQueryService(snapshot=self.snapshot)
+        self.service.breaker = CircuitBreaker(name="ibindex", failure_threshold=1, reset_timeout=30)
+
+    def test_serves_last_good_quote_when_provider_fails(self):
+        self.assertEqual("Investor B", self.service.get_quote("INVE B").name)
+        with patch.object(self.snapshot, "get_index", side_effect=ConnectionError("down")) as get_index:
+            quote = self.service.get_quote("INVE B")
+            self.assertIsInstance(quote, StaleQuote)
+            self.assertEqual("Investor B", quote.name)
+            self.assertIn("Stale: 0 minutes old", str(quote))
+            # the circuit is open now, the provider isn't asked again
+            self.assertIsInstance(self.service.get_quote("INVE B"), StaleQuote)
+            self.assertEqual(1, get_index.call_count)
+
+    def test_open_circuit_without_last_good_quote(self):
+        with patch.object(self.snapshot, "get_index", side_effect=ConnectionError("down")):
+            with self.assertRaises(ConnectionError):
+                self.service.get_quote("INVE B")
+            with self.assertRaises(CircuitOpen):
+                self.service.get_quote("INVE B")
+
+
 class TestYahooQueryService(unittest.TestCase):
 
     def setUp(self):
@@ -103,3 +365,252 @@ class TestYahooQueryService(unittest.TestCase):
         text = "investor ab"
         result = self.service.get_quote(text)
         self.assertRegexpMatches(str(result), "^Name: Investor AB ser. B, Price: [0-9\.]+, Low Price: [0-9\.]+, High Price: [0-9\.]+, Percent Change 1 Day: [0-9\.\-]+, Market: se_market, Chart: https://finance.yahoo.com/chart/INVE-B.ST, Update Time: [0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}")
+
+
+class TestYahooQueryServiceBatch(unittest.TestCase):
+
+    class FakeResponse(object):
+
+        def __init__(self, o, status_code=200):
+            self.o = o
+            self.status_code = status_code
+
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return self.o
+
+    def setUp(self):
+        quote_cache.clear()
+
+    def test_get_quotes_in_one_request(self):
+        service = YahooQueryService()
+        searches = {
+            "volvo": {"quotes": [{"symbol": "VOLV-B.ST"}]},
+            "volvo b": {"quotes": [{"symbol": "VOLV-B.ST"}]},
+            "ericsson": {"quotes": [{"symbol": "ERIC-B.ST"}]},
+            "nothing": {"quotes": []}
+        }
+        quotes = {"quoteResponse": {"result": [
+            {"symbol": "VOLV-B.ST", "shortName": "Volvo B", "regularMarketTime": 1600000000, "marketState": "REGULAR"},
+            {"symbol": "ERIC-B.ST", "shortName": "Ericsson B", "regularMarketTime": 1600000000,
+             "marketState": "CLOSED"}
+        ], "error": None}}
+        with patch.object(service, "search", side_effect=lambda q: YahooSearchResult(searches[q], q)), \
+                patch.object(service, "_get_with_cookie_refresh",
+                             return_value=self.FakeResponse(quotes)) as get:
+            result = service.get_quotes(["volvo", "ericsson", "nothing", "volvo b"])
+            get.assert_called_once()
+            self.assertEqual("VOLV-B.ST,ERIC-B.ST", get.call_args.kwargs["params"]["symbols"])
+        self.assertEqual(["Volvo B", "Ericsson B"], [result[0].shortName, result[1].shortName])
+        self.assertIsInstance(result[2], YahooFallbackQuote)
+        self.assertEqual("Volvo B", result[3].shortName)
+
+    def fake_upstream(self, down=False):
+        def get(url, params={}, endpoint=None):
+            if down:
+                raise ConnectionError("down")
+            if endpoint == "search":
+                return self.FakeResponse({"quotes": [{"symbol": params["q"].upper()}]})
+            return self.FakeResponse({"quoteResponse": {"result": [
+                {"symbol": x, "shortName": x, "regularMarketTime": 1600000000, "marketState": "CLOSED"}
+                for x in params["symbols"].split(",")], "error": None}})
+        return get
+
+    def test_half_open_probe_with_several_tickers(self):
+        service = YahooQueryService()
+        now = [0.0]
+        service.breaker = CircuitBreaker(name="yahoo", failure_threshold=1, reset_timeout=30, clock=lambda: now[0])
+        service.breaker.record_failure()
+        now[0] = 31.0
+        with patch.object(service, "_get_with_cookie_refresh", side_effect=self.fake_upstream()):
+            result = service.get_quotes(["half open probe a", "half open probe b"])
+        self.assertEqual(["HALF OPEN PROBE A", "HALF OPEN PROBE B"], [x.shortName for x in result])
+        self.assertEqual(CircuitBreaker.CLOSED, service.breaker.state)
+
+    def test_failing_get_quotes_counts_once(self):
+        service = YahooQueryService()
+        service.breaker = CircuitBreaker(name="yahoo", failure_threshold=5)
+        with patch.object(service, "_get_with_cookie_refresh", side_effect=self.fake_upstream(down=True)):
+            with self.assertRaises(ConnectionError):
+                service.get_quotes(["counted once a", "counted once b", "counted once c"])
+        self.assertEqual(1, service.breaker.failures)
+
+    def test_resolve_symbols_concurrently(self):
+        service = YahooQueryService()
+        barrier = threading.Barrier(3, timeout=5)
+        searches = []
+
+        def search(query):
+            searches.append(query)
+            # only returns when all three searches run at the same time
+            barrier.wait()
+            return YahooSearchResult({"quotes": [{"symbol": query.upper()}]} if query != "nothing" else {"quotes": []},
+                                     query)
+
+        with patch.object(configuration, "snapshot", ConfigurationSnapshot({"QUOTE_FANOUT": "4"})), \
+                patch.object(service, "search", side_effect=search):
+            self.assertEqual(["VOLVO", None, "ERIC", "VOLVO"],
+                             service.resolve_symbols(["volvo", "nothing", "eric", "volvo"]))
+        self.assertEqual(3, len(searches))
+
+    def test_get_quote_uses_quote_endpoint(self):
+        service = YahooQueryService()
+        quotes = {"quoteResponse": {"result": [
+            {"symbol": "VOLV-B.ST", "shortName": "Volvo B", "regularMarketTime": 1600000000, "marketState": "REGULAR"}
+        ], "error": None}}
+        with patch.object(service, "search", return_value=YahooSearchResult({"quotes": [{"symbol": "VOLV-B.ST"}]},
+                                                                            "volvo")), \
+                patch.object(service, "_get_with_cookie_refresh", return_value=self.FakeResponse(quotes)) as get:
+            self.assertEqual("Volvo B", service.get_quote("volvo").shortName)
+            get.assert_called_once()
+            self.assertEqual("quote", get.call_args.kwargs["endpoint"])
+            self.assertIn("regularMarketPrice", get.call_args.kwargs["params"]["fields"])
+
+    def test_get_quote_falls_back_to_options_endpoint(self):
+        service = YahooQueryService()
+        empty = {"quoteResponse": {"result": [], "error": None}}
+        options = {"optionChain": {"result": [{"quote": {
+            "symbol": "VOLV-B.ST", "shortName": "Volvo B", "regularMarketTime": 1600000000, "marketState": "REGULAR"
+        }}]}}
+        with patch.object(service, "search", return_value=YahooSearchResult({"quotes": [{"symbol": "VOLV-B.ST"}]},
+                                                                            "volvo")), \
+                patch.object(service, "_get_with_cookie_refresh",
+                             side_effect=[self.FakeResponse(empty), self.FakeResponse(options)]) as get:
+            self.assertEqual("Volvo B", service.get_quote("volvo").shortName)
+            self.assertEqual("options", get.call_args.kwargs["endpoint"])
+
+    def test_search_caches_ranked_symbols(self):
+        service = YahooQueryService()
+        service.search_cache = TTLCache(max_size=10, ttl=60)
+        response = {"quotes": [{"symbol": "VOLV-A.ST", "score": 1}, {"symbol": "VOLV-B.ST", "score": 2}]}
+        with patch.object(service, "_get_with_cookie_refresh", return_value=self.FakeResponse(response)) as get:
+            self.assertEqual(["VOLV-B.ST", "VOLV-A.ST"], service.search("volvo").get_tickers())
+            self.assertEqual(["VOLV-B.ST", "VOLV-A.ST"], service.search("volvo").get_tickers())
+            get.assert_called_once()
+        self.assertEqual(("VOLV-B.ST", "VOLV-A.ST"), service.search_cache.get("volvo"))
+
+    def test_get_quote_is_cached_while_market_is_open(self):
+        service = YahooQueryService()
+        quotes = {"quoteResponse": {"result": [
+            {"symbol": "VOLV-B.ST", "shortName": "Volvo B", "regularMarketTime": 1600000000, "marketState": "REGULAR"}
+        ], "error": None}}
+        with patch.object(service, "search", return_value=YahooSearchResult(query="volvo", symbols=["VOLV-B.ST"])), \
+                patch.object(service, "_get_with_cookie_refresh", return_value=self.FakeResponse(quotes)) as get:
+            quote = service.get_quote("volvo")
+            self.assertIs(quote, service.get_quote("volvo"))
+            self.assertIsNot(quote, service.get_quote("volvo", use_cache=False))
+            self.assertEqual(2, get.call_count)
+
+    def test_quote_cache_ttl(self):
+        with patch.object(configuration, "snapshot", ConfigurationSnapshot({"QUOTE_CACHE_TTL_OPEN_S": "15",
+                                                                             "QUOTE_CACHE_TTL_CLOSED_S": "900"})):
+            self.assertEqual(15, YahooQuote({"regularMarketTime": 1600000000, "marketState": "PRE"}).cache_ttl())
+            self.assertEqual(900, YahooQuote({"regularMarketTime": 1600000000, "marketState": "CLOSED"}).cache_ttl())
+            self.assertEqual(15, YahooQuote({"regularMarketTime": int(time.time()),
+                                             "marketState": "POST"}).cache_ttl())
+
+    def test_closed_quote_is_cached_until_next_session(self):
+        def closed_quote(at):
+            return YahooQuote({"regularMarketTime": int(at.timestamp()), "marketState": "CLOSED"})
+
+        with patch.object(configuration, "snapshot", ConfigurationSnapshot({"QUOTE_CACHE_TTL_CLOSED_S": "900",
+                                                                             "QUOTE_CACHE_TTL_CLOSED_MAX_S": "86400"})):
+            # closed Wednesday 17:30, opens again Thursday 05:30 at the earliest
+            quote = closed_quote(datetime(2024, 6, 5, 17, 30))
+            self.assertEqual(datetime(2024, 6, 6, 5, 30), quote.next_session())
+            self.assertEqual(10 * 3600, quote.cache_ttl(now=datetime(2024, 6, 5, 19, 30)))
+            # closed Friday, nothing happens until Monday but that is longer than the cap
+            quote = closed_quote(datetime(2024, 6, 7, 17, 30))
+            self.assertEqual(datetime(2024, 6, 10, 5, 30), quote.next_session())
+            self.assertEqual(86400, quote.cache_ttl(now=datetime(2024, 6, 7, 19, 30)))
+            self.assertEqual(3600, quote.cache_ttl(now=datetime(2024, 6, 10, 4, 30)))
+            # past the estimate, a holiday perhaps
+            self.assertEqual(900, quote.cache_ttl(now=datetime(2024, 6, 10, 9, 0)))
+
+
+class TestSessionPool(unittest.TestCase):
+
+    class FakeSession(object):
+
+        def __init__(self):
+            self.closed = False
+
+        def close(self):
+            self.closed = True
+
+    def test_reuse_session(self):
+        pool = SessionPool(factory=self.FakeSession, max_size=2, idle_timeout=300)
+        with pool.session() as s1:
+            pass
+        with pool.session() as s2:
+            self.assertIs(s1, s2)
+        self.assertFalse(s1.closed)
+
+    def test_max_size(self):
+        pool = SessionPool(factory=self.FakeSession, max_size=1, idle_timeout=300)
+        s1 = pool.acquire()
+        s2 = pool.acquire()
+        self.assertIsNot(s1, s2)
+        pool.release(s1)
+        pool.release(s2)
+        self.assertEqual(1, pool.size())
+        self.assertTrue(s2.closed)
+
+    def test_idle_eviction(self):
+        pool = SessionPool(factory=self.FakeSession, max_size=2, idle_timeout=300)
+        s1 = pool.acquire()
+        pool.release(s1)
+        pool.idle[0] = (s1, time.monotonic() - 301)
+        s2 = pool.acquire()
+        self.assertIsNot(s1, s2)
+        self.assertTrue(s1.closed)
+
+    def test_failed_session_is_discarded(self):
+        pool = SessionPool(factory=self.FakeSession, max_size=2, idle_timeout=300)
+        with self.assertRaises(RuntimeError):
+            with pool.session() as s:
+                raise RuntimeError("broken connection")
+        self.assertTrue(s.closed)
+        self.assertEqual(0, pool.size())
+
+
+class TestYahooCookieAndCrumbRefresh(unittest.TestCase):
+
+    def setUp(self):
+        create_tables()
+        self.service = YahooQueryService()
+        self.service.session_pool = SessionPool(factory=object)
+
+    def tearDown(self):
+        drop_tables()
+
+    def test_single_flight_refresh(self):
+        calls = []
+
+        def slow_refresh():
+            calls.append(1)
+            time.sleep(0.1)
+            return {"A": "1"}, "crumb"
+
+        pool = self.service.session_pool
+        threads = [threading.Thread(target=pool.refresh_credentials, args=(0, slow_refresh)) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(1, len(calls))
+        self.assertEqual("crumb", pool.crumb)
+        self.assertEqual(1, pool.generation)
+
+    def test_refresh_is_stored_and_reused(self):
+        with patch.object(self.service, "_get_cookies_and_crumb", return_value=({"A": "1"}, "crumb")):
+            self.service.session_pool.refresh_credentials(0, self.service._refresh_cookies_and_crumb)
+        self.assertEqual(({"A": "1"}, "crumb"), YahooQueryService()._load_cookies_and_crumb())
+
+    def test_expired_credentials_are_not_reused(self):
+        with Session() as session:
+            YahooCredentials.save(session, {"A": "1"}, "crumb")
+        with patch.object(configuration, "snapshot", ConfigurationSnapshot({"YAHOO_CRUMB_MAX_AGE_S": "-1"})):
+            self.assertEqual(({}, None), self.service._load_cookies_and_crumb())
@@ -0,0 +1,68 @@
+import unittest
+
+from stockbot.ratelimit import TokenBucket, UpstreamLimiter
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst_and_refill(self):
+        clock = FakeClock()
+        sut = TokenBucket(rate=2, burst=2, clock=clock)
+        self.assertTrue(sut.try_acquire())
+        self.assertTrue(sut.try_acquire())
+        self.assertFalse(sut.try_acquire())
+        self.assertEqual(0.5, sut.wait_time())
+        clock.now = 0.5
+        self.assertTrue(sut.try_acquire())
+        self.assertFalse(sut.try_acquire())
+
+
+class TestUpstreamLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.sleeps = []
+        self.sut = UpstreamLimiter(name="test", max_concurrent=2, rate=1, burst=1, clock=self.clock, sleep=self.sleep)
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.clock.now += seconds
+
+    def test_waits_for_token(self):
+        self.assertTrue(self.sut.acquire())
+        self.sut.release()
+        self.assertTrue(self.sut.acquire())
+        self.sut.release()
+        self.assertEqual([1.0], self.sleeps)
+
+    def test_gives_up_after_timeout(self):
+        self.assertTrue(self.sut.acquire())
+        self.sut.release()
+        self.assertFalse(self.sut.acquire(timeout=0.5))
+        self.assertEqual([], self.sleeps)
+        # the slot was handed back
+        self.assertTrue(self.sut.acquire(timeout=1))
+        self.assertTrue(self.sut.semaphore.acquire(blocking=False))
+
+    def test_concurrency_limit(self):
+        sut = UpstreamLimiter(name="test", max_concurrent=1, rate=100, burst=100, clock=self.clock, sleep=self.sleep)
+        self.assertTrue(sut.acquire())
+        self.assertFalse(sut.acquire(timeout=0.01))
+        sut.release()
+        self.assertTrue(sut.acquire(timeout=0.01))
+
+    def test_back_off(self):
+        self.sut.back_off(30)
+        self.assertFalse(self.sut.acquire(timeout=10))
+        self.assertTrue(self.sut.acquire())
+        self.assertEqual([30.0], self.sleeps)
+        self.assertEqual(1, self.sut.back_offs)
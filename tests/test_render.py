@@ -0,0 +1,48 @@
+import json
+import unittest
+
+from stockbot import render
+from stockbot.util import ColorHelper
+
+
+class Row(object):
+
+    def __init__(self, fields):
+        self.fields = fields
+
+
+class TestRender(unittest.TestCase):
+
+    fields = [
+        ["Name", "Volvo B", render.TITLE],
+        ["Price", 250.5, render.NUMBER],
+        ["Percent Change 1 Day", -1.25, render.IMPORTANT_CHANGE],
+        ["Chart", "https://example.com", render.URL],
+        ["Market", "se_market"],
+    ]
+
+    def test_irc(self):
+        self.assertEqual(render.IRC_SEPARATOR.join([
+            "{}: {}".format(ColorHelper.purple("Name"), ColorHelper.bold(ColorHelper.white("Volvo B"))),
+            "{}: {}".format(ColorHelper.purple("Price"), ColorHelper.grey("250.500")),
+            "{}: {}".format(ColorHelper.purple("Percent Change 1 Day"), ColorHelper.bold(ColorHelper.red("-1.250"))),
+            "{}: {}".format(ColorHelper.purple("Chart"), ColorHelper.greenish("https://example.com")),
+            "{}: {}".format(ColorHelper.purple("Market"), ColorHelper.grey("se_market")),
+        ]), render.irc(self.fields))
+
+    def test_irc_non_numeric_number(self):
+        self.assertEqual("{}: {}".format(ColorHelper.purple("Price"), ColorHelper.grey("N/A")),
+                         render.irc([["Price", "N/A", render.CHANGE]]))
+
+    def test_plain(self):
+        self.assertEqual("Name: Volvo B, Price: 250.5, Percent Change 1 Day: -1.25, Chart: https://example.com, "
+                         "Market: se_market", render.plain(self.fields))
+
+    def test_json(self):
+        self.assertEqual({"Name": "Volvo B", "Price": 250.5, "Percent Change 1 Day": -1.25,
+                          "Chart": "https://example.com", "Market": "se_market"},
+                         json.loads(render.to_json(self.fields)))
+
+    def test_fields_of(self):
+        self.assertIsNone(render.fields_of("just a string"))
+        self.assertEqual(self.fields, render.fields_of(Row(self.fields)))
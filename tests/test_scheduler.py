@@ -0,0 +1,295 @@
+import os
+import threading
+import time
+import unittest
+from datetime import datetime, timezone
+
+from stockbot import deadline
+from stockbot.command import root_command
+from stockbot.executor import WorkerPool
+from stockbot.scheduler import CronSpec, JobFailed, JobRunner, JobScheduler, ScheduledJob
+from stockbot.timer import OncePerDayTimer, OncePerHourTimer
+
+
+class FakeClock(object):
+
+    def __init__(self, now):
+        self.now = now.timestamp()
+
+    def __call__(self):
+        return self.now
+
+
+class TestCronSpec(unittest.TestCase):
+
+    def test_five_fields(self):
+        sut = CronSpec("30 9 * * 1-5")
+        # 2024-06-07 is a friday
+        self.assertEqual(datetime(2024, 6, 10, 9, 30), sut.next_after(datetime(2024, 6, 7, 9, 30)))
+        self.assertEqual(datetime(2024, 6, 7, 9, 30), sut.next_after(datetime(2024, 6, 7, 9, 29, 59)))
+
+    def test_seconds_and_steps(self):
+        sut = CronSpec("*/15 * * * * *")
+        self.assertEqual(datetime(2024, 6, 7, 9, 0, 15), sut.next_after(datetime(2024, 6, 7, 9, 0, 0, 500)))
+        self.assertEqual(datetime(2024, 6, 7, 9, 1, 0), sut.next_after(datetime(2024, 6, 7, 9, 0, 45)))
+
+    def test_month_and_day_rollover(self):
+        sut = CronSpec("0 0 0 1 1,7 *")
+        self.assertEqual(datetime(2025, 1, 1), sut.next_after(datetime(2024, 7, 1)))
+
+    def test_day_of_month_or_day_of_week(self):
+        # the 13th or any sunday
+        sut = CronSpec("0 12 13 * 0")
+        self.assertEqual(datetime(2024, 6, 9, 12), sut.next_after(datetime(2024, 6, 7)))
+        self.assertEqual(datetime(2024, 6, 13, 12), sut.next_after(datetime(2024, 6, 9, 12)))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            CronSpec("* * *")
+        with self.assertRaises(ValueError):
+            CronSpec("0 60 * * * *")
+        with self.assertRaises(ValueError):
+            CronSpec("0 0 0 31 2 *").next_after(datetime(2024, 1, 1))
+
+
+class TestJobScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock(datetime(2024, 6, 7, 9, 0, 30))
+        self.sut = JobScheduler(clock=self.clock)
+
+    def job(self, name, spec, **kwargs):
+        return ScheduledJob(name=name, command=[name], spec=CronSpec(spec), **kwargs)
+
+    def test_next_delay_and_due(self):
+        self.assertIsNone(self.sut.next_delay())
+        self.sut.add(self.job("a", "0 * * * * *"))
+        self.sut.add(self.job("b", "45 * * * * *"))
+        self.assertEqual(15, self.sut.next_delay())
+        self.assertEqual([], self.sut.pop_due())
+        self.clock.now += 15
+        self.assertEqual(["b"], [x.name for x in self.sut.pop_due()])
+        self.assertEqual(15, self.sut.next_delay())
+        self.clock.now += 15
+        self.assertEqual(["a"], [x.name for x in self.sut.pop_due()])
+
+    def test_remove_and_replace(self):
+        self.sut.add(self.job("a", "0 * * * * *"))
+        self.sut.add(self.job("a", "45 * * * * *"))
+        self.assertEqual(1, len(self.sut.get_jobs()))
+        self.assertEqual(15, self.sut.next_delay())
+        self.assertTrue(self.sut.remove("a"))
+        self.assertFalse(self.sut.remove("a"))
+        self.assertIsNone(self.sut.next_delay())
+
+    def test_catch_up_policies(self):
+        self.sut.add(self.job("skip", "0 * * * * *", catch_up=ScheduledJob.SKIP, grace=60))
+        self.sut.add(self.job("once", "0 * * * * *", catch_up=ScheduledJob.ONCE))
+        self.sut.add(self.job("all", "0 * * * * *", catch_up=ScheduledJob.ALL))
+        # asleep for three minutes
+        self.clock.now += 180
+        self.assertEqual(["all", "all", "all", "once"], sorted(x.name for x in self.sut.pop_due()))
+        self.assertEqual(30, self.sut.next_delay())
+
+    def test_late_run_within_grace_is_not_skipped(self):
+        self.sut.add(self.job("skip", "0 * * * * *", catch_up=ScheduledJob.SKIP, grace=60))
+        self.clock.now += 40
+        self.assertEqual(["skip"], [x.name for x in self.sut.pop_due()])
+
+    def test_jitter(self):
+        sut = JobScheduler(clock=self.clock, random=lambda low, high: high)
+        sut.add(self.job("a", "0 * * * * *", jitter=5))
+        self.assertEqual(35, sut.next_delay())
+
+
+@unittest.skipUnless(hasattr(time, "tzset") and os.path.exists("/usr/share/zoneinfo/Europe/Stockholm"),
+                     "needs the tz database")
+class TestJobSchedulerDaylightSavingTime(unittest.TestCase):
+
+    def setUp(self):
+        self.tz = os.environ.get("TZ")
+        os.environ["TZ"] = "Europe/Stockholm"
+        time.tzset()
+
+    def tearDown(self):
+        if self.tz is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = self.tz
+        time.tzset()
+
+    @staticmethod
+    def utc(*args):
+        return datetime(*args, tzinfo=timezone.utc).timestamp()
+
+    def test_repeated_hour(self):
+        # 2024-10-27 02:30 the second time, clocks went back from 03:00 CEST to 02:00 CET
+        clock = FakeClock(datetime(2024, 10, 27, 2, 30, fold=1))
+        self.assertEqual(self.utc(2024, 10, 27, 1, 30), clock.now)
+        sut = JobScheduler(clock=clock)
+        job = ScheduledJob(name="job", spec=CronSpec("0 * * * * *"))
+        sut.add(job)
+        self.assertEqual(self.utc(2024, 10, 27, 1, 31), job.scheduled_at)
+        clock.now = job.scheduled_at
+        self.assertEqual([job], sut.pop_due())
+        self.assertEqual(self.utc(2024, 10, 27, 1, 32), job.scheduled_at)
+
+    def test_catch_up_all_through_repeated_hour(self):
+        # daily at 02:30 local time is due twice on the day the clocks go back
+        clock = FakeClock(datetime(2024, 10, 27, 0, 0))
+        sut = JobScheduler(clock=clock)
+        job = ScheduledJob(name="job", spec=CronSpec("30 2 * * *"), catch_up=ScheduledJob.ALL)
+        sut.add(job)
+        clock.now = self.utc(2024, 10, 27, 4, 0)
+        self.assertEqual([job, job], sut.pop_due())
+        self.assertEqual(datetime(2024, 10, 28, 2, 30), datetime.fromtimestamp(job.scheduled_at))
+
+    def test_gap(self):
+        # 2024-03-31 02:30 doesn't exist, clocks went forward from 02:00 CET to 03:00 CEST
+        clock = FakeClock(datetime(2024, 3, 31, 1, 59))
+        sut = JobScheduler(clock=clock)
+        job = ScheduledJob(name="job", spec=CronSpec("30 2 * * *"))
+        sut.add(job)
+        self.assertGreater(job.scheduled_at, clock.now)
+        clock.now = job.scheduled_at
+        self.assertEqual([job], sut.pop_due())
+        self.assertGreater(job.scheduled_at, clock.now)
+
+
+class TestTimerJobs(unittest.TestCase):
+
+    def test_timers_as_jobs(self):
+        hourly = OncePerHourTimer(["game", "reddit"], fire_at_minute=5).job()
+        self.assertEqual(datetime(2024, 6, 7, 10, 5), hourly.spec.next_after(datetime(2024, 6, 7, 9, 5)))
+        daily = OncePerDayTimer(["news"], fire_at_hour=8, fire_at_minute=30).job(catch_up=ScheduledJob.SKIP)
+        self.assertEqual(datetime(2024, 6, 8, 8, 30), daily.spec.next_after(datetime(2024, 6, 7, 9)))
+        self.assertEqual(ScheduledJob.SKIP, daily.catch_up)
+
+
+class TestJobRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = JobRunner(pool=WorkerPool(name="test-job", max_workers=2, max_queue_size=5))
+        self.release = threading.Event()
+        self.runs = []
+
+    def tearDown(self):
+        self.release.set()
+
+    def job(self, **kwargs):
+        return ScheduledJob(name="job", command=["help"], spec=CronSpec("* * * * *"), **kwargs)
+
+    def blocking(self, n):
+        self.runs.append(n)
+        self.release.wait(5)
+
+    def wait_until_idle(self, name="job"):
+        for _ in range(500):
+            status = self.runner.get_status(name)
+            if status is not None and not status.running and self.runner.pool.active_workers() == 0:
+                return status
+            time.sleep(0.01)
+        self.fail("job is still running")
+
+    def test_skip_overlapping_run(self):
+        job = self.job()
+        self.assertEqual(JobRunner.STARTED, self.runner.run(job, self.blocking, 1))
+        self.assertEqual(JobRunner.SKIPPED, self.runner.run(job, self.blocking, 2))
+        self.release.set()
+        status = self.wait_until_idle()
+        self.assertEqual([1], self.runs)
+        self.assertEqual(1, status.runs)
+        self.assertEqual(1, status.skipped)
+        self.assertIsNone(status.last_error)
+        self.assertIsNotNone(status.last_duration)
+
+    def test_queue_overlapping_run(self):
+        job = self.job(overlap=ScheduledJob.QUEUE)
+        self.assertEqual(JobRunner.STARTED, self.runner.run(job, self.blocking, 1))
+        self.assertEqual(JobRunner.QUEUED, self.runner.run(job, self.blocking, 2))
+        self.assertEqual(JobRunner.QUEUED, self.runner.run(job, self.blocking, 3))
+        self.release.set()
+        time.sleep(0.05)
+        status = self.wait_until_idle()
+        # only the latest queued run is kept
+        self.assertEqual([1, 3], self.runs)
+        self.assertEqual(2, status.runs)
+
+    def test_replace_overlapping_run(self):
+        job = self.job(overlap=ScheduledJob.REPLACE)
+
+        def until_cancelled(n):
+            self.runs.append(n)
+            while n == 1 and not deadline.expired():
+                time.sleep(0.01)
+
+        self.assertEqual(JobRunner.STARTED, self.runner.run(job, until_cancelled, 1))
+        while len(self.runs) == 0:
+            time.sleep(0.01)
+        self.assertEqual(JobRunner.REPLACED, self.runner.run(job, until_cancelled, 2))
+        status = self.wait_until_idle()
+        self.assertEqual(2, status.runs)
+        self.assertEqual(1, status.replaced)
+        # whenever the replaced run noticed, the status is the one of the run that replaced it
+        self.assertIsNone(status.last_error)
+
+    def test_max_runtime(self):
+        def slow():
+            while True:
+                deadline.check()
+                time.sleep(0.01)
+
+        self.runner.run(self.job(max_runtime=0.05), slow)
+        status = self.wait_until_idle()
+        self.assertEqual("timed out", status.last_error)
+
+    def test_error(self):
+        def fail():
+            raise ValueError("boom")
+
+        self.runner.run(self.job(), fail)
+        status = self.wait_until_idle()
+        self.assertEqual("boom", status.last_error)
+        self.assertEqual(1, status.runs)
+
+    def test_failure_reply(self):
+        def fail():
+            raise JobFailed("Something broke")
+
+        self.runner.run(self.job(), fail)
+        status = self.wait_until_idle()
+        self.assertEqual("Something broke", status.last_error)
+
+    def test_rejected_when_pool_is_full(self):
+        runner = JobRunner(pool=WorkerPool(name="test-full", max_workers=1, max_queue_size=1))
+        jobs = [ScheduledJob(name="job-{}".format(x), spec=CronSpec("* * * * *")) for x in range(3)]
+        self.assertEqual(JobRunner.STARTED, runner.run(jobs[0], self.blocking, 0))
+        while len(self.runs) == 0:
+            time.sleep(0.01)
+        self.assertEqual(JobRunner.STARTED, runner.run(jobs[1], self.blocking, 1))
+        self.assertEqual(JobRunner.REJECTED, runner.run(jobs[2], self.blocking, 2))
+        self.assertFalse(runner.get_status("job-2").running)
+        self.assertEqual(1, runner.get_status("job-2").rejected)
+
+
+class FakeBot(object):
+
+    def __init__(self):
+        self.job_scheduler = JobScheduler(clock=FakeClock(datetime(2024, 6, 7, 9, 0, 30)))
+        self.job_runner = JobRunner(pool=WorkerPool(name="test-status", max_workers=1))
+
+
+class TestSchedulerStatusCommand(unittest.TestCase):
+
+    def execute(self, bot):
+        result = []
+        root_command.execute("scheduler", "status", command_args={"instance": bot},
+                             callback=lambda x: result.append(x), callback_args={})
+        return result[0]
+
+    def test_status(self):
+        bot = FakeBot()
+        self.assertEqual("No jobs scheduled", self.execute(bot))
+        bot.job_scheduler.add(ScheduledJob(name="news", command=["news"], spec=CronSpec("0 10 * * *")))
+        self.assertEqual(["Job: news, Next run: 2024-06-07 10:00:00, Overlap: skip, Running: False, Runs: 0, "
+                          "Skipped: 0, Last ms: N/A, Last error: None"], self.execute(bot))